@@ -56,6 +56,11 @@ fi
 # (re)install application
 $VENV_DIR/bin/pip install --upgrade --upgrade-strategy eager pip setuptools wheel $CPB_DIR
 
+# add what this version needs to an existing database
+if [ $setup -eq 0 ]; then
+    sudo -u www-data bash -c ". $ENV_FILE && $VENV_DIR/bin/copypatrol-backend migrate -log:migrate.log"
+fi
+
 # setup application
 if [ $setup -eq 1 ]; then
     sudo -u www-data bash -c ". $ENV_FILE && $VENV_DIR/bin/copypatrol-backend setup -log:setup.log $webhook"
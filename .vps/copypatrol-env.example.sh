@@ -12,6 +12,8 @@ CPB_DB_PASSWORD=userpassword
 CPB_DB_PORT=3306
 CPB_DB_USERNAME=notroot
 
+CPB_SITE_METADATA_PATH=/var/www/copypatrol-site-metadata.json
+
 CPB_SYSTEMD_EMAIL_FROM=noreply@example.com
 CPB_SYSTEMD_EMAIL_TO=you@example.com
 CPB_SYSTEMD_SMTP_HOST=localhost
@@ -21,3 +23,6 @@ CPB_TCA_DOMAIN=example.example.com
 CPB_TCA_KEY=abcdefghijklmnopqrstuvqxyz1234567890
 CPB_TCA_WEBHOOK_DOMAIN=copypatrol-api.example.com
 CPB_TCA_WEBHOOK_SIGNING_SECRET=your-ascii-string-here
+
+CPB_TEXT_CACHE_MAX_MB=512
+CPB_TEXT_CACHE_PATH=/var/www/copypatrol-text-cache.sqlite3
@@ -1,24 +1,72 @@
 from __future__ import annotations
 
 import difflib
+import itertools
 import re
-from contextlib import suppress
-from functools import cache
-from typing import TYPE_CHECKING
+import signal
+import threading
+from contextlib import contextmanager, suppress
+from typing import TYPE_CHECKING, NamedTuple
 
+import cachetools
 import mwparserfromhell
 import pywikibot
 import pywikibot.exceptions
+from mwparserfromhell.definitions import URI_SCHEMES
 from pywikibot.page import Revision
 from pywikibot_extensions.page import Page
 
-from copypatrol_backend.wiki import load_revisions
+from copypatrol_backend import config, fingerprint, text_cache
+from copypatrol_backend.text_index import TextIndex
+from copypatrol_backend.wiki import (
+    compare_revisions,
+    latest_revids,
+    load_revisions,
+    load_revisions_by_id,
+)
 
 if TYPE_CHECKING:
+    from collections import Counter
+    from collections.abc import Callable, Iterable, Iterator, Mapping
+    from types import FrameType
+
+    from mwparserfromhell.nodes import Node
+    from mwparserfromhell.wikicode import Wikicode
     from pywikibot.site import APISite
 
+    Opcode = tuple[str, int, int, int, int]
+
+
+class RevisionMetadata(NamedTuple):
+    size: int | None = None
+    parent_size: int | None = None
+    sha1: str | None = None
+    parent_sha1: str | None = None
+    tags: list[str] | None = None
+    comment: str | None = None
+    comment_hidden: bool | None = None
+    text_hidden: bool | None = None
+
+
+class LinkedText(NamedTuple):
+    text_index: TextIndex
+    fingerprints: frozenset[int]
+
+
+class DiffBudget(NamedTuple):
+    # CPU seconds for one diff, and the combined size of the cleaned texts
+    # above which diffing is not attempted
+    seconds: float | None = 10.0
+    max_size: int | None = 4_000_000
+
+
+DEFAULT_BUDGET = DiffBudget()
+
+
+class DiffBudgetExceeded(Exception):
+    pass
+
 
-@cache
 def category_regex(site: APISite, /) -> re.Pattern[str]:
     namespaces = "|".join(site.namespaces.CATEGORY)
     return re.compile(
@@ -27,47 +75,213 @@ def category_regex(site: APISite, /) -> re.Pattern[str]:
     )
 
 
-@cache
 def file_name_regex(site: APISite, /) -> re.Pattern[str]:
     namespaces = "|".join(site.namespaces.FILE)
     extensions = "|".join(site.file_extensions)
     return re.compile(rf"({namespaces})\s*:.+?\.({extensions})", flags=re.I)
 
 
-def clean_wikitext(text: str, /, *, site: APISite) -> str:
-    text = text.strip()
-    if not text:
-        return ""
+# change whenever cleaning gives different output, so cached text is not reused
+CLEAN_VERSION = "1"
 
-    # remove bold/italic wikitext markup
-    text = re.sub(r"(?P<open>'{2,3})(.+?)(?P=open)", r"\2", text)
 
-    # remove categories
-    text = category_regex(site).sub("", text)
+class CleaningProfile(NamedTuple):
+    sitename: str
+    category_regex: re.Pattern[str]
+    file_name_regex: re.Pattern[str]
+    # quotes, block quotes and references shorter than this are removed
+    max_quote_words: int
+    # identifies the cleaning output, for keys of cached cleaned text
+    version: str
+
+
+def build_cleaning_profile(
+    site: APISite,
+    /,
+    *,
+    max_quote_words: int = 50,
+) -> CleaningProfile:
+    categories = category_regex(site)
+    file_names = file_name_regex(site)
+    key = "\0".join(
+        [
+            CLEAN_VERSION,
+            categories.pattern,
+            str(categories.flags),
+            file_names.pattern,
+            str(file_names.flags),
+            str(max_quote_words),
+        ]
+    )
+    return CleaningProfile(
+        sitename=site.sitename,
+        category_regex=categories,
+        file_name_regex=file_names,
+        max_quote_words=max_quote_words,
+        version=f"{CLEAN_VERSION}-{text_cache.text_sha1(key)[:12]}",
+    )
+
+
+# profiles by site name, built on first use or registered by the parent
+# process in pool workers
+cleaning_profiles: dict[str, CleaningProfile] = {}
+
+
+def cleaning_profile(site: APISite, /) -> CleaningProfile:
+    profile = cleaning_profiles.get(site.sitename)
+    if profile is None:
+        profile = build_cleaning_profile(site)
+        cleaning_profiles[site.sitename] = profile
+    return profile
+
 
-    # remove quotes of less than 50 words
-    for quote in re.findall('["“«].+?["”»]', text):
-        if len(quote.split()) < 50:
+def register_cleaning_profiles(profiles: Iterable[CleaningProfile], /) -> None:
+    for profile in profiles:
+        cleaning_profiles[profile.sitename] = profile
+
+
+# cleaned and indexed text of revisions linked in edit summaries, which
+# are often the same few source pages
+linked_text_cache: cachetools.LRUCache[tuple[str, int], LinkedText | None]
+linked_text_cache = cachetools.LRUCache(maxsize=64)
+# cleaned sections of long revisions by profile version, site and raw text
+# SHA-1, sized in characters; consecutive edits to a page share most of
+# their sections
+section_cache: cachetools.LRUCache[tuple[str, str, str], str]
+section_cache = cachetools.LRUCache(maxsize=8 << 20, getsizeof=len)
+# revisions shorter than this together are cleaned whole
+SECTION_MIN_SIZE = 20_000
+SECTION_REGEX = re.compile(r"^(?==+[^=\n].*=[ \t]*$)", flags=re.M)
+QUOTE_REGEX = re.compile('["“«].+?["”»]')
+QUOTE_MARK_REGEX = re.compile('["“«”»]')
+# anything the parser would turn into a node other than plain text
+MARKUP_REGEX = re.compile(
+    r"[\[{<&]|^(?:[=#*;:]|----)|(?:"
+    + "|".join(map(re.escape, URI_SCHEMES))
+    + "):",
+    flags=re.I | re.M,
+)
+
+
+def remove_quotes(text: str, /, *, max_words: int = 50) -> str:
+    removed = 0
+
+    def remove_quote(match: re.Match[str]) -> str:
+        nonlocal removed
+        if len(match[0].split()) < max_words:
+            removed += 1
+            return ""
+        return match[0]
+
+    result = QUOTE_REGEX.sub(remove_quote, text)
+    # when every quote mark delimits a removed quote, no quote can occur
+    # anywhere but its own matches, so one pass matches replacing each in turn
+    if len(QUOTE_MARK_REGEX.findall(text)) == 2 * removed:
+        return result
+    for quote in QUOTE_REGEX.findall(text):
+        if len(quote.split()) < max_words:
             text = text.replace(quote, "")
+    return text
+
+
+class NodeParents:
+    # Wikicode.replace and Wikicode.remove search the whole tree for the node
+    # on every call; this finds the same context from parent links instead
+    def __init__(self, wikicode: Wikicode, /) -> None:
+        self.root = wikicode
+        self.parents: dict[int, tuple[Node, Wikicode]] = {}
+        self.owners: dict[int, tuple[Wikicode, Node]] = {}
+        self.add(wikicode)
+
+    def add(
+        self,
+        code: Wikicode,
+        /,
+        nodes: Iterable[Node] | None = None,
+    ) -> None:
+        stack = [(code, code.nodes if nodes is None else nodes)]
+        while stack:
+            code, children = stack.pop()
+            for node in children:
+                self.parents[id(node)] = (node, code)
+                for child in node.__children__():
+                    self.owners[id(child)] = (child, node)
+                    stack.append((child, child.nodes))
+
+    def context(self, node: Node, /) -> tuple[Wikicode, int]:
+        parent = self.parents.get(id(node))
+        if parent is None or parent[0] is not node:
+            raise ValueError(node)
+        code = parent[1]
+        # by identity, as equal nodes can appear more than once
+        index = next(
+            (i for i, child in enumerate(code.nodes) if child is node),
+            None,
+        )
+        if index is None:
+            raise ValueError(node)
+        if code is not self.root:
+            owner = self.owners.get(id(code))
+            if owner is None or owner[0] is not code:
+                raise ValueError(node)
+            self.context(owner[1])
+        return code, index
+
+    def replace(self, node: Node, value: Wikicode | str, /) -> None:
+        code, index = self.context(node)
+        code.nodes.pop(index)
+        size = len(code.nodes)
+        code.insert(index, value)
+        end = index + len(code.nodes) - size
+        self.add(code, code.nodes[index:end])
+
+    def remove(self, node: Node, /) -> None:
+        code, index = self.context(node)
+        code.nodes.pop(index)
+
 
+def strip_markup(text: str, /, *, max_words: int = 50) -> str:
+    if not MARKUP_REGEX.search(text):
+        # what strip_code does to a single text node
+        text = text.strip("\n")
+        while "\n\n\n" in text:
+            text = text.replace("\n\n\n", "\n\n")
+        return text
     wikicode = mwparserfromhell.parse(text, skip_style_tags=True)
+    parents = NodeParents(wikicode)
     # replace external links with their title
     for link in wikicode.ifilter_external_links():
         with suppress(ValueError):
-            wikicode.replace(link, link.title or "")
-    # remove block quotes and references of less than 50 words
+            parents.replace(link, link.title or "")
+    # remove short block quotes and references
     for tag in wikicode.ifilter_tags(
         matches=lambda x: x.tag.lower() in ("blockquote", "ref", "references"),
     ):
         contents = tag.contents.strip_code(keep_template_params=True).strip()
-        if len(contents.split(" ")) < 50:
+        if len(contents.split(" ")) < max_words:
             with suppress(ValueError):
-                wikicode.remove(tag)
+                parents.remove(tag)
     # strip remaining code
-    text = wikicode.strip_code(keep_template_params=True)
+    return wikicode.strip_code(keep_template_params=True)
+
+
+def _clean_wikitext(text: str, /, *, profile: CleaningProfile) -> str:
+    # remove bold/italic wikitext markup
+    if "''" in text:
+        text = re.sub(r"(?P<open>'{2,3})(.+?)(?P=open)", r"\2", text)
+
+    # remove categories
+    if "[[" in text:
+        text = profile.category_regex.sub("", text)
+
+    # remove short quotes
+    text = remove_quotes(text, max_words=profile.max_quote_words)
+
+    text = strip_markup(text, max_words=profile.max_quote_words)
 
     # remove file names
-    text = file_name_regex(site).sub("", text)
+    if ":" in text:
+        text = profile.file_name_regex.sub("", text)
 
     # normalize whitespace
     text = re.sub(r" {2,}", " ", text)
@@ -77,25 +291,302 @@ def clean_wikitext(text: str, /, *, site: APISite) -> str:
     return text.strip()
 
 
-def added_revision_text(old: str, new: str, /, *, site: APISite) -> str:
-    old = clean_wikitext(old, site=site)
-    new = clean_wikitext(new, site=site)
-    sm = difflib.SequenceMatcher(None, old, new)
+def clean_wikitext(text: str, /, *, site: APISite) -> str:
+    text = text.strip()
+    if not text:
+        return ""
+    profile = cleaning_profile(site)
+    cached = text_cache.clean_text(site.sitename, profile.version, text)
+    if cached is not None:
+        return cached
+    cleaned = _clean_wikitext(text, profile=profile)
+    text_cache.save_clean_text(site.sitename, profile.version, text, cleaned)
+    return cleaned
+
+
+def clean_section(text: str, /, *, site: APISite) -> str:
+    version = cleaning_profile(site).version
+    key = (version, site.sitename, text_cache.text_sha1(text))
+    cleaned = section_cache.get(key)
+    if cleaned is None:
+        cleaned = clean_wikitext(text, site=site)
+        section_cache[key] = cleaned
+    return cleaned
+
+
+def clean_revisions(
+    old: str,
+    new: str,
+    /,
+    *,
+    site: APISite,
+    min_size: int = SECTION_MIN_SIZE,
+) -> tuple[str, str, str]:
+    # the cleaned old and new text to diff, and all the cleaned old text for
+    # finding moved lines; in long revisions only changed sections are diffed
+    if len(old) + len(new) < min_size:
+        old = clean_wikitext(old, site=site)
+        return old, clean_wikitext(new, site=site), old
+    old_sections = SECTION_REGEX.split(old)
+    new_sections = SECTION_REGEX.split(new)
+    old_raw, new_raw = set(old_sections), set(new_sections)
+
+    def join(sections: Iterable[str]) -> str:
+        cleaned = (clean_section(section, site=site) for section in sections)
+        return "\n\n".join(filter(None, cleaned))
+
+    return (
+        join(section for section in old_sections if section not in new_raw),
+        join(section for section in new_sections if section not in old_raw),
+        join(old_sections),
+    )
+
+
+def char_opcodes(old: str, new: str, /) -> Iterator[Opcode]:
+    yield from difflib.SequenceMatcher(None, old, new).get_opcodes()
+
+
+def _slide_insert(
+    new: str,
+    equal: Opcode,
+    insert: Opcode,
+    /,
+) -> tuple[Opcode, Opcode, Opcode]:
+    # move an insert as far left as the preceding equal block allows,
+    # matching where the character-level matcher places it
+    _, a1, a2, b1, b2 = equal
+    _, _, _, c1, c2 = insert
+    shift = 0
+    while shift < a2 - a1 and new[c1 - shift - 1] == new[c2 - shift - 1]:
+        shift += 1
+    return (
+        ("equal", a1, a2 - shift, b1, b2 - shift),
+        ("insert", a2 - shift, a2 - shift, c1 - shift, c2 - shift),
+        ("equal", a2 - shift, a2, c2 - shift, c2),
+    )
+
+
+def line_opcodes(old: str, new: str, /) -> Iterator[Opcode]:
+    # align lines first and only compare characters within changed lines
+    old_lines = old.splitlines(keepends=True)
+    new_lines = new.splitlines(keepends=True)
+    old_offsets = list(itertools.accumulate(map(len, old_lines), initial=0))
+    new_offsets = list(itertools.accumulate(map(len, new_lines), initial=0))
+    sm = difflib.SequenceMatcher(None, old_lines, new_lines)
+    previous: Opcode | None = None
+    for op, old_start, old_end, new_start, new_end in sm.get_opcodes():
+        a1, a2 = old_offsets[old_start], old_offsets[old_end]
+        b1, b2 = new_offsets[new_start], new_offsets[new_end]
+        if op == "replace":
+            if previous is not None:
+                yield previous
+                previous = None
+            for opcode in char_opcodes(old[a1:a2], new[b1:b2]):
+                yield (
+                    opcode[0],
+                    a1 + opcode[1],
+                    a1 + opcode[2],
+                    b1 + opcode[3],
+                    b1 + opcode[4],
+                )
+            continue
+        current: Opcode = (op, a1, a2, b1, b2)
+        if op == "insert" and previous is not None:
+            equal, insert, rest = _slide_insert(new, previous, current)
+            if equal[2] > equal[1]:
+                yield equal
+            yield insert
+            # the remainder merges with the following equal block
+            previous = rest if rest[2] > rest[1] else None
+            continue
+        if previous is not None:
+            if op == "equal":
+                current = ("equal", previous[1], a2, previous[3], b2)
+            else:
+                yield previous
+        if op == "equal":
+            previous = current
+        else:
+            yield current
+            previous = None
+    if previous is not None:
+        yield previous
+
+
+# "line" is faster on large pages, but aligning lines first can match
+# different text than "char" does: on random edits that change several
+# places, added text differs for about 40% of pages (see
+# testing.benchmarks.diff_engine), so it is only used when asked for
+DIFF_ENGINES: dict[str, Callable[[str, str], Iterator[Opcode]]] = {
+    "char": char_opcodes,
+    "line": line_opcodes,
+}
+# how check_diff gets the changed text: by diffing both revisions locally,
+# or from the blocks of the wiki's own diff
+DIFF_MODES = ("full", "compare")
+
+
+def added_text(
+    old: str,
+    new: str,
+    /,
+    *,
+    engine: str = "char",
+    context: str | None = None,
+) -> str:
+    # added lines found anywhere in context (default: old) were moved
+    old_index = TextIndex(old if context is None else context)
     return "\n".join(
         line
-        for op, _, _, new_start, new_end in sm.get_opcodes()
+        for op, _, _, new_start, new_end in DIFF_ENGINES[engine](old, new)
         if op == "insert"
         if new_end - new_start > 50
         for line in "".join(new[new_start:new_end]).strip(" ").splitlines()
-        if not line.strip() or line.strip() not in old
+        if not line.strip() or line.strip() not in old_index
     ).strip()
 
 
+def approximate_added_text(old: str, new: str, /) -> str:
+    # line set difference: runs of new lines that are not lines of the old
+    old_lines = {line.strip() for line in old.splitlines() if line.strip()}
+    added = []
+    for in_old, lines in itertools.groupby(
+        new.splitlines(),
+        key=lambda line: line.strip() in old_lines,
+    ):
+        run = list(lines)
+        if not in_old and len("\n".join(run).strip(" ")) > 50:
+            added.extend(run)
+    return "\n".join(added).strip()
+
+
+@contextmanager
+def cpu_budget(seconds: float | None, /) -> Iterator[None]:
+    # signals can only be handled in the main thread, so other threads run
+    # without a time limit
+    if (
+        seconds is None
+        or not hasattr(signal, "setitimer")
+        or threading.current_thread() is not threading.main_thread()
+    ):
+        yield
+        return
+
+    def handler(signum: int, frame: FrameType | None) -> None:
+        raise DiffBudgetExceeded
+
+    previous = signal.signal(signal.SIGPROF, handler)
+    signal.setitimer(signal.ITIMER_PROF, seconds)
+    try:
+        yield
+    finally:
+        signal.setitimer(signal.ITIMER_PROF, 0)
+        signal.signal(signal.SIGPROF, previous)
+
+
+def bounded_added_text(
+    old: str,
+    new: str,
+    /,
+    *,
+    engine: str = "char",
+    context: str | None = None,
+    budget: DiffBudget = DEFAULT_BUDGET,
+) -> tuple[str, bool]:
+    if budget.max_size is None or len(old) + len(new) <= budget.max_size:
+        try:
+            with cpu_budget(budget.seconds):
+                text = added_text(old, new, engine=engine, context=context)
+                return text, False
+        except DiffBudgetExceeded:
+            pass
+    if context is not None:
+        old = context
+    return approximate_added_text(old, new), True
+
+
+def added_revision_text(
+    old: str,
+    new: str,
+    /,
+    *,
+    site: APISite,
+    engine: str = "char",
+) -> str:
+    old, new, context = clean_revisions(old, new, site=site)
+    return added_text(old, new, engine=engine, context=context)
+
+
+def added_compare_text(site: APISite, old: int, new: int, /) -> str | None:
+    blocks = compare_revisions(site, old, new)
+    if blocks is None:
+        return None
+    return added_revision_text(
+        "\n\n".join(old_block for old_block, _ in blocks),
+        "\n\n".join(new_block for _, new_block in blocks),
+        site=site,
+    )
+
+
+def linked_texts(pages: Iterable[pywikibot.Page], /) -> list[LinkedText]:
+    titles: dict[APISite, list[str]] = {}
+    for linked_page in pages:
+        titles.setdefault(linked_page.site, []).append(linked_page.title())
+    texts: list[LinkedText] = []
+    for site, site_titles in titles.items():
+        found: dict[int, LinkedText | None] = {}
+        missing = []
+        for revid in latest_revids(site, site_titles):
+            if (site.sitename, revid) in linked_text_cache:
+                found[revid] = linked_text_cache[site.sitename, revid]
+            else:
+                missing.append(revid)
+        if missing:
+            fetched = load_revisions_by_id(site, missing, content=True)
+            for revid, data in fetched.items():
+                text = data["slots"]["main"].get("*")
+                if text is not None:
+                    cleaned = clean_wikitext(text, site=site)
+                    found[revid] = LinkedText(
+                        TextIndex(cleaned),
+                        fingerprint.fingerprints(cleaned),
+                    )
+                else:
+                    pywikibot.debug(f"linked revision {revid} is hidden")
+                    found[revid] = None
+                linked_text_cache[site.sitename, revid] = found[revid]
+        texts.extend(text for text in found.values() if text is not None)
+    return texts
+
+
+def is_rollback(tags: Iterable[str], /) -> bool:
+    tags = set(tags)
+    return "mw-rollback" in tags or {"mw-undo", "twinkle"} <= tags
+
+
+def metadata_rejection(metadata: RevisionMetadata, /) -> str | None:
+    if metadata.tags is not None and is_rollback(metadata.tags):
+        return "was a rollback"
+    if metadata.text_hidden:
+        return "is hidden"
+    if metadata.sha1 is not None and metadata.sha1 == metadata.parent_sha1:
+        return "is an identity revert"
+    if metadata.size is not None and metadata.size < 500:
+        return "too small to compare"
+    return None
+
+
 def check_diff(
     page: pywikibot.Page,
     old: int,
     new: int,
     /,
+    *,
+    metadata: RevisionMetadata | None = None,
+    revisions: Mapping[int, Revision] | None = None,
+    diff_mode: str = "full",
+    budget: DiffBudget = DEFAULT_BUDGET,
+    stats: Counter[str] | None = None,
 ) -> str | None:
     def rev_text_hidden(rev: Revision) -> bool:
         if "texthidden" in rev["slots"]["main"]:
@@ -103,38 +594,69 @@ def check_diff(
             return True
         return False
 
-    def small_len(text: str) -> bool:
-        if len(text) < 500:
+    def too_small(size: int) -> bool:
+        if size < 500:
             pywikibot.debug(f"revision {new} to {page!r} too small to compare")
             return True
         return False
 
+    def small_len(text: str) -> bool:
+        return too_small(len(text))
+
     pywikibot.debug(f"checking revision {new} to {page!r}")
-    revs = load_revisions(
-        page.site,
-        [r for r in (old, new) if r > 0],
-        content=True,
-    )
+    if metadata is not None and (reason := metadata_rejection(metadata)):
+        pywikibot.debug(f"revision {new} to {page!r} {reason}")
+        return None
+    revids = [r for r in (old, new) if r > 0]
+    # the compare mode only needs the text of new pages
+    content = diff_mode == "full" or old <= 0
+    revs: Mapping[int, Revision] | None
+    if revisions is None:
+        revs = load_revisions(page.site, revids, content=content)
+    elif all(revid in revisions for revid in revids):
+        revs = revisions
+    else:
+        revs = None
     if revs is None:
         pywikibot.debug(f"{page!r} was deleted")
         return None
     new_rev = revs[new]
-    if "mw-rollback" in new_rev.tags or {"mw-undo", "twinkle"} <= set(
-        new_rev.tags
-    ):
+    if is_rollback(new_rev.tags):
         pywikibot.debug(f"revision {new} to {page!r} was a rollback")
         return None
-    if rev_text_hidden(new_rev) or small_len(new_rev.text):
+    if rev_text_hidden(new_rev):
+        return None
+    if too_small(new_rev.size if new_rev.text is None else len(new_rev.text)):
         return None
     if old > 0:
         old_rev = revs[old]
         if rev_text_hidden(old_rev):
             return None
-        added_text = added_revision_text(
-            old_rev.text,
-            new_rev.text,
-            site=page.site,
-        )
+        if diff_mode == "compare":
+            compared = added_compare_text(page.site, old, new)
+            if compared is None:
+                pywikibot.debug(f"revision {new} to {page!r} not compared")
+                return None
+            added_text = compared
+        else:
+            old_text, new_text, context = clean_revisions(
+                old_rev.text,
+                new_rev.text,
+                site=page.site,
+            )
+            added_text, approximate = bounded_added_text(
+                old_text,
+                new_text,
+                context=context,
+                budget=budget,
+            )
+            if stats is not None:
+                stats["diffs"] += 1
+                stats["approximate"] += approximate
+            if approximate:
+                pywikibot.log(
+                    f"revision {new} to {page!r} diffed approximately"
+                )
     else:
         added_text = clean_wikitext(new_rev.text, site=page.site)
     if small_len(added_text):
@@ -145,6 +667,7 @@ def check_diff(
             new_rev.comment,
             skip_style_tags=True,
         )
+        linked_pages = []
         for wikilink in comment_wikicode.ifilter_wikilinks():
             with suppress(
                 ValueError,
@@ -153,17 +676,26 @@ def check_diff(
                 pywikibot.exceptions.InvalidTitleError,
             ):
                 linked_page = Page.from_wikilink(wikilink, page.site)
-                if linked_page.namespace().id < 0 or not linked_page.exists():
-                    continue
-                for rev in linked_page.revisions(total=2, content=True):
-                    if rev_text_hidden(rev):
-                        continue
-                    linked_page_text = clean_wikitext(rev.text, site=page.site)
-                    added_text = "\n".join(
-                        part
-                        for part in added_text.splitlines()
-                        if not part.strip() or part not in linked_page_text
-                    )
+                if linked_page.namespace().id >= 0:
+                    linked_pages.append(linked_page)
+        linked = linked_texts(linked_pages)
+        for linked_text in linked:
+            added_text = "\n".join(
+                part
+                for part in added_text.splitlines()
+                if not part.strip() or part not in linked_text.text_index
+            )
+        if linked:
+            # also remove lightly edited copies
+            site_config = config.site_config(page.site.hostname())
+            threshold = site_config.copied_coverage
+            reference = frozenset().union(*(t.fingerprints for t in linked))
+            added_text = "\n".join(
+                part
+                for part in added_text.splitlines()
+                if not part.strip()
+                or fingerprint.coverage(part, reference) < threshold
+            )
         if small_len(added_text):
             return None
     return added_text
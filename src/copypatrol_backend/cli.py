@@ -2,113 +2,666 @@ from __future__ import annotations
 
 import argparse
 import datetime
+import functools
+import itertools
 import multiprocessing.pool
 import operator
 import os
+import signal
+import socket
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, Any, NamedTuple
 
 import pywikibot
 from pywikibot.exceptions import InvalidTitleError, PageSaveRelatedError
-from sqlalchemy.exc import IntegrityError, OperationalError
+from pywikibot.page import Revision
+from pywikibot.time import Timestamp
+from sqlalchemy.exc import OperationalError
 from sqlalchemy.orm.exc import StaleDataError
 
-from copypatrol_backend import database, tca
-from copypatrol_backend.check_diff import check_diff
-from copypatrol_backend.config import meta_config
-from copypatrol_backend.stream_listener import change_stream
+from copypatrol_backend import (
+    database,
+    pipeline,
+    site_metadata,
+    tca,
+    wiki,
+)
+from copypatrol_backend.check_diff import (
+    DEFAULT_BUDGET,
+    DIFF_MODES,
+    CleaningProfile,
+    DiffBudget,
+    RevisionMetadata,
+    check_diff,
+    cleaning_profile,
+    metadata_rejection,
+    register_cleaning_profiles,
+)
+from copypatrol_backend.config import meta_config, site_metadata_path
+from copypatrol_backend.stream_listener import (
+    STREAM,
+    StreamStats,
+    change_stream,
+    prescreen_rejections,
+    record_stream,
+    replay_stream,
+)
+
+if TYPE_CHECKING:
+    from collections.abc import Container, Sequence
+    from types import FrameType
+
+    from pywikibot.site import APISite
+    from sqlalchemy.orm import Session, sessionmaker
+
+    RevisionData = dict[int, dict[str, Any]]
+    PrefetchedDiff = tuple["DiffTask", RevisionData | None]
+
+
+def _queued_diff(event: dict[str, Any], /) -> database.QueuedDiff:
+    revision = event["revision"]
+    old_rev = event.get("prior_state", {}).get("revision", {})
+    comment_visible = revision.get("is_comment_visible")
+    text_visible = revision.get("is_content_visible")
+    return database.QueuedDiff.from_page(
+        pywikibot.Page(
+            wiki.site_from_domain(event["meta"]["domain"]),
+            event["page"]["page_title"],
+        ),
+        rev_id=revision["rev_id"],
+        rev_parent_id=revision.get("rev_parent_id", 0),
+        rev_timestamp=revision["rev_dt"],
+        rev_user_text=revision["editor"]["user_text"],
+        rev_size=revision.get("rev_size"),
+        rev_parent_size=old_rev.get("rev_size"),
+        rev_sha1=revision.get("rev_sha1"),
+        rev_parent_sha1=old_rev.get("rev_sha1"),
+        rev_tags=revision.get("tags"),
+        rev_comment=revision.get("comment"),
+        rev_comment_hidden=(
+            None if comment_visible is None else not comment_visible
+        ),
+        rev_text_hidden=None if text_visible is None else not text_visible,
+    )
+
+
+def _flush_queued_diffs(
+    sessionmaker: sessionmaker[Session],
+    diffs: list[database.QueuedDiff],
+    checkpoint: Timestamp | None,
+    /,
+) -> int:
+    if not diffs and checkpoint is None:
+        return 0
+    with sessionmaker.begin() as session:
+        count = database.add_revisions(session, diffs)
+        if checkpoint is not None:
+            database.save_stream_checkpoint(session, STREAM, checkpoint)
+    pywikibot.debug(f"queued {count} of {len(diffs)} revisions")
+    diffs.clear()
+    return count
 
 
 def store_changes(
     *,
     since: datetime.datetime | None = None,
     total: int | None = None,
+    batch_size: int = 1,
+    batch_interval: float | None = None,
+    replay: str | None = None,
+    realtime: bool = False,
 ) -> None:
     sessionmaker = database.create_sessionmaker()
-    for event in change_stream(since=since, total=total):
-        try:
+    stats = StreamStats()
+    if replay is not None:
+        stream = replay_stream(
+            replay,
+            realtime=realtime,
+            total=total,
+            stats=stats,
+            heartbeat=True,
+        )
+    else:
+        if since is None:
             with sessionmaker.begin() as session:
-                database.add_revision(
-                    session=session,
-                    page=pywikibot.Page(
-                        pywikibot.Site(url=event["meta"]["uri"]),
-                        event["page"]["page_title"],
-                    ),
-                    rev_id=event["revision"]["rev_id"],
-                    rev_parent_id=event["revision"].get("rev_parent_id", 0),
-                    rev_timestamp=event["revision"]["rev_dt"],
-                    rev_user_text=event["revision"]["editor"]["user_text"],
-                )
-        except (IntegrityError, InvalidTitleError) as e:  # pragma: no cover
-            pywikibot.warning(e)
+                since = database.stream_checkpoint(session, STREAM)
+            if since is not None:
+                # events from other partitions may arrive slightly out of order
+                since -= datetime.timedelta(minutes=1)
+                pywikibot.info(f"resuming {STREAM} since {since.isoformat()}")
+        stream = change_stream(
+            since=since,
+            total=total,
+            stats=stats,
+            heartbeat=True,
+        )
+    batch: list[database.QueuedDiff] = []
+    checkpoint: Timestamp | None = None
+    queued = 0
+    flushed = time.monotonic()
+    for event in stream:
+        # rejected events come through as None, so that a partial batch is
+        # still stored on time while every event is filtered out
+        if event is not None:
+            if replay is None:
+                checkpoint = Timestamp.set_timestamp(event["meta"]["dt"])
+            try:
+                batch.append(_queued_diff(event))
+            except InvalidTitleError as e:  # pragma: no cover
+                pywikibot.warning(e)
+        if len(batch) >= batch_size or (
+            batch_interval is not None
+            and time.monotonic() - flushed >= batch_interval
+        ):
+            queued += _flush_queued_diffs(sessionmaker, batch, checkpoint)
+            checkpoint = None
+            flushed = time.monotonic()
+    queued += _flush_queued_diffs(sessionmaker, batch, checkpoint)
+    elapsed = max(time.monotonic() - stats.started, 1e-9)
+    pywikibot.info(
+        f"{stats.summary()}, {queued} queued ({queued / elapsed:.1f}/s)"
+    )
+    pywikibot.info(f"prescreen rejections: {dict(prescreen_rejections)}")
+
+
+def record_changes(
+    path: str,
+    /,
+    *,
+    since: datetime.datetime | None = None,
+    total: int | None = None,
+) -> None:
+    count = record_stream(path, since=since, total=total)
+    pywikibot.info(f"recorded {count} events to {path}")
+
+
+def _revision_metadata(diff: database.QueuedDiff, /) -> RevisionMetadata:
+    return RevisionMetadata(
+        size=diff.rev_size,
+        parent_size=diff.rev_parent_size,
+        sha1=diff.rev_sha1,
+        parent_sha1=diff.rev_parent_sha1,
+        tags=diff.rev_tags,
+        comment=diff.rev_comment,
+        comment_hidden=diff.rev_comment_hidden,
+        text_hidden=diff.rev_text_hidden,
+    )
+
+
+POLL_INTERVAL = 1.0
+DEFAULT_LEASE = datetime.timedelta(minutes=15)
+
+
+class DiffTask(NamedTuple):
+    diff_id: int
+    project: str
+    lang: str
+    page_namespace: int
+    page_title: str
+    rev_id: int
+    rev_parent_id: int
+    metadata: RevisionMetadata
+    # sent to workers for sites whose profile they did not start with
+    profile: CleaningProfile | None = None
+
+    @classmethod
+    def from_diff(cls, diff: database.QueuedDiff, /) -> DiffTask:
+        return cls(
+            diff_id=diff.diff_id,
+            project=diff.project,
+            lang=diff.lang,
+            page_namespace=diff.page_namespace,
+            page_title=diff.page_title,
+            rev_id=diff.rev_id,
+            rev_parent_id=diff.rev_parent_id,
+            metadata=_revision_metadata(diff),
+        )
+
+    @property
+    def site(self) -> APISite:
+        return wiki.site_from_code(self.lang, self.project)
+
+
+class DiffResult(NamedTuple):
+    diff_id: int
+    outcome: str
+    text: str | None
+
+
+def _init_worker(profiles: list[CleaningProfile], /) -> None:
+    # workers exit on SIGTERM and leave SIGINT to the parent, even when
+    # forked while the parent handles them to stop gracefully
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # workers that are not forked from the parent start without its state
+    site_metadata.load()
+    register_cleaning_profiles(profiles)
+
+
+def _site_cleaning_profile(site: APISite, /) -> CleaningProfile | None:
+    try:
+        return cleaning_profile(site)
+    except Exception:  # pragma: no cover
+        pywikibot.exception()
+        return None
+
+
+def _unfetched_batch(
+    batch: tuple[APISite, list[DiffTask]],
+    /,
+) -> list[PrefetchedDiff]:
+    # workers load the revisions of these themselves
+    return [(task, None) for task in batch[1]]
 
 
 def _check_diff(
+    item: PrefetchedDiff,
+    /,
+    *,
+    diff_mode: str = "full",
+    budget: DiffBudget = DEFAULT_BUDGET,
+) -> DiffResult:
+    task, revisions = item
+    if task.profile is not None:
+        register_cleaning_profiles([task.profile])
+    stats: Counter[str] = Counter()
+    try:
+        page = wiki.page_from_title(
+            task.site,
+            task.page_namespace,
+            task.page_title,
+        )
+        text = check_diff(
+            page,
+            task.rev_parent_id,
+            task.rev_id,
+            metadata=task.metadata,
+            revisions=(
+                None
+                if revisions is None
+                else {
+                    revid: Revision(**data)
+                    for revid, data in revisions.items()
+                }
+            ),
+            diff_mode=diff_mode,
+            budget=budget,
+            stats=stats,
+        )
+    except Exception:  # pragma: no cover
+        pywikibot.exception()
+        return DiffResult(task.diff_id, "failed", None)
+    outcome = "approximate" if stats["approximate"] else "checked"
+    return DiffResult(task.diff_id, outcome, text)
+
+
+def _fetch_diff_revisions(
+    site: APISite,
+    tasks: list[DiffTask],
+    /,
+    *,
+    diff_mode: str = "full",
+) -> RevisionData | None:
+    revids: dict[bool, list[int]] = {True: [], False: []}
+    for task in tasks:
+        if metadata_rejection(task.metadata) is not None:
+            continue
+        # the compare mode only needs the text of new pages
+        content = diff_mode == "full" or task.rev_parent_id <= 0
+        revids[content].extend(
+            revid for revid in (task.rev_parent_id, task.rev_id) if revid > 0
+        )
+    revisions: RevisionData = {}
+    try:
+        for content, content_revids in revids.items():
+            if content_revids:
+                revisions |= wiki.load_revisions_by_id(
+                    site,
+                    content_revids,
+                    content=content,
+                )
+    except Exception:  # pragma: no cover
+        pywikibot.exception()
+        return None
+    return revisions
+
+
+def _diff_batches(
+    tasks: Sequence[DiffTask],
+    /,
+) -> list[tuple[APISite, list[DiffTask]]]:
+    key = operator.attrgetter("project", "lang")
+    batches = []
+    for _, group in itertools.groupby(sorted(tasks, key=key), key=key):
+        site_tasks = list(group)
+        site = site_tasks[0].site
+        size = max(1, site.maxlimit // 2)
+        for start in range(0, len(site_tasks), size):
+            end = start + size
+            batches.append((site, site_tasks[start:end]))
+    return batches
+
+
+def _fetch_batch(
+    batch: tuple[APISite, list[DiffTask]],
+    /,
+    *,
+    diff_mode: str = "full",
+) -> list[PrefetchedDiff]:
+    site, tasks = batch
+    revisions = _fetch_diff_revisions(site, tasks, diff_mode=diff_mode)
+    if revisions is None:
+        return _unfetched_batch(batch)
+    return [
+        (
+            task,
+            {
+                revid: revisions[revid]
+                for revid in (task.rev_parent_id, task.rev_id)
+                if revid in revisions
+            },
+        )
+        for task in tasks
+    ]
+
+
+def _submit_diff(
+    api: tca.TurnitinCoreAPI,
+    writer: database.StatusWriter,
     diff: database.QueuedDiff,
-) -> tuple[database.QueuedDiff, str | None] | Exception:
+    text: str,
+    /,
+    *,
+    title: str,
+) -> bool:
+    if diff.submission_id is None:
+        try:
+            diff.submission_id = api.create_submission(
+                site=diff.site,
+                title=title,
+                timestamp=diff.rev_timestamp,
+                owner=diff.rev_user_text,
+            )
+        except Exception:  # pragma: no cover
+            pywikibot.exception()
+            return False
+        try:
+            found = writer.created(diff.diff_id, diff.submission_id)
+        except Exception:  # pragma: no cover
+            pywikibot.exception()
+            pywikibot.error(
+                f"submission {diff.submission_id} of diff {diff.diff_id}"
+                " was not saved"
+            )
+            return False
+        if not found:
+            pywikibot.warning(f"diff {diff.diff_id} is no longer queued")
     try:
-        return diff, check_diff(diff.page, diff.rev_parent_id, diff.rev_id)
-    except Exception as e:  # pragma: no cover
+        api.upload_submission(diff.submission_id, text)
+    except Exception:  # pragma: no cover
         pywikibot.exception()
-        return e
+        return False
+    writer.update(diff.diff_id, database.Status.UPLOADED)
+    return True
 
 
-def check_changes(*, poolsize: int = 1, limit: int | None = None) -> None:
-    sessionmaker = database.create_sessionmaker()
+def _finish_diff(
+    res: DiffResult,
+    diff: database.QueuedDiff,
+    /,
+    *,
+    api: tca.TurnitinCoreAPI,
+    writer: database.StatusWriter,
+) -> bool:
+    if res.outcome == "failed":
+        return False
+    if res.text is None:
+        writer.delete(res.diff_id)
+        return True
+    return _submit_diff(
+        api,
+        writer,
+        diff,
+        res.text,
+        title=f"Revision {diff.rev_id} of {diff.page.title()}",
+    )
+
+
+def _poll_diffs(
+    sessionmaker: sessionmaker[Session],
+    owner: str,
+    /,
+    *,
+    lease: datetime.timedelta,
+    limit: int | None = None,
+    skip: Container[int] = (),
+) -> list[database.QueuedDiff]:
     with sessionmaker.begin() as session:
-        diffs = database.diffs_by_status(
+        diffs = database.claim_queued_diffs(
             session,
-            database.QueuedDiff,
-            [database.Status.UNSUBMITTED, database.Status.CREATED],
+            owner,
+            lease=lease,
             limit=limit,
         )
-    if not diffs:
+    return [diff for diff in diffs if diff.diff_id not in skip]
+
+
+def check_changes(
+    *,
+    poolsize: int = 1,
+    limit: int | None = None,
+    diff_mode: str = "full",
+    budget: DiffBudget = DEFAULT_BUDGET,
+    fetch_concurrency: int = 2,
+    tca_concurrency: int = 4,
+    daemon: bool = False,
+    poll_interval: float = 30.0,
+    worker_id: str | None = None,
+    lease: datetime.timedelta = DEFAULT_LEASE,
+) -> None:
+    if worker_id is None:
+        worker_id = f"{socket.gethostname()}:{os.getpid()}"
+    sessionmaker = database.create_sessionmaker()
+    writer = database.StatusWriter(sessionmaker)
+    # claim diffs so that other checkers sharing the queue skip them
+    diffs = _poll_diffs(sessionmaker, worker_id, lease=lease, limit=limit)
+    if not diffs and not daemon:
         return
-    api = tca.TurnitinCoreAPI()
-    chunksize, extra = divmod(len(diffs), poolsize * 4)
-    if extra:
-        chunksize += 1
-    pywikibot.debug(f"Pool({poolsize}) {chunksize=} for {len(diffs)} diffs")
-    with multiprocessing.Pool(poolsize) as pool:
-        for res in pool.imap_unordered(_check_diff, diffs, chunksize):
-            if isinstance(res, Exception):
-                continue
-            diff, text = res
-            with sessionmaker() as session:
-                session.add(diff)
-                if text is None:
-                    session.delete(diff)
-                    try:
-                        session.commit()
-                    except OperationalError:  # pragma: no cover
-                        pywikibot.exception(exc_info=False)
-                    continue
-                if diff.submission_id is None:
-                    title = f"Revision {diff.rev_id} of {diff.page.title()}"
-                    try:
-                        diff.submission_id = api.create_submission(
-                            site=diff.site,
-                            title=title,
-                            timestamp=diff.rev_timestamp,
-                            owner=diff.rev_user_text,
-                        )
-                    except Exception:  # pragma: no cover
-                        pywikibot.exception()
-                        continue
-                    else:
-                        diff.status = database.Status.CREATED
-                        try:
-                            session.commit()
-                        except StaleDataError:  # pragma: no cover
-                            pywikibot.exception(exc_info=False)
+    api = tca.TurnitinCoreAPI(pool_maxsize=tca_concurrency)
+    # build each site's cleaning profile once rather than in every worker
+    profiles = []
+    for site in {diff.site for diff in diffs}:
+        if (profile := _site_cleaning_profile(site)) is not None:
+            profiles.append(profile)
+    # sites polled later are not known to the pool initializer, so their
+    # profiles are built here as well and sent along with their tasks
+    pool_sites = {profile.sitename for profile in profiles}
+    # workers only get what they need to check a diff, and the results are
+    # written back by primary key rather than by merging whole rows
+    in_flight: dict[int, database.QueuedDiff] = {}
+    # diffs that failed are retried, but do not count as new work
+    retry: set[int] = set()
+    # and their leases are given up so that they can be claimed again
+    failed: set[int] = set()
+    outcomes: Counter[str] = Counter()
+    lock = threading.Lock()
+    # revisions are fetched by threads, checked by worker processes and
+    # submitted to Turnitin by threads, with bounded queues in between
+    stages = {
+        "fetch": pipeline.StageStats("fetch", workers=fetch_concurrency),
+        "check": pipeline.StageStats("check", workers=poolsize),
+        "submit": pipeline.StageStats("submit", workers=tca_concurrency),
+    }
+    batches: pipeline.Channel[tuple[APISite, list[DiffTask]]]
+    batches = pipeline.Channel(
+        stats=stages["fetch"],
+        consumers=fetch_concurrency,
+    )
+    fetched: pipeline.Channel[PrefetchedDiff]
+    fetched = pipeline.Channel(4 * poolsize, stats=stages["check"])
+    checked: pipeline.Channel[DiffResult] = pipeline.Channel(
+        4 * tca_concurrency,
+        stats=stages["submit"],
+        consumers=tca_concurrency,
+    )
+
+    def enqueue(diffs: list[database.QueuedDiff], /) -> int:
+        with lock:
+            in_flight.update((diff.diff_id, diff) for diff in diffs)
+            new = sum(diff.diff_id not in retry for diff in diffs)
+        tasks = []
+        for diff in diffs:
+            task = DiffTask.from_diff(diff)
+            if task.site.sitename not in pool_sites:
+                task = task._replace(profile=_site_cleaning_profile(task.site))
+            tasks.append(task)
+        for batch in _diff_batches(tasks):
+            batches.put(batch)
+        return new
+
+    def finish(res: DiffResult, /) -> tuple[()]:
+        with lock:
+            diff = in_flight[res.diff_id]
+        done = False
+        try:
+            done = _finish_diff(res, diff, api=api, writer=writer)
+        except Exception:  # pragma: no cover
+            pywikibot.exception()
+        finally:
+            # a diff left in flight would never be polled again
+            with lock:
+                outcomes[res.outcome] += 1
+                del in_flight[res.diff_id]
+                if done:
+                    retry.discard(res.diff_id)
+                else:
+                    retry.add(res.diff_id)
+                    failed.add(res.diff_id)
+        return ()
+
+    stopping = threading.Event()
+
+    def stop(signum: int, frame: FrameType | None) -> None:
+        pywikibot.info(f"{signal.Signals(signum).name}, finishing diffs")
+        stopping.set()
+
+    pywikibot.debug(
+        f"{fetch_concurrency} fetch threads, Pool({poolsize}),"
+        f" {tca_concurrency} submit threads for {len(diffs)} diffs"
+    )
+    # one more thread feeds the pool and collects its results
+    threads = fetch_concurrency + tca_concurrency + 1
+    with (
+        multiprocessing.Pool(poolsize, _init_worker, (profiles,)) as pool,
+        ThreadPoolExecutor(threads) as executor,
+    ):
+        futures = pipeline.thread_stage(
+            executor,
+            functools.partial(_fetch_batch, diff_mode=diff_mode),
+            batches,
+            fetched,
+            fallback=_unfetched_batch,
+        )
+        submitting = pipeline.thread_stage(executor, finish, checked, None)
+        futures += submitting
+        futures.append(
+            executor.submit(
+                pipeline.process_stage,
+                pool,
+                functools.partial(
+                    _check_diff,
+                    diff_mode=diff_mode,
+                    budget=budget,
+                ),
+                fetched,
+                checked,
+            )
+        )
+        previous = {}
+        try:
+            enqueue(diffs)
+            if daemon:
+                for signum in (signal.SIGTERM, signal.SIGINT):
+                    previous[signum] = signal.signal(signum, stop)
+            interval = POLL_INTERVAL
+            renewed = time.monotonic()
+            while not stopping.wait(interval):
+                with lock:
+                    skip = set(in_flight)
+                    released = failed - skip
+                    failed.difference_update(released)
+                # without polling, stop once the diffs in flight are done
+                if not daemon and (
+                    not skip or all(f.done() for f in submitting)
+                ):
+                    break
+                writer.flush(force=False)
                 try:
-                    api.upload_submission(diff.submission_id, text)
-                except Exception:  # pragma: no cover
-                    pywikibot.exception()
+                    # keep the diffs in flight claimed until they finish
+                    if time.monotonic() - renewed > lease.total_seconds() / 2:
+                        with sessionmaker.begin() as session:
+                            database.renew_leases(
+                                session,
+                                worker_id,
+                                skip,
+                                lease=lease,
+                            )
+                        renewed = time.monotonic()
+                    if released:
+                        with sessionmaker.begin() as session:
+                            database.release_leases(
+                                session,
+                                worker_id,
+                                released,
+                            )
+                    # with a limit, wait for diffs in flight to finish first
+                    full = limit is not None and len(skip) >= limit
+                    if not daemon or full:
+                        interval = POLL_INTERVAL
+                        continue
+                    new = enqueue(
+                        _poll_diffs(
+                            sessionmaker,
+                            worker_id,
+                            lease=lease,
+                            limit=None if limit is None else limit - len(skip),
+                            skip=skip,
+                        )
+                    )
+                except OperationalError:  # pragma: no cover
+                    pywikibot.exception(exc_info=False)
+                    new = 0
+                # poll again soon while diffs keep coming, back off when not
+                if new:
+                    interval = POLL_INTERVAL
                 else:
-                    diff.status = database.Status.UPLOADED
-                    try:
-                        session.commit()
-                    except StaleDataError:  # pragma: no cover
-                        pywikibot.exception(exc_info=False)
+                    interval = min(2 * interval, poll_interval)
+        finally:
+            batches.close()
+            for signum, handler in previous.items():
+                signal.signal(signum, handler)
+    if writer.flush():
+        # diffs that failed can be claimed again by any checker right away
+        with sessionmaker.begin() as session:
+            database.release_leases(session, worker_id)
+    else:  # pragma: no cover
+        # other checkers would redo diffs whose results were not written,
+        # so their leases are left to run out
+        writer.log_pending()
+    for future in futures:
+        future.result()
+    for stats in stages.values():
+        pywikibot.info(stats.summary())
+    checked_count = outcomes["checked"] + outcomes["approximate"]
+    if checked_count:
+        rate = outcomes["approximate"] / checked_count
+        pywikibot.info(
+            f"approximate diffs: {outcomes['approximate']}"
+            f" of {checked_count} checked ({rate:.1%})"
+        )
 
 
 def generate_reports(*, delta: datetime.timedelta | None = None) -> None:
@@ -150,7 +703,7 @@ def check_reports(*, delta: datetime.timedelta | None = None) -> None:
 def post_ready_counts() -> None:
     sessionmaker = database.create_sessionmaker()
     for domain in meta_config().domains:
-        site = pywikibot.Site(url=f"https://{domain}/wiki/DUMMY")
+        site = wiki.site_from_domain(domain)
         with sessionmaker.begin() as session:
             diff_count = database.diff_count(
                 session,
@@ -172,15 +725,20 @@ def post_ready_counts() -> None:
                 pywikibot.exception()
 
 
-def update_ready_diffs(*, delta: datetime.timedelta | None = None) -> None:
+def update_ready_diffs(
+    *,
+    delta: datetime.timedelta | None = None,
+    batch_size: int = 100,
+) -> None:
     with database.create_sessionmaker()() as session:
-        for diff in database.diffs_by_status(
+        diffs = database.diffs_by_status(
             session,
             database.Diff,
             database.Status.READY,
             delta=delta,
             op=operator.ge,
-        ):
+        )
+        for count, diff in enumerate(diffs, start=1):
             try:
                 res = diff.update_page()
             except pywikibot.exceptions.Error:  # pragma: no cover
@@ -189,7 +747,9 @@ def update_ready_diffs(*, delta: datetime.timedelta | None = None) -> None:
                 if res is None:
                     diff.status = database.Status.FIXED
                     diff.status_user_text = diff.site.username()
+            if count % batch_size == 0:
                 session.commit()
+        session.commit()
 
 
 def parse_script_args(*args: str) -> argparse.Namespace:
@@ -217,6 +777,56 @@ def parse_script_args(*args: str) -> argparse.Namespace:
         help="maximum number to store",
         metavar="N",
     )
+    store_subparser.add_argument(
+        "--batch-size",
+        default=1,
+        type=int,
+        help="number of changes to store at once (default: %(default)s)",
+        metavar="N",
+    )
+    store_subparser.add_argument(
+        "--batch-interval",
+        type=float,
+        help=(
+            "store buffered changes after this many seconds, checked on"
+            " every event from the stream, including filtered ones"
+        ),
+        metavar="SECONDS",
+    )
+    store_subparser.add_argument(
+        "--replay",
+        help="read changes recorded by record-changes instead of the stream",
+        metavar="PATH",
+    )
+    store_subparser.add_argument(
+        "--realtime",
+        action="store_true",
+        help="replay changes at their recorded speed",
+    )
+    description = "record raw stream changes to a file"
+    record_subparser = subparsers.add_parser(
+        "record-changes",
+        description=description,
+        help=description,
+        allow_abbrev=False,
+    )
+    record_subparser.add_argument(
+        "path",
+        help="gzip-compressed JSON lines file to append to",
+        metavar="PATH",
+    )
+    record_subparser.add_argument(
+        "--since",
+        type=datetime.datetime.fromisoformat,
+        help="since the timestamp",
+        metavar="YYYY-MM-DD HH:MM:SS",
+    )
+    record_subparser.add_argument(
+        "--total",
+        type=int,
+        help="maximum number to record",
+        metavar="N",
+    )
     description = "check stored changes"
     check_subparser = subparsers.add_parser(
         "check-changes",
@@ -237,6 +847,90 @@ def parse_script_args(*args: str) -> argparse.Namespace:
         help="maximum number to check",
         metavar="N",
     )
+    check_subparser.add_argument(
+        "--diff-mode",
+        choices=DIFF_MODES,
+        default="full",
+        help=(
+            "diff full revision texts locally, or use the changed blocks"
+            " from action=compare (default: %(default)s)"
+        ),
+    )
+    check_subparser.add_argument(
+        "--diff-budget",
+        default=DEFAULT_BUDGET.seconds,
+        type=float,
+        help=(
+            "CPU seconds for diffing one revision before falling back to"
+            " an approximate diff (default: %(default)s)"
+        ),
+        metavar="SECONDS",
+    )
+    check_subparser.add_argument(
+        "--diff-max-size",
+        default=DEFAULT_BUDGET.max_size,
+        type=int,
+        help=(
+            "combined size of cleaned texts above which revisions get an"
+            " approximate diff (default: %(default)s)"
+        ),
+        metavar="CHARS",
+    )
+    check_subparser.add_argument(
+        "--daemon",
+        action="store_true",
+        help=(
+            "keep running and poll the queue for new diffs until"
+            " SIGTERM or SIGINT"
+        ),
+    )
+    check_subparser.add_argument(
+        "--poll-interval",
+        default=30.0,
+        type=float,
+        help=(
+            "longest wait between polls of the queue with --daemon"
+            " (default: %(default)s)"
+        ),
+        metavar="SECONDS",
+    )
+    check_subparser.add_argument(
+        "--worker-id",
+        help=(
+            "name claiming diffs in the queue, unique among checkers"
+            " (default: HOSTNAME:PID)"
+        ),
+    )
+    check_subparser.add_argument(
+        "--lease",
+        default=DEFAULT_LEASE.total_seconds(),
+        type=float,
+        help=(
+            "seconds before claimed diffs that are not finished can be"
+            " claimed by other checkers (default: %(default)s)"
+        ),
+        metavar="SECONDS",
+    )
+    check_subparser.add_argument(
+        "--fetch-concurrency",
+        default=2,
+        type=int,
+        help=(
+            "number of threads fetching revisions from the wikis"
+            " (default: %(default)s)"
+        ),
+        metavar="N",
+    )
+    check_subparser.add_argument(
+        "--tca-concurrency",
+        default=4,
+        type=int,
+        help=(
+            "number of submissions sent to Turnitin at once"
+            " (default: %(default)s)"
+        ),
+        metavar="N",
+    )
     description = "check and generate reports"
     subparsers.add_parser(
         "reports",
@@ -258,6 +952,24 @@ def parse_script_args(*args: str) -> argparse.Namespace:
         help=description,
         allow_abbrev=False,
     )
+    description = "write a snapshot of site metadata for offline use"
+    metadata_subparser = subparsers.add_parser(
+        "site-metadata",
+        description=description,
+        help=description,
+        allow_abbrev=False,
+    )
+    metadata_subparser.add_argument(
+        "--path",
+        help="snapshot file (default: CPB_SITE_METADATA_PATH)",
+    )
+    description = "add tables, columns and indexes missing from the database"
+    subparsers.add_parser(
+        "migrate",
+        description=description,
+        help=description,
+        allow_abbrev=False,
+    )
     description = "setup database and (optionally) webhook"
     setup_subparser = subparsers.add_parser("setup", allow_abbrev=False)
     setup_subparser.add_argument(
@@ -271,10 +983,39 @@ def parse_script_args(*args: str) -> argparse.Namespace:
 def cli(*args: str) -> int:
     local_args = pywikibot.handle_args(args, do_help=False)
     parsed_args = parse_script_args(*local_args)
+    if parsed_args.action != "site-metadata":
+        site_metadata.load()
     if parsed_args.action == "store-changes":
-        store_changes(since=parsed_args.since, total=parsed_args.total)
+        store_changes(
+            since=parsed_args.since,
+            total=parsed_args.total,
+            batch_size=parsed_args.batch_size,
+            batch_interval=parsed_args.batch_interval,
+            replay=parsed_args.replay,
+            realtime=parsed_args.realtime,
+        )
+    elif parsed_args.action == "record-changes":
+        record_changes(
+            parsed_args.path,
+            since=parsed_args.since,
+            total=parsed_args.total,
+        )
     elif parsed_args.action == "check-changes":
-        check_changes(limit=parsed_args.limit, poolsize=parsed_args.poolsize)
+        check_changes(
+            limit=parsed_args.limit,
+            poolsize=parsed_args.poolsize,
+            diff_mode=parsed_args.diff_mode,
+            budget=DiffBudget(
+                seconds=parsed_args.diff_budget,
+                max_size=parsed_args.diff_max_size,
+            ),
+            fetch_concurrency=parsed_args.fetch_concurrency,
+            tca_concurrency=parsed_args.tca_concurrency,
+            daemon=parsed_args.daemon,
+            poll_interval=parsed_args.poll_interval,
+            worker_id=parsed_args.worker_id,
+            lease=datetime.timedelta(seconds=parsed_args.lease),
+        )
     elif parsed_args.action == "counts":
         post_ready_counts()
     elif parsed_args.action == "reports":
@@ -289,10 +1030,20 @@ def cli(*args: str) -> int:
             pywikibot.exception(exc_info=False)
     elif parsed_args.action == "update-ready-diffs":
         update_ready_diffs(delta=datetime.timedelta(weeks=-1))
-    elif parsed_args.action == "setup":
+    elif parsed_args.action == "site-metadata":
+        path = parsed_args.path or site_metadata_path()
+        if path is None:
+            pywikibot.error("no --path or CPB_SITE_METADATA_PATH")
+            return 1
+        sites = [wiki.site_from_domain(d) for d in meta_config().domains]
+        count = site_metadata.write(path, sites)
+        pywikibot.info(f"wrote metadata of {count} sites to {path}")
+    elif parsed_args.action in ("migrate", "setup"):
         database.create_tables()
-        if parsed_args.webhook:
+        if parsed_args.action == "setup" and parsed_args.webhook:
             api = tca.TurnitinCoreAPI()
             api.delete_webhooks()
             api.create_webhook()
+    for name, info in wiki.site_registry_info().items():
+        pywikibot.debug(f"{name}: {info}")
     return 0
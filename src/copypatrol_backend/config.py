@@ -24,6 +24,16 @@ class SiteConfig(NamedTuple):
     enabled: bool
     namespaces: list[int]
     pagetriage_namespaces: list[int]
+    min_size: int
+    min_size_delta: int | None
+    ignore_tags: list[frozenset[str]]
+    ignore_reverts: bool
+    copied_coverage: float
+
+
+class TextCacheConfig(NamedTuple):
+    path: str | None
+    max_bytes: int
 
 
 class TCAConfig(NamedTuple):
@@ -37,6 +47,11 @@ def config_parser() -> configparser.ConfigParser:
     return configparser.ConfigParser(
         converters={
             "listint": lambda x: [int(i) for i in x.split(",")],
+            "listtags": lambda x: [
+                frozenset(tag.strip() for tag in tags.split("+"))
+                for tags in x.split(",")
+                if tags.strip()
+            ],
         },
         default_section="copypatrol",
         interpolation=None,
@@ -76,6 +91,14 @@ def site_config(domain: str) -> SiteConfig:
         enabled=section.getboolean("enabled", False),
         namespaces=section.getlistint("namespaces", [0]),
         pagetriage_namespaces=pt_ns,
+        min_size=section.getint("min-size", 500),
+        min_size_delta=section.getint("min-size-delta", None),
+        ignore_tags=section.getlisttags(
+            "ignore-tags",
+            [frozenset({"mw-rollback"}), frozenset({"mw-undo", "twinkle"})],
+        ),
+        ignore_reverts=section.getboolean("ignore-reverts", False),
+        copied_coverage=section.getfloat("copied-coverage", 0.5),
     )
 
 
@@ -93,6 +116,19 @@ def tca_config() -> TCAConfig:
     )
 
 
+@functools.cache
+def text_cache_config() -> TextCacheConfig:
+    return TextCacheConfig(
+        path=os.environ.get("CPB_TEXT_CACHE_PATH") or None,
+        max_bytes=int(os.environ.get("CPB_TEXT_CACHE_MAX_MB", 512)) << 20,
+    )
+
+
+@functools.cache
+def site_metadata_path() -> str | None:
+    return os.environ.get("CPB_SITE_METADATA_PATH") or None
+
+
 @cachetools.func.ttl_cache(maxsize=1, ttl=3600)
 def url_ignore_list() -> list[re.Pattern[str]]:
     result: list[re.Pattern[str]] = []
@@ -1,8 +1,11 @@
 from __future__ import annotations
 
 import datetime
+import json
 import operator
 import os
+import threading
+import time
 from enum import IntEnum
 from typing import TYPE_CHECKING, Any, Self, TypeVar, Union
 from uuid import UUID
@@ -22,9 +25,17 @@ from sqlalchemy import (
     LargeBinary,
     TypeDecorator,
     create_engine,
+    delete,
     func,
+    insert,
+    inspect,
+    or_,
     select,
+    text,
+    tuple_,
+    update,
 )
+from sqlalchemy.exc import OperationalError
 from sqlalchemy.orm import (
     DeclarativeBase,
     Mapped,
@@ -33,11 +44,12 @@ from sqlalchemy.orm import (
     relationship,
     sessionmaker,
 )
+from sqlalchemy.schema import CreateColumn
 
 from copypatrol_backend import wiki
 
 if TYPE_CHECKING:
-    from collections.abc import Callable, Sequence
+    from collections.abc import Callable, Collection, Sequence
 
     from pywikibot.site import APISite
     from sqlalchemy.engine import Engine
@@ -110,6 +122,31 @@ class LargeBinaryDecorator(BinaryDecoratorBase):
     impl = LargeBinary
 
 
+class JSONListDecorator(TypeDecorator[list[str]]):
+    cache_ok = True
+    impl = LargeBinary
+
+    def process_bind_param(
+        self,
+        value: list[str] | None,
+        dialect: Dialect,
+    ) -> bytes | None:
+        if value is None:
+            return None
+        return json.dumps(value).encode()
+
+    def process_result_value(
+        self,
+        value: bytes | None,
+        dialect: Dialect,
+    ) -> list[str] | None:
+        if value is None:
+            return None
+        result = json.loads(value.decode())
+        assert isinstance(result, list)
+        return result
+
+
 class StatusDecorator(TypeDecorator[Status]):
     cache_ok = True
     impl = TinyInt
@@ -168,8 +205,9 @@ class TimestampDecorator(TypeDecorator[Timestamp]):
         self,
         value: Timestamp | None,
         dialect: Dialect,
-    ) -> bytes:
-        assert value is not None
+    ) -> bytes | None:
+        if value is None:
+            return None
         ret = value.totimestampformat().encode()
         assert isinstance(ret, bytes)
         return ret
@@ -178,8 +216,9 @@ class TimestampDecorator(TypeDecorator[Timestamp]):
         self,
         value: bytes | None,
         dialect: Dialect,
-    ) -> Timestamp:
-        assert value is not None
+    ) -> Timestamp | None:
+        if value is None:
+            return None
         return Timestamp.set_timestamp(value.decode())
 
 
@@ -214,15 +253,22 @@ class DiffMixin(MappedAsDataclass):
 
     @property
     def page(self) -> pywikibot.Page:
-        namespace = self.site.namespaces[self.page_namespace]
-        return pywikibot.Page(
-            self.site,
-            f"{namespace.canonical_name}:{self.page_title}",
-        )
+        site = self.site
+        key = (site, self.page_namespace, self.page_title)
+        cached = self.__dict__.get("_page_cache")
+        if cached is None or cached[0] != key:
+            page = wiki.page_from_title(
+                site,
+                self.page_namespace,
+                self.page_title,
+            )
+            cached = self.__dict__["_page_cache"] = (key, page)
+        assert isinstance(cached[1], pywikibot.Page)
+        return cached[1]
 
     @property
     def site(self) -> APISite:
-        return pywikibot.Site(self.lang, self.project)
+        return wiki.site_from_code(self.lang, self.project)
 
     def update_page(self) -> int | None:
         revs = wiki.load_revisions(self.site, [self.rev_id])
@@ -255,6 +301,81 @@ class QueuedDiff(TableBase, DiffMixin, kw_only=True):
         index=True,
         unique=True,
     )
+    # revision metadata from the stream, if available
+    rev_size: Mapped[int | None] = mapped_column(
+        UnsignedInteger,
+        default=None,
+    )
+    rev_parent_size: Mapped[int | None] = mapped_column(
+        UnsignedInteger,
+        default=None,
+    )
+    rev_sha1: Mapped[str | None] = mapped_column(
+        VarBinaryDecorator(40),
+        default=None,
+    )
+    rev_parent_sha1: Mapped[str | None] = mapped_column(
+        VarBinaryDecorator(40),
+        default=None,
+    )
+    rev_tags: Mapped[list[str] | None] = mapped_column(
+        JSONListDecorator,
+        default=None,
+    )
+    rev_comment: Mapped[str | None] = mapped_column(
+        LargeBinaryDecorator,
+        default=None,
+    )
+    rev_comment_hidden: Mapped[bool | None] = mapped_column(default=None)
+    rev_text_hidden: Mapped[bool | None] = mapped_column(default=None)
+    # the checker that claimed the diff, until the lease expires
+    lease_owner: Mapped[str | None] = mapped_column(
+        VarBinaryDecorator(64),
+        default=None,
+    )
+    lease_expiry: Mapped[Timestamp | None] = mapped_column(
+        TimestampDecorator(14),
+        default=None,
+        index=True,
+    )
+
+    @classmethod
+    def from_page(
+        cls,
+        page: pywikibot.Page,
+        /,
+        *,
+        rev_id: int,
+        rev_parent_id: int,
+        rev_timestamp: str,
+        rev_user_text: str,
+        rev_size: int | None = None,
+        rev_parent_size: int | None = None,
+        rev_sha1: str | None = None,
+        rev_parent_sha1: str | None = None,
+        rev_tags: list[str] | None = None,
+        rev_comment: str | None = None,
+        rev_comment_hidden: bool | None = None,
+        rev_text_hidden: bool | None = None,
+    ) -> Self:
+        return cls(
+            project=page.site.family.name,
+            lang=page.site.code,
+            page_namespace=page.namespace().id,
+            page_title=page.title(underscore=True, with_ns=False),
+            rev_id=rev_id,
+            rev_parent_id=rev_parent_id,
+            rev_timestamp=Timestamp.set_timestamp(rev_timestamp),
+            rev_user_text=rev_user_text,
+            rev_size=rev_size,
+            rev_parent_size=rev_parent_size,
+            rev_sha1=rev_sha1,
+            rev_parent_sha1=rev_parent_sha1,
+            rev_tags=rev_tags,
+            rev_comment=rev_comment,
+            rev_comment_hidden=rev_comment_hidden,
+            rev_text_hidden=rev_text_hidden,
+        )
 
 
 class Diff(TableBase, DiffMixin, kw_only=True):
@@ -331,6 +452,17 @@ class Source(TableBase, kw_only=True):
     percent: Mapped[float] = mapped_column(UnsignedFloat)
 
 
+class StreamCheckpoint(TableBase, kw_only=True):
+    __tablename__ = "stream_checkpoints"
+    __table_args__ = CREATE_TABLE_ARGS
+
+    stream: Mapped[str] = mapped_column(
+        VarBinaryDecorator(255),
+        primary_key=True,
+    )
+    timestamp: Mapped[Timestamp] = mapped_column(TimestampDecorator(14))
+
+
 DiffT = TypeVar("DiffT", bound=DiffMixin)
 
 
@@ -350,19 +482,362 @@ def add_revision(
     )
     if session.scalars(diff_stmt).unique().one_or_none():
         return  # pragma: no cover
-    diff = QueuedDiff(
-        project=page.site.family.name,
-        lang=page.site.code,
-        page_namespace=page.namespace().id,
-        page_title=page.title(underscore=True, with_ns=False),
+    diff = QueuedDiff.from_page(
+        page,
         rev_id=rev_id,
         rev_parent_id=rev_parent_id,
-        rev_timestamp=Timestamp.set_timestamp(rev_timestamp),
+        rev_timestamp=rev_timestamp,
         rev_user_text=rev_user_text,
     )
     session.add(diff)
 
 
+def add_revisions(session: Session, diffs: Sequence[QueuedDiff], /) -> int:
+    if not diffs:
+        return 0
+    # one lookup for every revision already in diffs
+    key = tuple_(Diff.project, Diff.lang, Diff.rev_id)
+    diff_stmt = select(Diff.project, Diff.lang, Diff.rev_id).where(
+        key.in_({(d.project, d.lang, d.rev_id) for d in diffs})
+    )
+    existing = set(session.execute(diff_stmt).tuples())
+    columns = [
+        attr.key
+        for attr in inspect(QueuedDiff).column_attrs
+        if not any(column.primary_key for column in attr.columns)
+    ]
+    values = [
+        {column: getattr(diff, column) for column in columns}
+        for diff in diffs
+        if (diff.project, diff.lang, diff.rev_id) not in existing
+    ]
+    if not values:
+        return 0
+    # one insert, ignoring revisions already queued
+    insert_stmt = (
+        insert(QueuedDiff)
+        .values(values)
+        .prefix_with("IGNORE", dialect="mysql")
+        .prefix_with("IGNORE", dialect="mariadb")
+        .prefix_with("OR IGNORE", dialect="sqlite")
+    )
+    result = session.execute(insert_stmt)
+    return int(result.rowcount)  # type: ignore[attr-defined]
+
+
+def update_queued_diff(
+    session: Session,
+    diff_id: int,
+    /,
+    **values: Any,
+) -> bool:
+    stmt = (
+        update(QueuedDiff)
+        .where(QueuedDiff.diff_id == diff_id)
+        .values(**values)
+        .execution_options(synchronize_session=False)
+    )
+    result = session.execute(stmt)
+    return bool(result.rowcount)  # type: ignore[attr-defined]
+
+
+def delete_queued_diff(session: Session, diff_id: int, /) -> bool:
+    stmt = (
+        delete(QueuedDiff)
+        .where(QueuedDiff.diff_id == diff_id)
+        .execution_options(synchronize_session=False)
+    )
+    result = session.execute(stmt)
+    return bool(result.rowcount)  # type: ignore[attr-defined]
+
+
+class StatusWriter:
+    # collects status changes and deletions of queued diffs from any thread,
+    # and writes them with one statement per status once enough are pending
+    # or the oldest has waited long enough
+    def __init__(
+        self,
+        sessionmaker: Callable[[], Session],
+        /,
+        *,
+        size: int = 100,
+        interval: float = 5.0,
+    ) -> None:
+        self.sessionmaker = sessionmaker
+        self.size = size
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._deletes: set[int] = set()
+        self._updates: dict[Status, set[int]] = {}
+        self._created: dict[int, UUID] = {}
+        self._since = 0.0
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._pending()
+
+    def _pending(self) -> int:
+        return (
+            len(self._deletes)
+            + len(self._created)
+            + sum(map(len, self._updates.values()))
+        )
+
+    def _add(self, diff_id: int, status: Status | None, /) -> None:
+        with self._lock:
+            if not self._pending():
+                self._since = time.monotonic()
+            for diff_ids in self._updates.values():
+                diff_ids.discard(diff_id)
+            if status is None:
+                self._deletes.add(diff_id)
+            else:
+                self._updates.setdefault(status, set()).add(diff_id)
+        self.flush(force=False)
+
+    def delete(self, diff_id: int, /) -> None:
+        self._add(diff_id, None)
+
+    def update(self, diff_id: int, status: Status, /) -> None:
+        self._add(diff_id, status)
+
+    def created(self, diff_id: int, submission_id: UUID, /) -> bool:
+        # a submission id from Turnitin is written right away, and only
+        # waits for the next flush when the database can't be reached
+        try:
+            with self.sessionmaker() as session:
+                found = update_queued_diff(
+                    session,
+                    diff_id,
+                    status=Status.CREATED,
+                    submission_id=submission_id,
+                )
+                session.commit()
+        except OperationalError:
+            pywikibot.exception(exc_info=False)
+            pywikibot.warning(
+                f"submission {submission_id} of diff {diff_id}"
+                " kept for the next flush"
+            )
+            with self._lock:
+                if not self._pending():
+                    self._since = time.monotonic()
+                self._created[diff_id] = submission_id
+            return True
+        return found
+
+    def flush(self, *, force: bool = True) -> bool:
+        with self._lock:
+            pending = self._pending()
+            due = (
+                pending >= self.size
+                or time.monotonic() - self._since >= self.interval
+            )
+            if not pending or not (force or due):
+                return True
+            found = 0
+            skipped: dict[int, Status] = {}
+            try:
+                with self.sessionmaker() as session:
+                    if self._deletes:
+                        found += session.execute(
+                            delete(QueuedDiff)
+                            .where(QueuedDiff.diff_id.in_(self._deletes))
+                            .execution_options(synchronize_session=False)
+                        ).rowcount  # type: ignore[attr-defined]
+                    for diff_id, submission_id in self._created.items():
+                        found += update_queued_diff(
+                            session,
+                            diff_id,
+                            status=Status.CREATED,
+                            submission_id=submission_id,
+                        )
+                    for status, diff_ids in self._updates.items():
+                        # a status never goes back, e.g. when the webhook
+                        # has seen a submission complete before the flush
+                        updated = session.execute(
+                            update(QueuedDiff)
+                            .where(
+                                QueuedDiff.diff_id.in_(diff_ids),
+                                QueuedDiff.status <= status,
+                            )
+                            .values(
+                                status=status,
+                                lease_owner=None,
+                                lease_expiry=None,
+                            )
+                            .execution_options(synchronize_session=False)
+                        ).rowcount  # type: ignore[attr-defined]
+                        found += updated
+                        if updated < len(diff_ids):
+                            stmt = select(
+                                QueuedDiff.diff_id, QueuedDiff.status
+                            ).where(
+                                QueuedDiff.diff_id.in_(diff_ids),
+                                QueuedDiff.status > status,
+                            )
+                            result = session.execute(stmt).tuples()
+                            skipped.update(result.all())
+                    session.commit()
+            except OperationalError:  # pragma: no cover
+                # keep everything pending for the next flush
+                pywikibot.exception(exc_info=False)
+                return False
+            self._deletes.clear()
+            self._created.clear()
+            self._updates.clear()
+        for diff_id, status in sorted(skipped.items()):
+            pywikibot.warning(f"diff {diff_id} is already {status.name}")
+        if found + len(skipped) < pending:
+            missing = pending - found - len(skipped)
+            pywikibot.warning(f"{missing} diffs no longer queued")
+        return True
+
+    def log_pending(self) -> None:
+        with self._lock:
+            for diff_id in sorted(self._deletes):
+                pywikibot.error(f"diff {diff_id} was not deleted")
+            for diff_id, submission_id in sorted(self._created.items()):
+                pywikibot.error(
+                    f"submission {submission_id} of diff {diff_id}"
+                    " was not saved"
+                )
+            for status, diff_ids in self._updates.items():
+                for diff_id in sorted(diff_ids):
+                    pywikibot.error(
+                        f"diff {diff_id} was not set to {status.name}"
+                    )
+
+
+def _skip_locked(session: Session, /) -> bool:
+    dialect = session.get_bind().dialect
+    if dialect.name not in {"mysql", "mariadb"}:
+        return False
+    version = dialect.server_version_info or ()
+    if getattr(dialect, "is_mariadb", False):
+        return version >= (10, 6)
+    return version >= (8, 0, 1)
+
+
+def _claimable(now: Timestamp, /) -> ColumnElement[bool]:
+    return QueuedDiff.status.in_([Status.UNSUBMITTED, Status.CREATED]) & or_(
+        QueuedDiff.lease_expiry.is_(None), QueuedDiff.lease_expiry < now
+    )
+
+
+def claim_queued_diffs(
+    session: Session,
+    owner: str,
+    /,
+    *,
+    lease: datetime.timedelta,
+    limit: int | None = None,
+) -> Sequence[QueuedDiff]:
+    now = Timestamp.utcnow()
+    stmt = (
+        select(QueuedDiff.diff_id)
+        .where(_claimable(now))
+        .order_by(QueuedDiff.rev_timestamp.desc())
+        .limit(limit)
+    )
+    if _skip_locked(session):
+        # other checkers skip the rows being claimed instead of waiting
+        stmt = stmt.with_for_update(skip_locked=True)
+    diff_ids = session.scalars(stmt).all()
+    if not diff_ids:
+        return []
+    # elsewhere, the condition makes only one of concurrent claims win
+    session.execute(
+        update(QueuedDiff)
+        .where(QueuedDiff.diff_id.in_(diff_ids), _claimable(now))
+        .values(
+            lease_owner=owner,
+            lease_expiry=now + lease,
+            status_timestamp=QueuedDiff.status_timestamp,
+        )
+        .execution_options(synchronize_session=False)
+    )
+    claimed = (
+        select(QueuedDiff)
+        .where(
+            QueuedDiff.diff_id.in_(diff_ids),
+            QueuedDiff.lease_owner == owner,
+        )
+        .order_by(QueuedDiff.rev_timestamp.desc())
+        .execution_options(populate_existing=True)
+    )
+    return session.scalars(claimed).all()
+
+
+def renew_leases(
+    session: Session,
+    owner: str,
+    diff_ids: Collection[int],
+    /,
+    *,
+    lease: datetime.timedelta,
+) -> int:
+    if not diff_ids:
+        return 0
+    stmt = (
+        update(QueuedDiff)
+        .where(
+            QueuedDiff.diff_id.in_(diff_ids),
+            QueuedDiff.lease_owner == owner,
+        )
+        .values(
+            lease_expiry=Timestamp.utcnow() + lease,
+            status_timestamp=QueuedDiff.status_timestamp,
+        )
+        .execution_options(synchronize_session=False)
+    )
+    result = session.execute(stmt)
+    return int(result.rowcount)  # type: ignore[attr-defined]
+
+
+def release_leases(
+    session: Session,
+    owner: str,
+    diff_ids: Collection[int] | None = None,
+    /,
+) -> int:
+    stmt = (
+        update(QueuedDiff)
+        .where(
+            QueuedDiff.lease_owner == owner,
+            QueuedDiff.status.in_([Status.UNSUBMITTED, Status.CREATED]),
+        )
+        .values(
+            lease_owner=None,
+            lease_expiry=None,
+            status_timestamp=QueuedDiff.status_timestamp,
+        )
+        .execution_options(synchronize_session=False)
+    )
+    if diff_ids is not None:
+        if not diff_ids:
+            return 0
+        stmt = stmt.where(QueuedDiff.diff_id.in_(diff_ids))
+    result = session.execute(stmt)
+    return int(result.rowcount)  # type: ignore[attr-defined]
+
+
+def stream_checkpoint(session: Session, stream: str, /) -> Timestamp | None:
+    stmt = select(StreamCheckpoint.timestamp).where(
+        StreamCheckpoint.stream == stream
+    )
+    return session.scalar(stmt)
+
+
+def save_stream_checkpoint(
+    session: Session,
+    stream: str,
+    timestamp: Timestamp,
+    /,
+) -> None:
+    session.merge(StreamCheckpoint(stream=stream, timestamp=timestamp))
+
+
 def _create_engine(echo: bool = False) -> Engine:
     charset = os.environ.get("CPB_DB_DEFAULT_CHARACTER_SET")
     url = URL.create(
@@ -382,7 +857,39 @@ def create_sessionmaker() -> sessionmaker[Session]:
 
 
 def create_tables() -> None:
-    TableBase.metadata.create_all(_create_engine(echo=True), checkfirst=True)
+    engine = _create_engine(echo=True)
+    TableBase.metadata.create_all(engine, checkfirst=True)
+    upgrade_tables(engine)
+
+
+def upgrade_tables(engine: Engine, /) -> int:
+    # create_all leaves existing tables alone, so columns and indexes added
+    # to them since are added here
+    inspector = inspect(engine)
+    preparer = engine.dialect.identifier_preparer
+    added = 0
+    with engine.begin() as conn:
+        for table in TableBase.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            columns = {c["name"] for c in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in columns:
+                    continue
+                spec = CreateColumn(column).compile(dialect=engine.dialect)
+                conn.execute(
+                    text(
+                        f"ALTER TABLE {preparer.format_table(table)}"
+                        f" ADD COLUMN {spec}"
+                    )
+                )
+                added += 1
+            indexes = {i["name"] for i in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name not in indexes:
+                    index.create(conn)
+                    added += 1
+    return added
 
 
 def diffs_by_status(
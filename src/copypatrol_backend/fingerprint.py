@@ -0,0 +1,61 @@
+from __future__ import annotations
+
+import re
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from collections.abc import Set
+
+WORD_REGEX = re.compile(r"\w+")
+# a shared run of at least K + WINDOW - 1 words always shares a fingerprint,
+# and with K >= WINDOW the fingerprints of a copied run cover all of it but
+# at most WINDOW - 1 words at either end
+K = 5
+WINDOW = 4
+
+
+def words(text: str, /) -> list[str]:
+    return WORD_REGEX.findall(text.lower())
+
+
+def kgram_hashes(words: list[str], /, *, k: int = K) -> list[int]:
+    return [hash(kgram) for kgram in zip(*(words[i:] for i in range(k)))]
+
+
+def winnow(hashes: list[int], /, *, window: int = WINDOW) -> dict[int, int]:
+    # the rightmost smallest hash of every window, by position
+    selected = {}
+    for start in range(max(1, len(hashes) - window + 1)):
+        end = start + window
+        chunk = hashes[start:end]
+        if not chunk:
+            break
+        smallest = min(chunk)
+        pos = start + len(chunk) - 1 - chunk[::-1].index(smallest)
+        selected[pos] = smallest
+    return selected
+
+
+def fingerprints(
+    text: str,
+    /,
+    *,
+    k: int = K,
+    window: int = WINDOW,
+) -> frozenset[int]:
+    hashes = kgram_hashes(words(text), k=k)
+    return frozenset(winnow(hashes, window=window).values())
+
+
+def coverage(text: str, reference: Set[int], /, *, k: int = K) -> float:
+    # fraction of the words of text in k-grams fingerprinted in reference;
+    # every k-gram of text is looked up, so only the reference is winnowed
+    text_words = words(text)
+    if len(text_words) < k or not reference:
+        return 0.0
+    covered = bytearray(len(text_words))
+    for pos, value in enumerate(kgram_hashes(text_words, k=k)):
+        if value in reference:
+            end = pos + k
+            covered[pos:end] = b"\x01" * k
+    return covered.count(1) / len(text_words)
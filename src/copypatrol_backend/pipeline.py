@@ -0,0 +1,165 @@
+from __future__ import annotations
+
+import functools
+import queue
+import threading
+import time
+from typing import TYPE_CHECKING, Any, Generic, TypeVar
+
+import pywikibot
+
+if TYPE_CHECKING:
+    from collections.abc import Callable, Iterable, Iterator
+    from concurrent.futures import Executor, Future
+    from multiprocessing.pool import Pool
+
+T = TypeVar("T")
+U = TypeVar("U")
+_DONE = object()
+
+
+class StageStats:
+    __slots__ = (
+        "_lock",
+        "busy",
+        "depth_max",
+        "depth_total",
+        "items",
+        "name",
+        "samples",
+        "started",
+        "workers",
+    )
+
+    def __init__(self, name: str, /, *, workers: int) -> None:
+        self._lock = threading.Lock()
+        self.name = name
+        self.workers = workers
+        self.items = 0
+        self.busy = 0.0
+        self.samples = 0
+        self.depth_total = 0
+        self.depth_max = 0
+        self.started = time.monotonic()
+
+    def add(self, seconds: float, /, *, items: int = 1) -> None:
+        with self._lock:
+            self.items += items
+            self.busy += seconds
+
+    def sample(self, depth: int, /) -> None:
+        with self._lock:
+            self.samples += 1
+            self.depth_total += depth
+            self.depth_max = max(self.depth_max, depth)
+
+    def summary(self) -> str:
+        elapsed = max(time.monotonic() - self.started, 1e-9)
+        depth = self.depth_total / self.samples if self.samples else 0
+        return (
+            f"{self.name}: {self.items} in {elapsed:.1f}s"
+            f" ({self.items / elapsed:.1f}/s),"
+            f" {self.busy / (elapsed * self.workers):.0%} busy"
+            f" x{self.workers}, queue {depth:.1f} mean {self.depth_max} max"
+        )
+
+
+class Channel(Generic[T]):
+    # a bounded queue into a stage, which samples its depth on every put
+    def __init__(
+        self,
+        maxsize: int = 0,
+        /,
+        *,
+        stats: StageStats,
+        consumers: int = 1,
+    ) -> None:
+        self._queue: queue.Queue[Any] = queue.Queue(maxsize)
+        self.stats = stats
+        self.consumers = consumers
+
+    def put(self, item: T, /) -> None:
+        self._queue.put(item)
+        self.stats.sample(self._queue.qsize())
+
+    def close(self) -> None:
+        for _ in range(self.consumers):
+            self._queue.put(_DONE)
+
+    def __iter__(self) -> Iterator[T]:
+        while (item := self._queue.get()) is not _DONE:
+            yield item
+
+
+def thread_stage(
+    executor: Executor,
+    func: Callable[[T], Iterable[U]],
+    inbox: Channel[T],
+    outbox: Channel[U] | None,
+    /,
+    *,
+    fallback: Callable[[T], Iterable[U]] | None = None,
+) -> list[Future[None]]:
+    stats = inbox.stats
+    lock = threading.Lock()
+    running = stats.workers
+
+    def worker() -> None:
+        nonlocal running
+        try:
+            for item in inbox:
+                start = time.monotonic()
+                try:
+                    results = list(func(item))
+                except Exception:
+                    pywikibot.exception()
+                    # items are passed on rather than lost downstream
+                    results = [] if fallback is None else list(fallback(item))
+                # a stage feeding another one counts what it passes on
+                items = 1 if outbox is None else len(results)
+                stats.add(time.monotonic() - start, items=items)
+                if outbox is not None:
+                    for result in results:
+                        outbox.put(result)
+        finally:
+            with lock:
+                running -= 1
+                if not running and outbox is not None:
+                    outbox.close()
+
+    return [executor.submit(worker) for _ in range(stats.workers)]
+
+
+def _timed(func: Callable[[T], U], item: T, /) -> tuple[float, U]:
+    start = time.monotonic()
+    result = func(item)
+    return time.monotonic() - start, result
+
+
+def process_stage(
+    pool: Pool,
+    func: Callable[[T], U],
+    inbox: Channel[T],
+    outbox: Channel[U],
+    /,
+) -> None:
+    stats = inbox.stats
+    # the pool takes its input as fast as it can, so only a couple of items
+    # per worker leave the inbox before their results come back
+    slots = threading.Semaphore(2 * stats.workers)
+
+    def inputs() -> Iterator[T]:
+        for item in inbox:
+            slots.acquire()
+            yield item
+
+    try:
+        for seconds, result in pool.imap_unordered(
+            functools.partial(_timed, func),
+            inputs(),
+        ):
+            slots.release()
+            stats.add(seconds)
+            outbox.put(result)
+    finally:
+        outbox.close()
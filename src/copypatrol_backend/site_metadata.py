@@ -0,0 +1,111 @@
+from __future__ import annotations
+
+import json
+import os
+import tempfile
+from typing import TYPE_CHECKING, Any
+
+import pywikibot
+from pywikibot.site import APISite
+from pywikibot.time import Timestamp
+
+from copypatrol_backend import config
+
+if TYPE_CHECKING:
+    from collections.abc import Iterable
+
+# siteinfo used to clean text and build pages: namespaces and their aliases,
+# file extensions, and interwiki prefixes for links in edit summaries
+PROPS = (
+    "general",
+    "namespaces",
+    "namespacealiases",
+    "fileextensions",
+    "interwikimap",
+)
+
+# snapshot entries by sitename, applied when a site is first built
+_pending: dict[str, tuple[dict[str, Any], Timestamp]] = {}
+
+
+def snapshot(sites: Iterable[APISite], /) -> dict[str, Any]:
+    data = {}
+    for site in sites:
+        # file extensions also come from the shared image repository
+        for metadata_site in (site, site.image_repository()):
+            if not isinstance(metadata_site, APISite):
+                continue
+            if metadata_site.sitename in data:
+                continue
+            data[metadata_site.sitename] = {
+                prop: metadata_site.siteinfo.get(prop, expiry=True)
+                for prop in PROPS
+            }
+    return {"timestamp": Timestamp.nowutc().isoformat(), "sites": data}
+
+
+def write(path: str, sites: Iterable[APISite], /) -> int:
+    data = snapshot(sites)
+    # replace the file in one step so loading never sees a partial write
+    fd, temp_path = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(path)),
+        prefix=".site-metadata-",
+    )
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(data, f)
+        os.replace(temp_path, path)
+    except BaseException:  # pragma: no cover
+        os.unlink(temp_path)
+        raise
+    return len(data["sites"])
+
+
+def load(path: str | None = None, /) -> int:
+    if path is None:
+        path = config.site_metadata_path()
+        if path is None:
+            return 0
+    try:
+        with open(path) as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        pywikibot.exception(exc_info=False)
+        pywikibot.warning(f"site metadata not loaded from {path}")
+        return 0
+    timestamp = Timestamp.fromisoformat(data["timestamp"])
+    _pending.update(
+        (sitename, (props, timestamp))
+        for sitename, props in data["sites"].items()
+    )
+    pywikibot.debug(f"loaded site metadata from {timestamp.isoformat()}")
+    return len(data["sites"])
+
+
+def _seed_siteinfo(
+    site: APISite,
+    props: dict[str, Any],
+    timestamp: Timestamp,
+    /,
+) -> bool:
+    # Siteinfo has no public way to add values; this relies on the private
+    # _cache dict of prop -> (value, timestamp) used by pywikibot 11
+    cache = getattr(site.siteinfo, "_cache", None)
+    if not isinstance(cache, dict):  # pragma: no cover
+        pywikibot.warning(f"site metadata not supported for {site}")
+        return False
+    for prop, value in props.items():
+        # siteinfo already loaded in this process is at least as fresh
+        cache.setdefault(prop, (value, timestamp))
+    return True
+
+
+def apply(site: APISite, /) -> None:
+    if (entry := _pending.pop(site.sitename, None)) is not None:
+        _seed_siteinfo(site, *entry)
+    if not _pending:
+        return
+    # file extensions also come from the shared image repository
+    repo = site.image_repository()
+    if isinstance(repo, APISite) and repo.sitename in _pending:
+        _seed_siteinfo(repo, *_pending.pop(repo.sitename))
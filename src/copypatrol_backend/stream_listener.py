@@ -1,48 +1,311 @@
 from __future__ import annotations
 
-from typing import TYPE_CHECKING, Any
+import gzip
+import json
+import time
+from collections import Counter
+from typing import TYPE_CHECKING, Any, NamedTuple, Self
 
 from pywikibot.comms.eventstreams import EventStreams
+from pywikibot.time import Timestamp
 
 from copypatrol_backend import config
 
 if TYPE_CHECKING:
     import datetime
-    from collections.abc import Generator
+    from collections.abc import (
+        Callable,
+        Collection,
+        Generator,
+        Iterable,
+        Mapping,
+    )
 
 
-def stream_filter(data: dict[str, Any], /) -> bool:
-    if data["page_change_kind"] not in ("create", "edit"):
-        return False
-    if data["revision"]["rev_size"] < 500:
+STREAM = "mediawiki.page_change.v1"
+
+
+class Prescreen(NamedTuple):
+    min_size: int = 500
+    min_size_delta: int | None = None
+    ignore_tags: tuple[frozenset[str], ...] = (
+        frozenset({"mw-rollback"}),
+        frozenset({"mw-undo", "twinkle"}),
+    )
+    ignore_reverts: bool = False
+
+    @classmethod
+    def from_site_config(cls, site_config: config.SiteConfig, /) -> Self:
+        return cls(
+            min_size=site_config.min_size,
+            min_size_delta=site_config.min_size_delta,
+            ignore_tags=tuple(site_config.ignore_tags),
+            ignore_reverts=site_config.ignore_reverts,
+        )
+
+
+def _small_revision(data: dict[str, Any], prescreen: Prescreen, /) -> bool:
+    return bool(data["revision"]["rev_size"] < prescreen.min_size)
+
+
+def _small_size_delta(data: dict[str, Any], prescreen: Prescreen, /) -> bool:
+    if prescreen.min_size_delta is None:
         return False
     old_rev = data.get("prior_state", {}).get("revision", {})
-    if data["revision"]["rev_sha1"] == old_rev.get("rev_sha1"):
-        return False
-    domain = data["meta"]["domain"]
-    if domain not in config.meta_config().domains:
-        return False
-    namespaces = config.site_config(domain).namespaces
-    if data["page"]["namespace_id"] not in namespaces:
-        return False
-    if (
-        data["revision"]["editor"]["is_bot"]
-        or data["revision"]["editor"]["is_system"]
-        or data["revision"]["editor"]["user_text"] in config.user_ignore_list()
-    ):
+    delta = data["revision"]["rev_size"] - old_rev.get("rev_size", 0)
+    return bool(delta < prescreen.min_size_delta)
+
+
+def _hidden_content(data: dict[str, Any], prescreen: Prescreen, /) -> bool:
+    return data["revision"].get("is_content_visible") is False
+
+
+def _ignored_tags(data: dict[str, Any], prescreen: Prescreen, /) -> bool:
+    tags = data["revision"].get("tags")
+    if not tags:
         return False
-    return True
+    return any(ignored <= set(tags) for ignored in prescreen.ignore_tags)
+
+
+def _revert(data: dict[str, Any], prescreen: Prescreen, /) -> bool:
+    return prescreen.ignore_reverts and bool(
+        data["revision"].get("rev_is_revert")
+    )
+
+
+PRESCREEN_RULES: dict[str, Callable[[dict[str, Any], Prescreen], bool]] = {
+    "small-revision": _small_revision,
+    "small-size-delta": _small_size_delta,
+    "hidden-content": _hidden_content,
+    "ignored-tags": _ignored_tags,
+    "revert": _revert,
+}
+prescreen_rejections: Counter[str] = Counter()
+_DEFAULT_PRESCREEN = Prescreen()
+
+
+class StreamFilter:
+    __slots__ = ("expires", "ignored_users", "namespaces", "prescreens")
+
+    def __init__(
+        self,
+        *,
+        namespaces: Mapping[str, frozenset[int]],
+        ignored_users: frozenset[str],
+        prescreens: Mapping[str, Prescreen] | None = None,
+        ttl: float = 3600,
+    ) -> None:
+        self.namespaces = dict(namespaces)
+        self.ignored_users = ignored_users
+        self.prescreens = dict(prescreens or {})
+        self.expires = time.monotonic() + ttl
+
+    @classmethod
+    def from_config(
+        cls,
+        *,
+        ignored_users: Collection[str] | None = None,
+    ) -> Self:
+        if ignored_users is None:
+            ignored_users = config.user_ignore_list()
+        site_configs = [
+            config.site_config(domain)
+            for domain in config.meta_config().domains
+        ]
+        return cls(
+            namespaces={
+                site_config.domain: frozenset(site_config.namespaces)
+                for site_config in site_configs
+            },
+            ignored_users=frozenset(ignored_users),
+            prescreens={
+                site_config.domain: Prescreen.from_site_config(site_config)
+                for site_config in site_configs
+            },
+        )
+
+    def __call__(self, data: dict[str, Any], /) -> bool:
+        if data["page_change_kind"] not in ("create", "edit"):
+            return False
+        revision = data["revision"]
+        old_rev = data.get("prior_state", {}).get("revision", {})
+        if revision["rev_sha1"] == old_rev.get("rev_sha1"):
+            return False
+        domain = data["meta"]["domain"]
+        if data["page"]["namespace_id"] not in self.namespaces.get(domain, ()):
+            return False
+        editor = revision["editor"]
+        if (
+            editor["is_bot"]
+            or editor["is_system"]
+            or editor["user_text"] in self.ignored_users
+        ):
+            return False
+        prescreen = self.prescreens.get(domain) or _DEFAULT_PRESCREEN
+        for name, rule in PRESCREEN_RULES.items():
+            if rule(data, prescreen):
+                prescreen_rejections[name] += 1
+                return False
+        return True
+
+
+_stream_filter: StreamFilter | None = None
+
+
+def compiled_stream_filter() -> StreamFilter:
+    global _stream_filter
+    stream_filter = _stream_filter
+    if stream_filter is None or time.monotonic() >= stream_filter.expires:
+        # build the replacement first so readers never see a partial filter
+        stream_filter = _stream_filter = StreamFilter.from_config()
+    return stream_filter
+
+
+def stream_filter(data: dict[str, Any], /) -> bool:
+    return compiled_stream_filter()(data)
+
+
+class StreamStats:
+    __slots__ = ("accepted", "events", "started")
+
+    def __init__(self) -> None:
+        self.accepted = 0
+        self.events = 0
+        self.started = time.monotonic()
+
+    def counted(
+        self,
+        func: Callable[[dict[str, Any]], bool],
+        /,
+    ) -> Callable[[dict[str, Any]], bool]:
+        def counted_filter(data: dict[str, Any], /) -> bool:
+            self.events += 1
+            if func(data):
+                self.accepted += 1
+                return True
+            return False
+
+        return counted_filter
+
+    def summary(self) -> str:
+        elapsed = max(time.monotonic() - self.started, 1e-9)
+        rate = self.accepted / self.events if self.events else 0
+        return (
+            f"{self.events} events in {elapsed:.1f}s"
+            f" ({self.events / elapsed:.1f}/s),"
+            f" {self.accepted} accepted ({rate:.1%})"
+        )
+
+
+def _accepted(
+    events: Iterable[dict[str, Any]],
+    func: Callable[[dict[str, Any]], bool],
+    /,
+    *,
+    total: int | None = None,
+    heartbeat: bool = False,
+) -> Generator[dict[str, Any] | None]:
+    count = 0
+    for data in events:
+        if not func(data):
+            # lets consumers act on time while every event is rejected
+            if heartbeat:
+                yield None
+            continue
+        yield data
+        count += 1
+        if total is not None and count >= total:
+            return
 
 
 def change_stream(
     *,
     since: datetime.datetime | None = None,
     total: int | None = None,
-) -> Generator[dict[str, Any]]:
+    stats: StreamStats | None = None,
+    heartbeat: bool = False,
+) -> Generator[dict[str, Any] | None]:
+    stream = EventStreams(
+        streams=STREAM,
+        since=since,
+    )
+    func: Callable[[dict[str, Any]], bool] = stream_filter
+    if stats is not None:
+        func = stats.counted(func)
+    # filtered here rather than by EventStreams, which skips rejected
+    # events without yielding
+    yield from _accepted(stream, func, total=total, heartbeat=heartbeat)
+
+
+def record_stream(
+    path: str,
+    /,
+    *,
+    since: datetime.datetime | None = None,
+    total: int | None = None,
+) -> int:
     stream = EventStreams(
-        streams="mediawiki.page_change.v1",
+        streams=STREAM,
         since=since,
     )
-    stream.register_filter(stream_filter)
     stream.set_maximum_items(total)
-    yield from stream
+    count = 0
+    with gzip.open(path, "at", encoding="utf-8") as f:
+        for data in stream:
+            f.write(json.dumps(data, separators=(",", ":")) + "\n")
+            count += 1
+    return count
+
+
+def read_events(path: str, /) -> Generator[dict[str, Any]]:
+    # recordings are always compressed, whatever their file name
+    with open(path, "rb") as f:
+        compressed = f.read(2) == b"\x1f\x8b"
+    opener = gzip.open if compressed else open
+    with opener(path, "rt", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def replay_stream(
+    path: str,
+    /,
+    *,
+    realtime: bool = False,
+    total: int | None = None,
+    stats: StreamStats | None = None,
+    ignored_users: Collection[str] = (),
+    heartbeat: bool = False,
+) -> Generator[dict[str, Any] | None]:
+    # replays don't fetch the user ignore list, so they can run offline
+    func: Callable[[dict[str, Any]], bool]
+    func = StreamFilter.from_config(ignored_users=ignored_users)
+    if stats is not None:
+        func = stats.counted(func)
+    yield from _accepted(
+        _replayed_events(path, realtime=realtime),
+        func,
+        total=total,
+        heartbeat=heartbeat,
+    )
+
+
+def _replayed_events(
+    path: str,
+    /,
+    *,
+    realtime: bool = False,
+) -> Generator[dict[str, Any]]:
+    first: float | None = None
+    started = time.monotonic()
+    for data in read_events(path):
+        if realtime:
+            event_time = Timestamp.set_timestamp(data["meta"]["dt"])
+            offset = event_time.timestamp()
+            if first is None:
+                first = offset
+            delay = offset - first - (time.monotonic() - started)
+            if delay > 0:
+                time.sleep(delay)
+        yield data
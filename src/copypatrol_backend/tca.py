@@ -28,7 +28,7 @@ JSON = dict[str, _JSON]
 
 
 class TurnitinCoreAPI:
-    def __init__(self) -> None:
+    def __init__(self, *, pool_maxsize: int = 10) -> None:
         super().__init__()
         self.config = config.tca_config()
         self.base_url = f"https://{self.config.domain}/api/v1"
@@ -50,7 +50,13 @@ class TurnitinCoreAPI:
                 "X-Turnitin-Integration-Version": _VERSION,
             }
         )
-        self.session.mount(self.base_url, HTTPAdapter(max_retries=retry))
+        self.session.mount(
+            self.base_url,
+            HTTPAdapter(
+                pool_maxsize=max(pool_maxsize, 10),
+                max_retries=retry,
+            ),
+        )
 
     def read_response(self, response: requests.Response, /) -> dict[str, Any]:
         if response.status_code == 451:
@@ -0,0 +1,218 @@
+from __future__ import annotations
+
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from typing import TYPE_CHECKING
+
+import pywikibot
+
+from copypatrol_backend import config
+
+if TYPE_CHECKING:
+    from collections.abc import Iterable, Mapping
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS revisions (
+    site TEXT NOT NULL,
+    revid INTEGER NOT NULL,
+    sha1 TEXT NOT NULL,
+    PRIMARY KEY (site, revid)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS revisions_sha1 ON revisions (sha1);
+CREATE TABLE IF NOT EXISTS texts (
+    key TEXT PRIMARY KEY,
+    data BLOB NOT NULL,
+    size INTEGER NOT NULL,
+    atime REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS texts_atime ON texts (atime);
+CREATE TABLE IF NOT EXISTS usage (
+    id INTEGER PRIMARY KEY CHECK (id = 0),
+    bytes INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO usage SELECT 0, COALESCE(SUM(size), 0) FROM texts
+    WHERE NOT EXISTS (SELECT * FROM usage);
+CREATE TRIGGER IF NOT EXISTS texts_insert AFTER INSERT ON texts BEGIN
+    UPDATE usage SET bytes = bytes + new.size;
+END;
+CREATE TRIGGER IF NOT EXISTS texts_update AFTER UPDATE OF size ON texts BEGIN
+    UPDATE usage SET bytes = bytes - old.size + new.size;
+END;
+CREATE TRIGGER IF NOT EXISTS texts_delete AFTER DELETE ON texts BEGIN
+    UPDATE usage SET bytes = bytes - old.size;
+END;
+"""
+EVICT_EVERY = 100
+# texts evicted at most at once, so eviction never scans the whole cache
+EVICT_LIMIT = 1000
+# reads only write atime once it is this old, most hits are read-only
+ATIME_RESOLUTION = 3600.0
+
+# sqlite connections can only be used by the thread that opened them
+_local = threading.local()
+_writes = 0
+
+
+def text_sha1(text: str, /) -> str:
+    return hashlib.sha1(text.encode(), usedforsecurity=False).hexdigest()
+
+
+def connection() -> sqlite3.Connection | None:
+    path = config.text_cache_config().path
+    if path is None:
+        return None
+    # sqlite connections must not be shared with forked pool workers
+    pid = os.getpid()
+    current: tuple[int, str, sqlite3.Connection] | None
+    current = getattr(_local, "connection", None)
+    if current is None or current[:2] != (pid, path):
+        conn = sqlite3.connect(path, timeout=30, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript(SCHEMA)
+        current = _local.connection = (pid, path, conn)
+    return current[2]
+
+
+def _get(conn: sqlite3.Connection, keys: list[str], /) -> dict[str, str]:
+    if not keys:
+        return {}
+    params = ",".join("?" * len(keys))
+    rows = conn.execute(
+        "SELECT key, data, atime FROM texts"  # nosec B608
+        f" WHERE key IN ({params})",
+        keys,
+    ).fetchall()
+    now = time.time()
+    touched = [
+        (now, key) for key, _, atime in rows if now - atime >= ATIME_RESOLUTION
+    ]
+    if touched:
+        conn.executemany("UPDATE texts SET atime = ? WHERE key = ?", touched)
+    return {key: zlib.decompress(data).decode() for key, data, _ in rows}
+
+
+def _put(conn: sqlite3.Connection, items: dict[str, str], /) -> None:
+    global _writes
+    now = time.time()
+    rows = []
+    for key, text in items.items():
+        data = zlib.compress(text.encode())
+        rows.append((key, data, len(data), now))
+    # an upsert rather than REPLACE, whose deletes don't run the triggers
+    conn.executemany(
+        "INSERT INTO texts VALUES (?, ?, ?, ?) ON CONFLICT (key) DO UPDATE"
+        " SET data = excluded.data, size = excluded.size,"
+        " atime = excluded.atime",
+        rows,
+    )
+    _writes += len(rows)
+    if _writes >= EVICT_EVERY:
+        _writes = 0
+        evict(conn)
+
+
+def evict(conn: sqlite3.Connection, /) -> int:
+    max_bytes = config.text_cache_config().max_bytes
+    (excess,) = conn.execute(
+        "SELECT bytes - ? FROM usage", (max_bytes,)
+    ).fetchone()
+    if excess <= 0:
+        return 0
+    stale = []
+    # least recently used first
+    for key, size in conn.execute(
+        "SELECT key, size FROM texts ORDER BY atime LIMIT ?",
+        (EVICT_LIMIT,),
+    ):
+        stale.append(key)
+        excess -= size
+        if excess <= 0:
+            break
+    if stale:
+        conn.execute("BEGIN IMMEDIATE")
+        conn.executemany(
+            "DELETE FROM texts WHERE key = ?", [(key,) for key in stale]
+        )
+        conn.executemany(
+            "DELETE FROM revisions WHERE sha1 = ?",
+            [(key[4:],) for key in stale if key.startswith("raw:")],
+        )
+        conn.execute("COMMIT")
+    return len(stale)
+
+
+def revision_texts(site: str, revids: Iterable[int], /) -> dict[int, str]:
+    revids = list(revids)
+    if not revids or (conn := connection()) is None:
+        return {}
+    try:
+        params = ",".join("?" * len(revids))
+        sha1s = dict(
+            conn.execute(
+                "SELECT revid, sha1 FROM revisions"  # nosec B608
+                f" WHERE site = ? AND revid IN ({params})",
+                [site, *revids],
+            ).fetchall()
+        )
+        texts = _get(conn, [f"raw:{sha1}" for sha1 in sha1s.values()])
+    except sqlite3.Error:  # pragma: no cover
+        pywikibot.exception()
+        return {}
+    return {
+        revid: texts[f"raw:{sha1}"]
+        for revid, sha1 in sha1s.items()
+        if f"raw:{sha1}" in texts
+    }
+
+
+def save_revision_texts(site: str, texts: Mapping[int, str], /) -> None:
+    if not texts or (conn := connection()) is None:
+        return
+    sha1s = {revid: text_sha1(text) for revid, text in texts.items()}
+    try:
+        conn.executemany(
+            "INSERT OR REPLACE INTO revisions VALUES (?, ?, ?)",
+            [(site, revid, sha1) for revid, sha1 in sha1s.items()],
+        )
+        _put(
+            conn,
+            {f"raw:{sha1s[revid]}": text for revid, text in texts.items()},
+        )
+    except sqlite3.Error:  # pragma: no cover
+        pywikibot.exception()
+
+
+def _clean_key(site: str, version: str, text: str, /) -> str:
+    return f"clean:{version}:{site}:{text_sha1(text)}"
+
+
+def clean_text(site: str, version: str, text: str, /) -> str | None:
+    if (conn := connection()) is None:
+        return None
+    key = _clean_key(site, version, text)
+    try:
+        return _get(conn, [key]).get(key)
+    except sqlite3.Error:  # pragma: no cover
+        pywikibot.exception()
+        return None
+
+
+def save_clean_text(
+    site: str,
+    version: str,
+    text: str,
+    cleaned: str,
+    /,
+) -> None:
+    if (conn := connection()) is None:
+        return
+    try:
+        _put(conn, {_clean_key(site, version, text): cleaned})
+    except sqlite3.Error:  # pragma: no cover
+        pywikibot.exception()
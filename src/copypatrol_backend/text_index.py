@@ -0,0 +1,59 @@
+from __future__ import annotations
+
+from functools import cached_property
+
+
+class TextIndex:
+    def __init__(
+        self,
+        text: str,
+        /,
+        *,
+        size: int = 32,
+        step: int = 8,
+        exact: bool = True,
+    ) -> None:
+        self.text = text
+        self.size = size
+        self.step = step
+        self.exact = exact
+
+    @cached_property
+    def lines(self) -> frozenset[str]:
+        lines = self.text.splitlines()
+        return frozenset(lines).union(line.strip() for line in lines)
+
+    @cached_property
+    def ngrams(self) -> dict[int, int]:
+        text, size = self.text, self.size
+        ngrams: dict[int, int] = {}
+        for start in range(0, len(text) - size + 1, self.step):
+            end = start + size
+            ngrams.setdefault(hash(text[start:end]), start)
+        return ngrams
+
+    def _find_ngram(self, value: str, start: int, /) -> int | None:
+        # n-grams are indexed every step characters, so one of the next step
+        # windows of any substring of the text lines up with an indexed one
+        size, ngrams = self.size, self.ngrams
+        for i in range(start, start + self.step):
+            end = i + size
+            pos = ngrams.get(hash(value[i:end]))
+            if pos is not None:
+                return pos - i
+        return None
+
+    def __contains__(self, value: str) -> bool:
+        if value in self.lines:
+            return True
+        if len(value) < self.size + self.step - 1:
+            return value in self.text
+        last = len(value) - self.size - self.step + 1
+        offset = self._find_ngram(value, 0)
+        if offset is None or self._find_ngram(value, last) is None:
+            return False
+        if not self.exact:
+            return True
+        if offset >= 0 and self.text.startswith(value, offset):
+            return True
+        return value in self.text
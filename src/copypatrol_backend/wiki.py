@@ -1,22 +1,59 @@
 from __future__ import annotations
 
-from typing import TYPE_CHECKING
+from html.parser import HTMLParser
+from typing import TYPE_CHECKING, Any
 
+import cachetools.func
 import pywikibot
 import pywikibot.exceptions
 from pywikibot.page import Revision
 
+from copypatrol_backend import site_metadata, text_cache
+
 if TYPE_CHECKING:
+    from collections.abc import Iterable
+
     from pywikibot.site import APISite
 
 
-def load_revisions(
+@cachetools.func.lru_cache(maxsize=128)
+def site_from_domain(domain: str, /) -> APISite:
+    site = pywikibot.Site(url=f"https://{domain}/wiki/DUMMY")
+    site_metadata.apply(site)
+    return site
+
+
+@cachetools.func.lru_cache(maxsize=128)
+def site_from_code(code: str, family: str, /) -> APISite:
+    site = pywikibot.Site(code, family)
+    site_metadata.apply(site)
+    return site
+
+
+def page_from_title(
+    site: APISite,
+    namespace: int,
+    title: str,
+    /,
+) -> pywikibot.Page:
+    canonical_name = site.namespaces[namespace].canonical_name
+    return pywikibot.Page(site, f"{canonical_name}:{title}")
+
+
+def site_registry_info() -> dict[str, Any]:
+    return {
+        func.__name__: func.cache_info()
+        for func in (site_from_domain, site_from_code)
+    }
+
+
+def _query_revisions(
     site: APISite,
     revids: list[int],
     /,
     *,
-    content: bool = False,
-) -> dict[int, Revision] | None:
+    content: bool,
+) -> dict[str, Any]:
     rvprops = [
         "ids",
         "flags",
@@ -32,25 +69,223 @@ def load_revisions(
     ]
     if content:
         rvprops.append("content")
-    data = site.simple_request(
+    data: dict[str, Any] = site.simple_request(
         action="query",
         revids=revids,
         prop="revisions",
         rvprop=rvprops,
         rvslots="*",
     ).submit()
-    if "badrevids" in data["query"]:
-        return None
+    return data
+
+
+def _fetch_revisions(
+    site: APISite,
+    revids: list[int],
+    /,
+    *,
+    content: bool,
+) -> tuple[dict[int, dict[str, Any]], set[int]]:
+    cached = {}
+    if content:
+        cached = text_cache.revision_texts(site.sitename, revids)
+    if cached:
+        # cached text can't change, but whether it is deleted can, so those
+        # revisions are still queried, just without their content
+        queries = [
+            (list(cached), False),
+            ([revid for revid in revids if revid not in cached], True),
+        ]
+    else:
+        queries = [(revids, content)]
+    revisions = {}
+    badrevids: set[int] = set()
+    for query_revids, query_content in queries:
+        if not query_revids:
+            continue
+        data = _query_revisions(site, query_revids, content=query_content)
+        badrevids.update(map(int, data["query"].get("badrevids", ())))
+        for page in data["query"].get("pages", {}).values():
+            for rev in page["revisions"]:
+                revisions[rev["revid"]] = (page, rev)
+    fetched = {}
+    for revid, (_, rev) in revisions.items():
+        if revid not in cached:
+            if content and (text := rev["slots"]["main"].get("*")):
+                fetched[revid] = text
+            continue
+        main = rev.setdefault("slots", {}).setdefault("main", {})
+        if "sha1hidden" in rev:
+            main.setdefault("texthidden", True)
+        elif "texthidden" not in main:
+            main["*"] = cached[revid]
+    text_cache.save_revision_texts(site.sitename, fetched)
     return {
-        rev["revid"]: Revision(
-            pageid=page["pageid"],
-            ns=page["ns"],
-            title=page["title"],
+        revid: {
+            "pageid": page["pageid"],
+            "ns": page["ns"],
+            "title": page["title"],
             **rev,
-        )
-        for page in data["query"]["pages"].values()
-        for rev in page["revisions"]
-    }
+        }
+        for revid, (page, rev) in revisions.items()
+    }, badrevids
+
+
+def load_revisions(
+    site: APISite,
+    revids: list[int],
+    /,
+    *,
+    content: bool = False,
+) -> dict[int, Revision] | None:
+    revisions, badrevids = _fetch_revisions(site, revids, content=content)
+    if badrevids:
+        return None
+    return {revid: Revision(**data) for revid, data in revisions.items()}
+
+
+def load_revisions_by_id(
+    site: APISite,
+    revids: Iterable[int],
+    /,
+    *,
+    content: bool = False,
+) -> dict[int, dict[str, Any]]:
+    # plain revision data rather than Revision objects, which can't be
+    # pickled to pool workers
+    limit = site.maxlimit
+    pending = list(dict.fromkeys(revids))
+    revisions: dict[int, dict[str, Any]] = {}
+    while pending:
+        chunk, pending = pending[:limit], pending[limit:]
+        fetched, badrevids = _fetch_revisions(site, chunk, content=content)
+        revisions.update(fetched)
+        if badrevids:
+            pywikibot.debug(f"skipped bad revids {sorted(badrevids)}")
+        # responses over the API's size limit leave out some revisions
+        missing = [
+            revid
+            for revid in chunk
+            if revid not in fetched and revid not in badrevids
+        ]
+        if missing and fetched:
+            pending = missing + pending
+    return revisions
+
+
+def latest_revids(site: APISite, titles: Iterable[str], /) -> list[int]:
+    # the latest revision of each existing page, and the one before it
+    titles = list(dict.fromkeys(titles))
+    limit = site.maxlimit
+    revids: list[int] = []
+    for start in range(0, len(titles), limit):
+        end = start + limit
+        data = site.simple_request(
+            action="query",
+            titles=titles[start:end],
+            prop="revisions",
+            rvprop="ids",
+            formatversion="2",
+        ).submit()
+        for page in data["query"].get("pages", []):
+            # missing and invalid pages have no revisions
+            for rev in page.get("revisions", []):
+                revids.extend(
+                    revid
+                    for revid in (rev["revid"], rev.get("parentid", 0))
+                    if revid > 0
+                )
+    return revids
+
+
+class DiffTableParser(HTMLParser):
+    # collects the old and new lines of each block of an action=compare table
+    LINE_CLASSES = {"diff-context", "diff-deletedline", "diff-addedline"}
+    OLD_CLASSES = {"diff-side-deleted", "diff-deletedline"}
+    NEW_CLASSES = {"diff-side-added", "diff-addedline"}
+    MOVED_CLASSES = {"mw-diff-movedpara-left", "mw-diff-movedpara-right"}
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.blocks: list[tuple[list[str], list[str]]] = []
+        self._cells: list[tuple[str, str | None]] = []
+        self._side: str | None = None
+        self._text: list[str] = []
+        self._skip = 0
+
+    def handle_starttag(
+        self,
+        tag: str,
+        attrs: list[tuple[str, str | None]],
+    ) -> None:
+        classes = set((dict(attrs).get("class") or "").split())
+        if self._skip or (tag == "a" and classes & self.MOVED_CLASSES):
+            # paragraph move markers
+            self._skip += 1
+        elif tag == "tr":
+            self._cells = []
+        elif tag == "td" and "diff-lineno" in classes:
+            if not self.blocks or any(self.blocks[-1]):
+                self.blocks.append(([], []))
+        elif tag == "td" and classes & (self.LINE_CLASSES | {"diff-empty"}):
+            if classes & self.OLD_CLASSES:
+                side = "old"
+            elif classes & self.NEW_CLASSES:
+                side = "new"
+            else:
+                # context cells without a side class, old side first
+                side = "new" if self._cells else "old"
+            if "diff-empty" in classes:
+                self._cells.append((side, None))
+            else:
+                self._side = side
+                self._text = []
+
+    def handle_endtag(self, tag: str) -> None:
+        if self._skip:
+            self._skip -= 1
+        elif tag == "td" and self._side is not None:
+            self._cells.append((self._side, "".join(self._text)))
+            self._side = None
+        elif tag == "tr" and self._cells:
+            if not self.blocks:
+                self.blocks.append(([], []))
+            old, new = self.blocks[-1]
+            for side, text in self._cells:
+                if text is not None:
+                    (old if side == "old" else new).append(text)
+            self._cells = []
+
+    def handle_data(self, data: str) -> None:
+        if self._side is not None and not self._skip:
+            self._text.append(data)
+
+
+def compare_revisions(
+    site: APISite,
+    old: int,
+    new: int,
+    /,
+) -> list[tuple[str, str]] | None:
+    try:
+        data = site.simple_request(
+            action="compare",
+            fromrev=old,
+            torev=new,
+            prop="diff",
+            difftype="table",
+            formatversion="2",
+        ).submit()
+    except pywikibot.exceptions.APIError:
+        pywikibot.exception(exc_info=False)
+        return None
+    parser = DiffTableParser()
+    parser.feed(data["compare"].get("body", ""))
+    parser.close()
+    return [
+        ("\n".join(old_lines), "\n".join(new_lines))
+        for old_lines, new_lines in parser.blocks
+    ]
 
 
 def submit_pagetriage(site: APISite, page_id: int, rev_id: int, /) -> None:
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+"""Compare clean_wikitext with the previous multi-pass implementation.
+
+usage: python -m testing.benchmarks.clean_wikitext [--domain DOMAIN]
+    [--repeat N] [WIKITEXT ...]
+
+Each WIKITEXT file is one revision's wikitext. Without arguments, the
+revisions in testing/fixtures are used. Every revision is cleaned whole,
+paragraph by paragraph, and joined into one long article; the exit status
+is 1 if any output differs.
+"""
+
+from __future__ import annotations
+
+import argparse
+import re
+import sys
+import time
+from contextlib import suppress
+from typing import TYPE_CHECKING
+
+import mwparserfromhell
+
+from copypatrol_backend import wiki
+from copypatrol_backend.check_diff import (
+    category_regex,
+    clean_wikitext,
+    file_name_regex,
+)
+from testing.resources import resource
+
+if TYPE_CHECKING:
+    from pywikibot.site import APISite
+
+FIXTURES = [
+    "Basil_Lee_Whitener-1173291523.txt",
+    "Kommet,_ihr_Hirten-1125722395.txt",
+    "Kommet,_ihr_Hirten-1126962296.txt",
+]
+
+
+def legacy_clean_wikitext(text: str, /, *, site: APISite) -> str:
+    text = text.strip()
+    if not text:
+        return ""
+    text = re.sub(r"(?P<open>'{2,3})(.+?)(?P=open)", r"\2", text)
+    text = category_regex(site).sub("", text)
+    for quote in re.findall('["“«].+?["”»]', text):
+        if len(quote.split()) < 50:
+            text = text.replace(quote, "")
+    wikicode = mwparserfromhell.parse(text, skip_style_tags=True)
+    for link in wikicode.ifilter_external_links():
+        with suppress(ValueError):
+            wikicode.replace(link, link.title or "")
+    for tag in wikicode.ifilter_tags(
+        matches=lambda x: x.tag.lower() in ("blockquote", "ref", "references"),
+    ):
+        contents = tag.contents.strip_code(keep_template_params=True).strip()
+        if len(contents.split(" ")) < 50:
+            with suppress(ValueError):
+                wikicode.remove(tag)
+    text = wikicode.strip_code(keep_template_params=True)
+    text = file_name_regex(site).sub("", text)
+    text = re.sub(r" {2,}", " ", text)
+    text = "\n".join(line.strip() for line in text.splitlines())
+    text = re.sub(r"( ?\n){3,}", r"\n\n", text)
+    return text.strip()
+
+
+def main(*args: str) -> int:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--domain", default="en.wikipedia.org")
+    parser.add_argument("--repeat", type=int, default=3, metavar="N")
+    parser.add_argument("paths", nargs="*", metavar="WIKITEXT")
+    parsed = parser.parse_args(args)
+    site = wiki.site_from_domain(parsed.domain)
+    revisions = []
+    for path in parsed.paths:
+        with open(path) as f:
+            revisions.append(f.read())
+    if not revisions:
+        revisions = [resource(name) for name in FIXTURES]
+    corpora = {
+        "revisions": revisions,
+        "paragraphs": [
+            paragraph
+            for revision in revisions
+            for paragraph in revision.split("\n\n")
+        ],
+        # long articles are where per-node tree searches add up
+        "long article": ["\n\n".join(revisions * 20)],
+    }
+    mismatches = 0
+    for label, texts in corpora.items():
+        timings = {}
+        for func in (legacy_clean_wikitext, clean_wikitext):
+            best = float("inf")
+            for _ in range(parsed.repeat):
+                start = time.perf_counter()
+                for text in texts:
+                    func(text, site=site)
+                best = min(best, time.perf_counter() - start)
+            timings[func.__name__] = best
+        mismatches += sum(
+            legacy_clean_wikitext(text, site=site)
+            != clean_wikitext(text, site=site)
+            for text in texts
+        )
+        print(
+            f"{label} ({len(texts):,}):"
+            f" legacy {timings['legacy_clean_wikitext']:.4f}s,"
+            f" current {timings['clean_wikitext']:.4f}s"
+        )
+    print(f"mismatches: {mismatches}")
+    return 1 if mismatches else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main(*sys.argv[1:]))
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+"""Compare the char and line diff engines used by added_text.
+
+The line engine is much faster on large pages, but its added text is not
+the same as the char engine's on many edits that change several places,
+which is why char stays the default. The last line counts how many random
+multi-place edits get different output.
+
+usage: python -m testing.benchmarks.diff_engine [--repeat N] [--edits N]
+"""
+
+from __future__ import annotations
+
+import argparse
+import random
+import sys
+import time
+
+from copypatrol_backend.check_diff import DIFF_ENGINES, added_text
+from testing.resources import resource
+
+PARAGRAPHS = [
+    paragraph
+    for name in (
+        "Basil_Lee_Whitener-1173291523-cleaned.txt",
+        "Kommet,_ihr_Hirten-1126962296-cleaned.txt",
+    )
+    for paragraph in resource(name).split("\n\n")
+    if paragraph.strip()
+]
+
+
+def article(size: int, /, *, seed: int = 0) -> str:
+    rng = random.Random(seed)  # nosec B311
+    paragraphs: list[str] = []
+    length = 0
+    while length < size:
+        paragraph = f"{len(paragraphs)}. {rng.choice(PARAGRAPHS)}"
+        paragraphs.append(paragraph)
+        length += len(paragraph) + 2
+    return "\n\n".join(paragraphs)
+
+
+def edit(old: str, /, *, seed: int = 0) -> str:
+    rng = random.Random(seed)  # nosec B311
+    paragraphs = old.split("\n\n")
+    addition = " ".join(
+        rng.choice(PARAGRAPHS[0].split()) for _ in range(200)
+    ).capitalize()
+    paragraphs.insert(len(paragraphs) // 2, addition)
+    paragraphs[-1] = paragraphs[-1].replace("the", "a", 1)
+    return "\n\n".join(paragraphs)
+
+
+def multi_edit(old: str, /, *, seed: int = 0) -> str:
+    rng = random.Random(seed)  # nosec B311
+    words = PARAGRAPHS[0].split()
+    paragraphs = old.split("\n\n")
+    for _ in range(rng.randint(1, 4)):
+        index = rng.randrange(len(paragraphs))
+        kind = rng.choice(("insert", "replace", "delete", "reword"))
+        if kind in ("insert", "replace"):
+            text = " ".join(rng.choices(words, k=rng.randint(5, 80)))
+            if kind == "insert":
+                paragraphs.insert(index, text)
+            else:
+                paragraphs[index] = text
+        elif kind == "delete" and len(paragraphs) > 1:
+            del paragraphs[index]
+        else:
+            paragraph = paragraphs[index].split(" ")
+            start = rng.randrange(len(paragraph) + 1)
+            paragraph[start:start] = rng.choices(words, k=rng.randint(1, 20))
+            paragraphs[index] = " ".join(paragraph)
+    return "\n\n".join(paragraphs)
+
+
+def main(*args: str) -> int:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--repeat", type=int, default=3, metavar="N")
+    parser.add_argument("--edits", type=int, default=300, metavar="N")
+    parsed = parser.parse_args(args)
+    for label, size in (
+        ("small", 3_000),
+        ("medium", 30_000),
+        ("very large", 200_000),
+    ):
+        old = article(size)
+        new = edit(old)
+        results = {}
+        for engine in DIFF_ENGINES:
+            best = float("inf")
+            for _ in range(parsed.repeat):
+                start = time.perf_counter()
+                results[engine] = added_text(old, new, engine=engine)
+                best = min(best, time.perf_counter() - start)
+            print(f"{label} ({len(new):,} chars) {engine}: {best:.4f}s")
+        same = results["char"] == results["line"]
+        print(f"{label}: outputs {'match' if same else 'differ'}")
+    differ = 0
+    for seed in range(parsed.edits):
+        old = article(3_000, seed=seed)
+        new = multi_edit(old, seed=seed)
+        differ += added_text(old, new, engine="char") != added_text(
+            old, new, engine="line"
+        )
+    print(f"multi-place edits: outputs differ for {differ} of {parsed.edits}")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main(*sys.argv[1:]))
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+"""Compare the full and compare diff modes on live revisions.
+
+usage: python -m testing.benchmarks.diff_mode [--domain DOMAIN]
+    OLD:NEW [OLD:NEW ...]
+
+Each OLD:NEW is a pair of revision IDs on DOMAIN. The full mode fetches
+both revisions' text and diffs them locally; the compare mode asks the wiki
+for the changed blocks. Fragments are cleaned on their own, so the added
+text can differ; exact matches and the mean similarity are reported.
+"""
+
+from __future__ import annotations
+
+import argparse
+import difflib
+import sys
+import time
+
+from copypatrol_backend import wiki
+from copypatrol_backend.check_diff import (
+    added_compare_text,
+    added_revision_text,
+)
+
+
+def main(*args: str) -> int:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--domain", default="en.wikipedia.org")
+    parser.add_argument("pairs", nargs="+", metavar="OLD:NEW")
+    parsed = parser.parse_args(args)
+    site = wiki.site_from_domain(parsed.domain)
+    timings = {"full": 0.0, "compare": 0.0}
+    matches = 0
+    ratios = []
+    for pair in parsed.pairs:
+        old, new = map(int, pair.split(":"))
+        start = time.perf_counter()
+        revisions = wiki.load_revisions(site, [old, new], content=True)
+        if revisions is None:
+            print(f"{pair}: revision not found")
+            continue
+        full = added_revision_text(
+            revisions[old].text or "",
+            revisions[new].text or "",
+            site=site,
+        )
+        timings["full"] += time.perf_counter() - start
+        start = time.perf_counter()
+        compared = added_compare_text(site, old, new)
+        timings["compare"] += time.perf_counter() - start
+        if compared is None:
+            print(f"{pair}: compare failed")
+            continue
+        matches += full == compared
+        ratio = difflib.SequenceMatcher(None, full, compared).ratio()
+        ratios.append(ratio)
+        print(f"{pair}: {len(full):,} / {len(compared):,} chars, {ratio:.3f}")
+    if ratios:
+        print(f"exact matches: {matches}/{len(ratios)}")
+        print(f"mean similarity: {sum(ratios) / len(ratios):.3f}")
+    print(f"full {timings['full']:.4f}s, compare {timings['compare']:.4f}s")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main(*sys.argv[1:]))
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+"""Measure events/sec through the compiled stream filter.
+
+usage: python -m testing.benchmarks.stream_filter [EVENTS.jsonl[.gz] ...]
+
+Events can be recorded with `copypatrol-backend record-changes`.
+
+Without arguments, a synthetic mix of page_change events is used.
+"""
+
+from __future__ import annotations
+
+import argparse
+import itertools
+import random
+import sys
+import time
+from typing import Any
+
+from copypatrol_backend.stream_listener import StreamFilter, read_events
+
+DOMAINS = [
+    "en.wikipedia.org",
+    "es.wikipedia.org",
+    "fr.wikipedia.org",
+    "de.wikipedia.org",
+    "commons.wikimedia.org",
+    "www.wikidata.org",
+]
+
+
+def synthetic_events(n: int, /) -> list[dict[str, Any]]:
+    rng = random.Random(0)  # nosec B311
+    events = []
+    for i in range(n):
+        events.append(
+            {
+                "meta": {"domain": rng.choice(DOMAINS)},
+                "page_change_kind": rng.choice(
+                    ["edit"] * 8 + ["create", "move", "delete"]
+                ),
+                "page": {"namespace_id": rng.choice([0, 0, 0, 1, 2, 4, 118])},
+                "revision": {
+                    "editor": {
+                        "is_bot": rng.random() < 0.2,
+                        "is_system": False,
+                        "user_text": f"User {rng.randrange(1000)}",
+                    },
+                    "rev_id": i,
+                    "rev_sha1": f"{rng.getrandbits(160):040x}",
+                    "rev_size": rng.randrange(50_000),
+                },
+                "prior_state": {
+                    "revision": {"rev_sha1": f"{rng.getrandbits(160):040x}"},
+                },
+            }
+        )
+    return events
+
+
+def main(*args: str) -> int:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("paths", nargs="*", metavar="EVENTS")
+    parser.add_argument("--repeat", type=int, default=5, metavar="N")
+    parsed = parser.parse_args(args)
+    if parsed.paths:
+        events = list(
+            itertools.chain.from_iterable(map(read_events, parsed.paths))
+        )
+    else:
+        events = synthetic_events(100_000)
+    stream_filter = StreamFilter(
+        namespaces={
+            "en.wikipedia.org": frozenset({0, 2, 118}),
+            "es.wikipedia.org": frozenset({0, 2}),
+        },
+        ignored_users=frozenset(f"User {i}" for i in range(0, 1000, 7)),
+    )
+    best = float("inf")
+    for _ in range(parsed.repeat):
+        start = time.perf_counter()
+        accepted = sum(map(stream_filter, events))
+        best = min(best, time.perf_counter() - start)
+    print(f"events: {len(events)}")
+    print(f"accepted: {accepted} ({accepted / len(events):.1%})")
+    print(f"events/sec: {len(events) / best:,.0f}")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main(*sys.argv[1:]))
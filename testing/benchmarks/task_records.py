@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+"""Compare what check-changes sends to and from its workers per diff.
+
+usage: python -m testing.benchmarks.task_records [--count N]
+
+The pool used to pickle whole queued diff rows to the workers and back with
+the added text and diff statistics; it now sends a DiffTask and gets back a
+DiffResult. Revision text prefetched for the workers is the same either way
+and is left out. The pickled sizes and the time to pickle and unpickle N
+records in each direction are reported.
+"""
+
+from __future__ import annotations
+
+import argparse
+import pickle  # nosec B403
+import sys
+import time
+from collections import Counter
+
+from pywikibot.time import Timestamp
+
+from copypatrol_backend import database
+from copypatrol_backend.cli import DiffResult, DiffTask
+
+TEXT = "Added text. " * 200
+
+
+def queued_diff(diff_id: int, /) -> database.QueuedDiff:
+    diff = database.QueuedDiff(
+        project="wikipedia",
+        lang="en",
+        page_namespace=0,
+        page_title=f"Example_article_{diff_id}",
+        rev_id=1_200_000_000 + diff_id,
+        rev_parent_id=1_199_999_999 + diff_id,
+        rev_timestamp=Timestamp(2024, 1, 2, 3, 4, 5),
+        rev_user_text="Example user",
+        rev_size=12_345,
+        rev_parent_size=10_000,
+        rev_sha1="0123456789abcdef0123456789abcdef01234567",
+        rev_parent_sha1="76543210fedcba9876543210fedcba9876543210",
+        rev_tags=["visualeditor", "mobile edit"],
+        rev_comment="Expanded the history section",
+        rev_comment_hidden=False,
+        rev_text_hidden=False,
+    )
+    diff.diff_id = diff_id
+    return diff
+
+
+def measure(records: list[object], /) -> tuple[int, float]:
+    start = time.perf_counter()
+    size = 0
+    for record in records:
+        data = pickle.dumps(record)
+        size += len(data)
+        # only loads what was just dumped
+        pickle.loads(data)  # nosec B301
+    return size, time.perf_counter() - start
+
+
+def main(*args: str) -> int:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--count", type=int, default=10_000)
+    parsed = parser.parse_args(args)
+    diffs = [queued_diff(diff_id) for diff_id in range(parsed.count)]
+    stats = Counter(diffs=1)
+    directions: dict[str, tuple[list[object], list[object]]] = {
+        "tasks": (
+            list(diffs),
+            [DiffTask.from_diff(diff) for diff in diffs],
+        ),
+        "results": (
+            [(diff, TEXT, stats) for diff in diffs],
+            [DiffResult(diff.diff_id, "checked", TEXT) for diff in diffs],
+        ),
+    }
+    for name, (old, new) in directions.items():
+        old_size, old_time = measure(old)
+        new_size, new_time = measure(new)
+        print(
+            f"{name}: {old_size / len(old):,.0f} -> {new_size / len(new):,.0f}"
+            f" bytes per record ({new_size / old_size:.1%}),"
+            f" {old_time:.4f}s -> {new_time:.4f}s"
+        )
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main(*sys.argv[1:]))
@@ -6,6 +6,14 @@ import uuid
 import pytest
 import pywikibot
 from pywikibot.time import Timestamp
+from sqlalchemy import (
+    Index,
+    MetaData,
+    Table,
+    create_engine,
+    inspect,
+    select,
+)
 from sqlalchemy.sql.expression import text
 
 from copypatrol_backend import database
@@ -115,6 +123,16 @@ def test_add_revision(db_session):
         "rev_user_text": "Examplé".encode(),
         "submission_id": None,
         "status": database.Status.UNSUBMITTED.value,
+        "rev_size": None,
+        "rev_parent_size": None,
+        "rev_sha1": None,
+        "rev_parent_sha1": None,
+        "rev_tags": None,
+        "rev_comment": None,
+        "rev_comment_hidden": None,
+        "rev_text_hidden": None,
+        "lease_owner": None,
+        "lease_expiry": None,
     }
     stmt = text("SELECT * FROM `diffs_queue` WHERE `page_title` = :title")
     result = db_session.execute(stmt, {"title": b"Add_revision"}).all()
@@ -125,6 +143,97 @@ def test_add_revision(db_session):
     assert res == expected
 
 
+@pytest.mark.parametrize(
+    "diffs_data",
+    [
+        {
+            "project": "wikipedia",
+            "lang": "en",
+            "page_namespace": 0,
+            "page_title": "Add_revisions",
+            "rev_id": 1102,
+            "rev_parent_id": 1100,
+            "rev_timestamp": "20220101010101",
+            "rev_user_text": "Example",
+            "status": database.Status.UNSUBMITTED.value,
+            "status_timestamp": "20220101010101",
+        },
+    ],
+    indirect=True,
+)
+def test_add_revisions(db_session, diffs_data):
+    site = pywikibot.Site("en", "wikipedia")
+    db_session.add(
+        database.Diff(
+            submission_id=UUID,
+            project="wikipedia",
+            lang="en",
+            page_namespace=0,
+            page_title="Add_revisions",
+            rev_id=1101,
+            rev_parent_id=1100,
+            rev_timestamp=Timestamp(2022, 1, 1, 1, 1, 1),
+            rev_user_text="Example",
+            sources=[],
+        )
+    )
+    db_session.commit()
+    diffs = [
+        database.QueuedDiff.from_page(
+            pywikibot.Page(site, "Add revisions"),
+            rev_id=rev_id,
+            rev_parent_id=1100,
+            rev_timestamp="2022-01-01T01:01:01Z",
+            rev_user_text="Examplé",
+            rev_size=1000,
+            rev_tags=["foo", "bar"],
+            rev_text_hidden=False,
+        )
+        for rev_id in (1101, 1102, 1103, 1103)
+    ]
+    assert database.add_revisions(db_session, diffs) == 1
+    assert database.add_revisions(db_session, []) == 0
+    db_session.commit()
+    stmt = text(
+        "SELECT `rev_id`, `rev_user_text` FROM `diffs_queue`"
+        " WHERE `page_title` = :title ORDER BY `rev_id`"
+    )
+    result = db_session.execute(stmt, {"title": b"Add_revisions"}).all()
+    assert [tuple(row) for row in result] == [
+        (1102, b"Example"),
+        (1103, "Examplé".encode()),
+    ]
+    diff_stmt = select(database.QueuedDiff).where(
+        database.QueuedDiff.rev_id == 1103
+    )
+    diff = db_session.scalars(diff_stmt).one()
+    assert diff.rev_size == 1000
+    assert diff.rev_tags == ["foo", "bar"]
+    assert diff.rev_text_hidden is False
+    assert diff.rev_comment is None
+
+
+def test_stream_checkpoint(db_session):
+    stream = "mediawiki.page_change.v1"
+    assert database.stream_checkpoint(db_session, stream) is None
+    database.save_stream_checkpoint(
+        db_session,
+        stream,
+        Timestamp(2022, 1, 1, 1, 1, 1),
+    )
+    db_session.commit()
+    database.save_stream_checkpoint(
+        db_session,
+        stream,
+        Timestamp(2022, 1, 1, 2, 2, 2),
+    )
+    db_session.commit()
+    assert database.stream_checkpoint(db_session, stream) == Timestamp(
+        2022, 1, 1, 2, 2, 2
+    )
+    assert database.stream_checkpoint(db_session, "other") is None
+
+
 @pytest.mark.parametrize(
     "diffs_data,status",
     [
@@ -187,6 +296,201 @@ def test_queued_diff_from_submission_id(db_session, diffs_data):
     assert result.submission_id == UUID
 
 
+@pytest.mark.parametrize(
+    "diffs_data",
+    [
+        {
+            "project": "wikipedia",
+            "lang": "en",
+            "page_namespace": 0,
+            "page_title": "Update_by_id",
+            "rev_id": 3500,
+            "rev_parent_id": 3499,
+            "rev_timestamp": "20220101010101",
+            "rev_user_text": "Example",
+            "status": 0,
+            "status_timestamp": "20220101010101",
+        }
+    ],
+    indirect=True,
+)
+def test_update_delete_queued_diff(db_session, diffs_data):
+    stmt = select(database.QueuedDiff).where(
+        database.QueuedDiff.rev_id == 3500
+    )
+    diff_id = db_session.scalars(stmt).one().diff_id
+    db_session.expunge_all()
+    assert database.update_queued_diff(
+        db_session,
+        diff_id,
+        status=database.Status.CREATED,
+        submission_id=UUID,
+    )
+    db_session.commit()
+    diff = db_session.scalars(stmt).one()
+    assert diff.status == database.Status.CREATED
+    assert diff.submission_id == UUID
+    assert diff.status_timestamp > Timestamp(2022, 1, 1, 1, 1, 1)
+    db_session.expunge_all()
+    assert database.delete_queued_diff(db_session, diff_id)
+    db_session.commit()
+    assert db_session.scalars(stmt).one_or_none() is None
+    assert not database.update_queued_diff(
+        db_session,
+        diff_id,
+        status=database.Status.UPLOADED,
+    )
+    assert not database.delete_queued_diff(db_session, diff_id)
+
+
+@pytest.mark.parametrize(
+    "diffs_data",
+    [
+        tuple(
+            {
+                "project": "wikipedia",
+                "lang": "en",
+                "page_namespace": 0,
+                "page_title": "Claim",
+                "rev_id": 3600 + i,
+                "rev_parent_id": 3600,
+                "rev_timestamp": f"2022010101010{i}",
+                "rev_user_text": "Example",
+                "status": status,
+                "status_timestamp": "20220101010101",
+            }
+            for i, status in enumerate((-4, -4, -3, -2, -4))
+        )
+    ],
+    indirect=True,
+)
+def test_claim_queued_diffs(db_session, diffs_data):
+    lease = datetime.timedelta(minutes=10)
+
+    def claim(owner, **kwargs):
+        kwargs.setdefault("lease", lease)
+        diffs = database.claim_queued_diffs(db_session, owner, **kwargs)
+        db_session.commit()
+        return [diff.rev_id for diff in diffs]
+
+    assert claim("a", limit=2) == [3604, 3602]
+    assert claim("b") == [3601, 3600]
+    assert claim("c") == []
+    stmt = select(database.QueuedDiff).where(
+        database.QueuedDiff.rev_id == 3604
+    )
+    diff = db_session.scalars(stmt).one()
+    assert diff.lease_owner == "a"
+    assert diff.lease_expiry > Timestamp.utcnow()
+    assert diff.status_timestamp == Timestamp(2022, 1, 1, 1, 1, 1)
+    # expired leases are claimed again
+    ids = [diff.diff_id]
+    assert database.renew_leases(db_session, "b", ids, lease=-lease) == 0
+    assert database.renew_leases(db_session, "a", ids, lease=-lease) == 1
+    db_session.commit()
+    assert claim("c") == [3604]
+    assert database.release_leases(db_session, "b") == 2
+    db_session.commit()
+    assert claim("c", limit=1) == [3601]
+    # only diffs still to be submitted are released
+    stmt = select(database.QueuedDiff).where(
+        database.QueuedDiff.page_title == "Claim"
+    )
+    diff_ids = {diff.rev_id: diff.diff_id for diff in db_session.scalars(stmt)}
+    assert database.update_queued_diff(
+        db_session,
+        diff_ids[3603],
+        lease_owner="c",
+    )
+    assert database.release_leases(db_session, "c", [diff_ids[3604]]) == 1
+    assert database.release_leases(db_session, "c", []) == 0
+    assert database.release_leases(db_session, "c") == 1
+    db_session.commit()
+    db_session.expunge_all()
+    diffs = {diff.rev_id: diff for diff in db_session.scalars(stmt)}
+    assert diffs[3603].lease_owner == "c"
+    assert {
+        diff.rev_id
+        for diff in diffs.values()
+        if diff.status_timestamp != Timestamp(2022, 1, 1, 1, 1, 1)
+    } == {3603}
+
+
+@pytest.mark.parametrize(
+    "diffs_data",
+    [
+        tuple(
+            {
+                "project": "wikipedia",
+                "lang": "en",
+                "page_namespace": 0,
+                "page_title": "Status_writer",
+                "rev_id": 3700 + i,
+                "rev_parent_id": 3700,
+                "rev_timestamp": "20220101010101",
+                "rev_user_text": "Example",
+                "status": -4,
+                "status_timestamp": "20220101010101",
+            }
+            for i in range(4)
+        )
+    ],
+    indirect=True,
+)
+def test_status_writer(db_session, diffs_data):
+    def statuses():
+        stmt = select(database.QueuedDiff).where(
+            database.QueuedDiff.page_title == "Status_writer"
+        )
+        return {
+            diff.rev_id: (diff.status, diff.submission_id)
+            for diff in db_session.scalars(stmt)
+        }
+
+    stmt = select(database.QueuedDiff.rev_id, database.QueuedDiff.diff_id)
+    ids = dict(db_session.execute(stmt).tuples().all())
+    database.claim_queued_diffs(
+        db_session,
+        "a",
+        lease=datetime.timedelta(minutes=10),
+    )
+    db_session.commit()
+    writer = database.StatusWriter(db_session, size=3, interval=3600)
+    writer.update(ids[3700], database.Status.UPLOADED)
+    writer.delete(ids[3701])
+    assert len(writer) == 2
+    # submission ids are written right away
+    assert writer.created(ids[3702], UUID)
+    unsubmitted = (database.Status.UNSUBMITTED, None)
+    assert statuses() == {
+        3700: unsubmitted,
+        3701: unsubmitted,
+        3702: (database.Status.CREATED, UUID),
+        3703: unsubmitted,
+    }
+    writer.update(ids[3702], database.Status.UPLOADED)
+    assert len(writer) == 0
+    assert statuses() == {
+        3700: (database.Status.UPLOADED, None),
+        3702: (database.Status.UPLOADED, UUID),
+        3703: unsubmitted,
+    }
+    # diffs are no longer leased once uploaded
+    stmt = select(database.QueuedDiff.rev_id, database.QueuedDiff.lease_owner)
+    assert dict(db_session.execute(stmt).tuples().all()) == {
+        3700: None,
+        3702: None,
+        3703: "a",
+    }
+    # the last change of a diff wins
+    writer.update(ids[3703], database.Status.CREATED)
+    writer.delete(ids[3703])
+    assert len(writer) == 1
+    assert writer.flush()
+    assert 3703 not in statuses()
+    assert writer.flush()
+
+
 @pytest.mark.parametrize(
     "diffs_data",
     [
@@ -382,3 +686,83 @@ def test_max_min_diff_timestamp(db_session, diffs_data):
         )
         == _1
     )
+
+
+@pytest.mark.parametrize(
+    "diffs_data",
+    [
+        tuple(
+            {
+                "project": "wikipedia",
+                "lang": "en",
+                "page_namespace": 0,
+                "page_title": "Status_writer_forward",
+                "rev_id": 3800 + i,
+                "rev_parent_id": 3800,
+                "rev_timestamp": "20220101010101",
+                "rev_user_text": "Example",
+                "status": status,
+                "status_timestamp": "20220101010101",
+            }
+            for i, status in enumerate((-3, -1))
+        )
+    ],
+    indirect=True,
+)
+def test_status_writer_forward_only(mocker, db_session, diffs_data):
+    warning = mocker.patch("pywikibot.warning")
+    stmt = select(database.QueuedDiff.rev_id, database.QueuedDiff.diff_id)
+    ids = dict(db_session.execute(stmt).tuples().all())
+    writer = database.StatusWriter(db_session, interval=3600)
+    writer.update(ids[3800], database.Status.UPLOADED)
+    # the webhook got to this one first
+    writer.update(ids[3801], database.Status.UPLOADED)
+    writer.delete(-1)
+    assert writer.flush()
+    stmt = select(database.QueuedDiff.rev_id, database.QueuedDiff.status)
+    assert dict(db_session.execute(stmt).tuples().all()) == {
+        3800: database.Status.UPLOADED,
+        3801: database.Status.PENDING,
+    }
+    assert [call.args[0] for call in warning.call_args_list] == [
+        f"diff {ids[3801]} is already PENDING",
+        "1 diffs no longer queued",
+    ]
+
+
+def test_upgrade_tables(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'old.sqlite3'}")
+    # the queue as it was before the revision metadata and leases
+    new_columns = {
+        "rev_size",
+        "rev_parent_size",
+        "rev_sha1",
+        "rev_parent_sha1",
+        "rev_tags",
+        "rev_comment",
+        "rev_comment_hidden",
+        "rev_text_hidden",
+        "lease_owner",
+        "lease_expiry",
+    }
+    old = MetaData()
+    Table(
+        "diffs_queue",
+        old,
+        *(
+            column._copy()
+            for column in database.QueuedDiff.__table__.columns
+            if column.name not in new_columns
+        ),
+        Index("ix_diffs_queue_rev", "project", "lang", "rev_id", unique=True),
+    )
+    old.create_all(engine)
+    database.TableBase.metadata.create_all(engine)
+    assert database.upgrade_tables(engine) == len(new_columns) + 1
+    inspector = inspect(engine)
+    columns = {col["name"] for col in inspector.get_columns("diffs_queue")}
+    assert new_columns <= columns
+    indexes = {idx["name"] for idx in inspector.get_indexes("diffs_queue")}
+    assert "ix_diffs_queue_lease_expiry" in indexes
+    assert database.upgrade_tables(engine) == 0
+    engine.dispose()
@@ -1,7 +1,11 @@
 from __future__ import annotations
 
+import difflib
+import pickle
 import re
+from collections import Counter
 
+import cachetools
 import pytest
 import pywikibot
 from pywikibot.page import Revision
@@ -19,6 +23,7 @@ def mock_filename_regex(mocker):
         "copypatrol_backend.check_diff.file_name_regex",
         return_value=regex,
     )
+    mocker.patch.dict(check_diff.cleaning_profiles, clear=True)
     yield
 
 
@@ -64,6 +69,125 @@ def test_clean_wikitext_empty():
     assert check_diff.clean_wikitext("", site=SITE) == ""
 
 
+def test_cleaning_profile(mocker, mock_filename_regex):
+    profile = check_diff.cleaning_profile(SITE)
+    assert check_diff.cleaning_profile(SITE) is profile
+    assert profile.sitename == SITE.sitename
+    assert profile.version.startswith(f"{check_diff.CLEAN_VERSION}-")
+    assert pickle.loads(pickle.dumps(profile)) == profile
+    other = check_diff.build_cleaning_profile(SITE, max_quote_words=20)
+    assert other.version != profile.version
+    mocker.patch.object(check_diff, "CLEAN_VERSION", "test")
+    assert check_diff.build_cleaning_profile(SITE).version.startswith("test-")
+    check_diff.register_cleaning_profiles([other])
+    assert check_diff.cleaning_profile(SITE) is other
+
+
+def test_clean_wikitext_text_cache(mocker, mock_filename_regex, text_cache):
+    text = resource("Kommet,_ihr_Hirten-1126962296.txt")
+    expected = resource("Kommet,_ihr_Hirten-1126962296-cleaned.txt").strip()
+    clean = mocker.spy(check_diff, "_clean_wikitext")
+    assert check_diff.clean_wikitext(text, site=SITE) == expected
+    assert check_diff.clean_wikitext(text, site=SITE) == expected
+    assert clean.call_count == 1
+    mocker.patch.object(check_diff, "CLEAN_VERSION", "test")
+    check_diff.cleaning_profiles.clear()
+    assert check_diff.clean_wikitext(text, site=SITE) == expected
+    assert clean.call_count == 2
+
+
+def test_section_regex():
+    text = "Lead\n== A ==\ntext\n=== B ===  \nmore\n==C\n=\nend"
+    assert check_diff.SECTION_REGEX.split(text) == [
+        "Lead\n",
+        "== A ==\ntext\n",
+        "=== B ===  \nmore\n==C\n=\nend",
+    ]
+
+
+@pytest.mark.parametrize("min_size", [0, check_diff.SECTION_MIN_SIZE])
+def test_clean_revisions(mocker, mock_filename_regex, min_size):
+    mocker.patch.object(
+        check_diff,
+        "section_cache",
+        cachetools.LRUCache(maxsize=1 << 20, getsizeof=len),
+    )
+    old = resource("Kommet,_ihr_Hirten-1125722395.txt")
+    new = resource("Kommet,_ihr_Hirten-1126962296.txt")
+    clean = mocker.spy(check_diff, "_clean_wikitext")
+    old_text, new_text, context = check_diff.clean_revisions(
+        old,
+        new,
+        site=SITE,
+        min_size=min_size,
+    )
+    assert context == check_diff.clean_wikitext(old, site=SITE)
+    if min_size:
+        assert new_text == check_diff.clean_wikitext(new, site=SITE)
+        assert old_text == context
+    else:
+        assert len(new_text) < len(check_diff.clean_wikitext(new, site=SITE))
+        assert len(old_text) < len(context)
+        # each distinct section is cleaned once
+        sections = set(check_diff.SECTION_REGEX.split(old))
+        sections.update(check_diff.SECTION_REGEX.split(new))
+        assert clean.call_count - 2 == len(sections)
+    expected = resource("Kommet,_ihr_Hirten-1126962296-added.txt").strip()
+    assert check_diff.added_text(old_text, new_text, context=context) == (
+        expected
+    )
+
+
+def test_clean_revisions_cached(mocker, mock_filename_regex):
+    mocker.patch.object(
+        check_diff,
+        "section_cache",
+        cachetools.LRUCache(maxsize=1 << 20, getsizeof=len),
+    )
+    old = resource("Kommet,_ihr_Hirten-1125722395.txt")
+    new = resource("Kommet,_ihr_Hirten-1126962296.txt")
+    check_diff.clean_revisions(old, new, site=SITE, min_size=0)
+    clean = mocker.spy(check_diff, "clean_wikitext")
+    check_diff.clean_revisions(new, old, site=SITE, min_size=0)
+    assert clean.call_count == 0
+
+
+@pytest.mark.parametrize(
+    "text, expected",
+    [
+        ('He said "hello" and «bye».', "He said  and ."),
+        ('a "b" c "b" d', "a  c  d"),
+        ("»« » «« » ", "» « "),
+        ('a"««""”"«»"”"”"a”', 'a«»”"a”'),
+        ("no quotes", "no quotes"),
+    ],
+)
+def test_remove_quotes(text, expected):
+    assert check_diff.remove_quotes(text) == expected
+
+
+@pytest.mark.parametrize(
+    "text, expected",
+    [
+        ("\n\nplain\n\n\n\n\ntext\n", "plain\n\ntext"),
+        ("Note: plain text", "Note: plain text"),
+        ("see [http://example.org Example] here", "see Example here"),
+        ("a<ref>[http://example.org b]</ref> c", "a c"),
+        (
+            "[http://example.org [http://example.com x] y]<ref>z</ref>",
+            "[http://example.com x y]",
+        ),
+        (
+            "<blockquote>q<ref>r</ref></blockquote> {{t|[http://e.org v]}}",
+            " v",
+        ),
+        ("== Heading ==\n* item &amp; more", " Heading \n item & more"),
+    ],
+)
+def test_strip_markup(text, expected):
+    assert check_diff.strip_markup(text) == expected
+
+
 def test_added_revision_text(mock_filename_regex):
     old = resource("Kommet,_ihr_Hirten-1125722395.txt")
     new = resource("Kommet,_ihr_Hirten-1126962296.txt")
@@ -71,6 +195,138 @@ def test_added_revision_text(mock_filename_regex):
     assert check_diff.added_revision_text(old, new, site=SITE) == expected
 
 
+def test_added_compare_text(mocker, mock_filename_regex):
+    old = resource("Kommet,_ihr_Hirten-1125722395.txt").splitlines()
+    new = resource("Kommet,_ihr_Hirten-1126962296.txt").splitlines()
+    # blocks with two lines of context, like the wiki's diff
+    blocks = []
+    matcher = difflib.SequenceMatcher(None, old, new)
+    for group in matcher.get_grouped_opcodes(2):
+        old_lines, new_lines = [], []
+        for _, old_start, old_end, new_start, new_end in group:
+            old_lines += old[old_start:old_end]
+            new_lines += new[new_start:new_end]
+        blocks.append(("\n".join(old_lines), "\n".join(new_lines)))
+    compare_revisions = mocker.patch(
+        "copypatrol_backend.check_diff.compare_revisions",
+        return_value=blocks,
+    )
+    expected = resource("Kommet,_ihr_Hirten-1126962296-added.txt").strip()
+    assert check_diff.added_compare_text(SITE, 1, 2) == expected
+    compare_revisions.assert_called_once_with(SITE, 1, 2)
+    compare_revisions.return_value = None
+    assert check_diff.added_compare_text(SITE, 1, 2) is None
+
+
+@pytest.mark.parametrize("engine", ["char", "line"])
+def test_added_revision_text_engines(mock_filename_regex, engine):
+    old = resource("Kommet,_ihr_Hirten-1125722395.txt")
+    new = resource("Kommet,_ihr_Hirten-1126962296.txt")
+    expected = resource("Kommet,_ihr_Hirten-1126962296-added.txt").strip()
+    result = check_diff.added_revision_text(old, new, site=SITE, engine=engine)
+    assert result == expected
+
+
+@pytest.mark.parametrize(
+    "old, new",
+    [
+        pytest.param("", "foo\nbar\n", id="from empty"),
+        pytest.param("foo\nbar\n", "", id="to empty"),
+        pytest.param("a\n\nb\n", "a\n\nc\n\nb\n", id="slide insert"),
+        pytest.param("a\nb\nc", "a\nB\nc\nd", id="replace and insert"),
+        pytest.param("a\nb\nc\n", "a\nc\n", id="delete"),
+    ],
+)
+def test_line_opcodes(old, new):
+    opcodes = list(check_diff.line_opcodes(old, new))
+    old_pos = new_pos = 0
+    result = ""
+    for op, a1, a2, b1, b2 in opcodes:
+        assert (a1, b1) == (old_pos, new_pos)
+        if op == "equal":
+            assert old[a1:a2] == new[b1:b2]
+        result += new[b1:b2]
+        old_pos, new_pos = a2, b2
+    assert (old_pos, new_pos) == (len(old), len(new))
+    assert result == new
+
+
+def test_line_opcodes_slide_insert():
+    old, new = "a\n\nb\n", "a\n\nc\n\nb\n"
+    opcodes = list(check_diff.line_opcodes(old, new))
+    assert ("insert", 1, 1, 1, 4) in opcodes
+    assert opcodes == list(check_diff.char_opcodes(old, new))
+
+
+def test_added_text_default_engine(mocker):
+    # the line engine's output differs on many multi-place edits
+    line = mocker.Mock(side_effect=check_diff.line_opcodes)
+    mocker.patch.dict(check_diff.DIFF_ENGINES, {"line": line})
+    old, new = "intro\n\noutro", f"intro\n\n{'added ' * 10}\n\noutro"
+    assert check_diff.added_text(old, new) == "added " * 9 + "added"
+    line.assert_not_called()
+
+
+def test_approximate_added_text():
+    old = "intro\n\nkept paragraph\n\noutro"
+    new = (
+        f"intro\n\n{'moved ' * 10}\n{'added ' * 10}\n\nkept paragraph"
+        "\n\nshort\n\noutro"
+    )
+    assert check_diff.approximate_added_text(old, new) == (
+        f"{'moved ' * 10}\n{'added ' * 10}".strip()
+    )
+
+
+@pytest.mark.parametrize(
+    "budget, approximate",
+    [
+        pytest.param(check_diff.DiffBudget(), False, id="default"),
+        pytest.param(
+            check_diff.DiffBudget(seconds=None, max_size=None),
+            False,
+            id="unbounded",
+        ),
+        pytest.param(
+            check_diff.DiffBudget(max_size=100),
+            True,
+            id="max size",
+        ),
+    ],
+)
+def test_bounded_added_text(budget, approximate):
+    old = "foo bar\n" * 100
+    new = f"{old}{'baz ' * 50}\n{old}"
+    expected = "baz " * 49 + "baz"
+    assert check_diff.bounded_added_text(old, new, budget=budget) == (
+        expected,
+        approximate,
+    )
+
+
+def test_bounded_added_text_timeout(mocker):
+    added_text = mocker.patch(
+        "copypatrol_backend.check_diff.added_text",
+        side_effect=check_diff.DiffBudgetExceeded,
+    )
+    old = "foo bar\n" * 100
+    new = f"{old}{'baz ' * 50}"
+    assert check_diff.bounded_added_text(old, new) == (
+        "baz " * 49 + "baz",
+        True,
+    )
+    added_text.assert_called_once()
+
+
+def test_cpu_budget():
+    with pytest.raises(check_diff.DiffBudgetExceeded):
+        with check_diff.cpu_budget(0.01):
+            while True:
+                pass
+    with check_diff.cpu_budget(None):
+        pass
+
+
 @pytest.mark.parametrize(
     "old_text, new_text, new_comment, new_tags, added_text",
     [
@@ -156,6 +412,7 @@ def test_added_revision_text(mock_filename_regex):
         ),
     ],
 )
+@pytest.mark.parametrize("prefetched", [False, True])
 def test_check_diff(
     mocker,
     mock_filename_regex,
@@ -164,6 +421,7 @@ def test_check_diff(
     new_text,
     new_tags,
     added_text,
+    prefetched,
 ):
     page = pywikibot.Page(SITE, "Barack Obama")
     old_rev = Revision(
@@ -180,15 +438,53 @@ def test_check_diff(
         tags=new_tags,
         user="B",
     )
-    mocker.patch(
+    revisions = {old_rev.revid: old_rev, new_rev.revid: new_rev}
+    load_revisions = mocker.patch(
         "copypatrol_backend.check_diff.load_revisions",
-        return_value={
-            old_rev.revid: old_rev,
-            new_rev.revid: new_rev,
-        },
+        return_value=revisions,
+    )
+    result = check_diff.check_diff(
+        page,
+        old_rev.revid,
+        new_rev.revid,
+        revisions=revisions if prefetched else None,
     )
-    result = check_diff.check_diff(page, old_rev.revid, new_rev.revid)
     assert result == added_text
+    assert load_revisions.called is not prefetched
+
+
+@pytest.mark.parametrize("max_size, approximate", [(None, 0), (100, 1)])
+def test_check_diff_budget_stats(
+    mocker,
+    mock_filename_regex,
+    max_size,
+    approximate,
+):
+    page = pywikibot.Page(SITE, "Barack Obama")
+    revisions = {
+        revid: Revision(
+            revid=revid,
+            comment="",
+            slots={"main": {"*": text}},
+            tags=[],
+            user="A",
+        )
+        for revid, text in (
+            (1, "foo bar" * 100),
+            (2, f'{"foo bar" * 100}\n\n{"baz" * 500}'),
+        )
+    }
+    stats: Counter[str] = Counter()
+    result = check_diff.check_diff(
+        page,
+        1,
+        2,
+        revisions=revisions,
+        budget=check_diff.DiffBudget(max_size=max_size),
+        stats=stats,
+    )
+    assert result == "baz" * 500
+    assert stats == Counter(diffs=1, approximate=approximate)
 
 
 @pytest.mark.parametrize(
@@ -200,6 +496,17 @@ def test_check_diff(
             None,
             id="new page copied text from existing page",
         ),
+        pytest.param(
+            True,
+            {
+                "*": resource("Kommet,_ihr_Hirten-1126962296.txt")
+                .replace(" song ", " tune ")
+                .replace("German", "Germanic")
+                .strip(),
+            },
+            None,
+            id="new page lightly edited copy of existing page",
+        ),
         pytest.param(
             False,
             {"*": "something not copied"},
@@ -221,21 +528,19 @@ def test_check_diff_new_links(
     linked_page_slots_main,
     added_text,
 ):
-    mocker.patch("pywikibot.site.APISite.loadrevisions")
-    mocker.patch("pywikibot.Page.exists", return_value=linked_page_exists)
-    mocker.patch(
-        "pywikibot.Page.revisions",
-        return_value=[
-            Revision(
-                revid=987654321,
-                comment="something",
-                slots={
-                    "main": linked_page_slots_main,
-                },
-                tags=["foo"],
-                user="C",
-            ),
-        ],
+    mocker.patch.object(check_diff, "linked_text_cache", {})
+    latest_revids = mocker.patch(
+        "copypatrol_backend.check_diff.latest_revids",
+        return_value=[987654321] if linked_page_exists else [],
+    )
+    load_revisions_by_id = mocker.patch(
+        "copypatrol_backend.check_diff.load_revisions_by_id",
+        return_value={
+            987654321: {
+                "revid": 987654321,
+                "slots": {"main": linked_page_slots_main},
+            },
+        },
     )
     page = pywikibot.Page(SITE, "Kommet, ihr Hirten")
     new_rev = Revision(
@@ -256,6 +561,38 @@ def test_check_diff_new_links(
         },
     )
     assert check_diff.check_diff(page, 0, new_rev.revid) == added_text
+    latest_revids.assert_called_once_with(SITE, ["Example"])
+    assert load_revisions_by_id.called is linked_page_exists
+
+
+def test_linked_texts(mocker, mock_filename_regex):
+    mocker.patch.object(check_diff, "linked_text_cache", {})
+    mocker.patch(
+        "copypatrol_backend.check_diff.latest_revids",
+        return_value=[1, 2, 3],
+    )
+    load_revisions_by_id = mocker.patch(
+        "copypatrol_backend.check_diff.load_revisions_by_id",
+        side_effect=lambda site, revids, content: {
+            revid: {
+                "revid": revid,
+                "slots": {
+                    "main": (
+                        {"texthidden": ""} if revid == 2 else {"*": f"{revid}"}
+                    ),
+                },
+            }
+            for revid in revids
+        },
+    )
+    pages = [pywikibot.Page(SITE, "Foo"), pywikibot.Page(SITE, "Bar")]
+    texts = check_diff.linked_texts(pages)
+    assert [text.text_index.text for text in texts] == ["1", "3"]
+    load_revisions_by_id.assert_called_once_with(SITE, [1, 2, 3], content=True)
+    texts = check_diff.linked_texts(pages)
+    assert [text.text_index.text for text in texts] == ["1", "3"]
+    assert load_revisions_by_id.call_count == 1
+    assert check_diff.linked_text_cache[SITE.sitename, 2] is None
 
 
 def test_check_diff_deleted(mocker):
@@ -267,6 +604,66 @@ def test_check_diff_deleted(mocker):
     assert check_diff.check_diff(page, 1125722395, 1126962296) is None
 
 
+@pytest.mark.parametrize("prefetched", [1125722395, 1126962296])
+def test_check_diff_prefetched_revisions(mocker, prefetched):
+    page = pywikibot.Page(SITE, "Kommet, ihr Hirten")
+    text = resource(f"Kommet,_ihr_Hirten-{prefetched}.txt")
+    rev = Revision(
+        revid=prefetched,
+        comment="",
+        slots={"main": {"*": text}},
+        tags=[],
+        user="A",
+    )
+    load_revisions = mocker.patch(
+        "copypatrol_backend.check_diff.load_revisions",
+    )
+    result = check_diff.check_diff(
+        page,
+        1125722395,
+        1126962296,
+        revisions={rev.revid: rev},
+    )
+    assert result is None
+    load_revisions.assert_not_called()
+
+
+@pytest.mark.parametrize("compared", [None, "x" * 500])
+def test_check_diff_compare_mode(mocker, compared):
+    page = pywikibot.Page(SITE, "Kommet, ihr Hirten")
+    revisions = {
+        revid: Revision(
+            revid=revid,
+            comment="",
+            slots={"main": {}},
+            size=5000,
+            tags=[],
+            user="A",
+        )
+        for revid in (1125722395, 1126962296)
+    }
+    load_revisions = mocker.patch(
+        "copypatrol_backend.check_diff.load_revisions",
+        return_value=revisions,
+    )
+    mocker.patch(
+        "copypatrol_backend.check_diff.added_compare_text",
+        return_value=compared,
+    )
+    result = check_diff.check_diff(
+        page,
+        1125722395,
+        1126962296,
+        diff_mode="compare",
+    )
+    assert result == compared
+    load_revisions.assert_called_once_with(
+        SITE,
+        [1125722395, 1126962296],
+        content=False,
+    )
+
+
 @pytest.mark.parametrize(
     "old_slots_main, new_slots_main",
     [
@@ -316,3 +713,64 @@ def test_check_diff_rev_text_hidden(
     )
     result = check_diff.check_diff(page, old_rev.revid, new_rev.revid)
     assert result is None
+
+
+@pytest.mark.parametrize(
+    "metadata",
+    [
+        pytest.param(
+            check_diff.RevisionMetadata(tags=["mw-rollback"]),
+            id="rollback",
+        ),
+        pytest.param(
+            check_diff.RevisionMetadata(tags=["mw-undo", "twinkle"]),
+            id="twinkle undo",
+        ),
+        pytest.param(
+            check_diff.RevisionMetadata(text_hidden=True),
+            id="text hidden",
+        ),
+        pytest.param(
+            check_diff.RevisionMetadata(sha1="abc", parent_sha1="abc"),
+            id="identity revert",
+        ),
+        pytest.param(
+            check_diff.RevisionMetadata(size=499),
+            id="small",
+        ),
+    ],
+)
+def test_check_diff_metadata_rejected(mocker, metadata):
+    load_revisions = mocker.patch(
+        "copypatrol_backend.check_diff.load_revisions",
+    )
+    page = pywikibot.Page(SITE, "Kommet, ihr Hirten")
+    result = check_diff.check_diff(
+        page,
+        1125722395,
+        1126962296,
+        metadata=metadata,
+    )
+    assert result is None
+    load_revisions.assert_not_called()
+
+
+@pytest.mark.parametrize(
+    "metadata, expected",
+    [
+        (check_diff.RevisionMetadata(), None),
+        (
+            check_diff.RevisionMetadata(
+                size=500,
+                sha1="abc",
+                parent_sha1="def",
+                tags=["mw-undo"],
+                text_hidden=False,
+            ),
+            None,
+        ),
+        (check_diff.RevisionMetadata(tags=["mw-rollback"]), "was a rollback"),
+    ],
+)
+def test_metadata_rejection(metadata, expected):
+    assert check_diff.metadata_rejection(metadata) == expected
@@ -2,11 +2,22 @@ from __future__ import annotations
 
 import datetime
 import multiprocessing
+import os
+import re
+import signal
+import time
 from argparse import Namespace
+from uuid import UUID
 
 import pytest
+from pywikibot.time import Timestamp
 
-from copypatrol_backend import cli
+from copypatrol_backend import cli, database
+from copypatrol_backend.check_diff import (
+    CleaningProfile,
+    RevisionMetadata,
+    cleaning_profiles,
+)
 
 
 @pytest.mark.parametrize(
@@ -14,7 +25,15 @@ from copypatrol_backend import cli
     [
         pytest.param(
             ("store-changes",),
-            Namespace(action="store-changes", since=None, total=None),
+            Namespace(
+                action="store-changes",
+                since=None,
+                total=None,
+                batch_size=1,
+                batch_interval=None,
+                replay=None,
+                realtime=False,
+            ),
             id="store-changes",
         ),
         pytest.param(
@@ -23,6 +42,10 @@ from copypatrol_backend import cli
                 action="store-changes",
                 since=datetime.datetime(2022, 1, 1, 0, 0, 0),
                 total=None,
+                batch_size=1,
+                batch_interval=None,
+                replay=None,
+                realtime=False,
             ),
             id="store-changes since",
         ),
@@ -32,15 +55,70 @@ from copypatrol_backend import cli
                 action="store-changes",
                 since=None,
                 total=10,
+                batch_size=1,
+                batch_interval=None,
+                replay=None,
+                realtime=False,
             ),
             id="store-changes total",
         ),
+        pytest.param(
+            (
+                "store-changes",
+                "--batch-size",
+                "100",
+                "--batch-interval",
+                "2.5",
+            ),
+            Namespace(
+                action="store-changes",
+                since=None,
+                total=None,
+                batch_size=100,
+                batch_interval=2.5,
+                replay=None,
+                realtime=False,
+            ),
+            id="store-changes batch",
+        ),
+        pytest.param(
+            ("store-changes", "--replay", "events.jsonl.gz", "--realtime"),
+            Namespace(
+                action="store-changes",
+                since=None,
+                total=None,
+                batch_size=1,
+                batch_interval=None,
+                replay="events.jsonl.gz",
+                realtime=True,
+            ),
+            id="store-changes replay",
+        ),
+        pytest.param(
+            ("record-changes", "events.jsonl.gz", "--total", "10"),
+            Namespace(
+                action="record-changes",
+                path="events.jsonl.gz",
+                since=None,
+                total=10,
+            ),
+            id="record-changes",
+        ),
         pytest.param(
             ("check-changes",),
             Namespace(
                 action="check-changes",
                 poolsize=multiprocessing.cpu_count(),
                 limit=None,
+                diff_mode="full",
+                diff_budget=10.0,
+                diff_max_size=4_000_000,
+                daemon=False,
+                poll_interval=30.0,
+                worker_id=None,
+                lease=900.0,
+                fetch_concurrency=2,
+                tca_concurrency=4,
             ),
             id="check-changes",
         ),
@@ -50,7 +128,20 @@ from copypatrol_backend import cli
                 "--poolsize",
                 "3",
             ),
-            Namespace(action="check-changes", poolsize=3, limit=None),
+            Namespace(
+                action="check-changes",
+                poolsize=3,
+                limit=None,
+                diff_mode="full",
+                diff_budget=10.0,
+                diff_max_size=4_000_000,
+                daemon=False,
+                poll_interval=30.0,
+                worker_id=None,
+                lease=900.0,
+                fetch_concurrency=2,
+                tca_concurrency=4,
+            ),
             id="check-changes poolsize",
         ),
         pytest.param(
@@ -61,9 +152,115 @@ from copypatrol_backend import cli
                 "--limit",
                 "10",
             ),
-            Namespace(action="check-changes", poolsize=3, limit=10),
+            Namespace(
+                action="check-changes",
+                poolsize=3,
+                limit=10,
+                diff_mode="full",
+                diff_budget=10.0,
+                diff_max_size=4_000_000,
+                daemon=False,
+                poll_interval=30.0,
+                worker_id=None,
+                lease=900.0,
+                fetch_concurrency=2,
+                tca_concurrency=4,
+            ),
             id="check-changes limit",
         ),
+        pytest.param(
+            ("check-changes", "--diff-mode", "compare"),
+            Namespace(
+                action="check-changes",
+                poolsize=multiprocessing.cpu_count(),
+                limit=None,
+                diff_mode="compare",
+                diff_budget=10.0,
+                diff_max_size=4_000_000,
+                daemon=False,
+                poll_interval=30.0,
+                worker_id=None,
+                lease=900.0,
+                fetch_concurrency=2,
+                tca_concurrency=4,
+            ),
+            id="check-changes diff mode",
+        ),
+        pytest.param(
+            (
+                "check-changes",
+                "--diff-budget",
+                "2.5",
+                "--diff-max-size",
+                "100000",
+            ),
+            Namespace(
+                action="check-changes",
+                poolsize=multiprocessing.cpu_count(),
+                limit=None,
+                diff_mode="full",
+                diff_budget=2.5,
+                diff_max_size=100_000,
+                daemon=False,
+                poll_interval=30.0,
+                worker_id=None,
+                lease=900.0,
+                fetch_concurrency=2,
+                tca_concurrency=4,
+            ),
+            id="check-changes diff budget",
+        ),
+        pytest.param(
+            (
+                "check-changes",
+                "--fetch-concurrency",
+                "3",
+                "--tca-concurrency",
+                "8",
+            ),
+            Namespace(
+                action="check-changes",
+                poolsize=multiprocessing.cpu_count(),
+                limit=None,
+                diff_mode="full",
+                diff_budget=10.0,
+                diff_max_size=4_000_000,
+                daemon=False,
+                poll_interval=30.0,
+                worker_id=None,
+                lease=900.0,
+                fetch_concurrency=3,
+                tca_concurrency=8,
+            ),
+            id="check-changes concurrency",
+        ),
+        pytest.param(
+            (
+                "check-changes",
+                "--daemon",
+                "--poll-interval",
+                "10",
+                "--worker-id",
+                "vm1",
+                "--lease",
+                "60",
+            ),
+            Namespace(
+                action="check-changes",
+                poolsize=multiprocessing.cpu_count(),
+                limit=None,
+                diff_mode="full",
+                diff_budget=10.0,
+                diff_max_size=4_000_000,
+                daemon=True,
+                poll_interval=10.0,
+                worker_id="vm1",
+                lease=60.0,
+                fetch_concurrency=2,
+                tca_concurrency=4,
+            ),
+            id="check-changes daemon",
+        ),
         pytest.param(
             ("reports",),
             Namespace(action="reports"),
@@ -79,6 +276,17 @@ from copypatrol_backend import cli
             Namespace(action="counts"),
             id="counts",
         ),
+        pytest.param(
+            ("site-metadata",),
+            Namespace(action="site-metadata", path=None),
+            id="site-metadata",
+        ),
+        pytest.param(
+            ("site-metadata", "--path", "metadata.json"),
+            Namespace(action="site-metadata", path="metadata.json"),
+            id="site-metadata path",
+        ),
+        pytest.param(("migrate",), Namespace(action="migrate"), id="migrate"),
         pytest.param(
             ("setup",),
             Namespace(
@@ -108,15 +316,408 @@ def test_parse_script_args(args, expected):
         ("store-changes", "--foo", "bar"),
         ("store-changes", "--since", "2022-01-01T00:00:00", "--total", "ten"),
         ("store-changes", "--since", "2022-01-01T00:00:00", "--foo"),
+        ("store-changes", "--batch-size", "ten"),
+        ("record-changes",),
+        ("record-changes", "events.jsonl.gz", "--replay", "foo"),
         ("check-changes", "foo"),
         ("check-changes", "--limit", "ten"),
         ("check-changes", "--workers", "3"),
+        ("check-changes", "--diff-mode", "html"),
+        ("check-changes", "--diff-budget", "soon"),
         ("reports", "foo"),
         ("update-ready-diffs", "foo"),
         ("counts", "foo"),
+        ("site-metadata", "foo"),
+        ("migrate", "foo"),
         ("setup", "--foo"),
     ],
 )
 def test_parse_script_args_exits(args):
     with pytest.raises(SystemExit):
         cli.parse_script_args(*args)
+
+
+def _diff_row(diff_id, /, **kwargs):
+    fields = {
+        "project": "wikipedia",
+        "lang": "en",
+        "page_namespace": 0,
+        "page_title": f"Example {diff_id}",
+        "rev_id": 2 * diff_id,
+        "rev_parent_id": 2 * diff_id - 1,
+        "rev_timestamp": Timestamp(2023, 1, 2, 3, 4, 5),
+        "rev_user_text": "Example",
+    }
+    diff = database.QueuedDiff(**(fields | kwargs))
+    diff.diff_id = diff_id
+    return diff
+
+
+def _test_profile(site, /):
+    return CleaningProfile(
+        sitename=site.sitename,
+        category_regex=re.compile("category"),
+        file_name_regex=re.compile("file"),
+        max_quote_words=50,
+        version="test",
+    )
+
+
+def test_fetch_batch(mocker):
+    def diff_task(lang, rev_id, rev_parent_id, **kwargs):
+        return cli.DiffTask.from_diff(
+            _diff_row(
+                rev_id,
+                lang=lang,
+                rev_id=rev_id,
+                rev_parent_id=rev_parent_id,
+                **kwargs,
+            )
+        )
+
+    mocker.patch(
+        "pywikibot.site.APISite.maxlimit",
+        new_callable=mocker.PropertyMock,
+        return_value=4,
+    )
+    load = mocker.patch(
+        "copypatrol_backend.cli.wiki.load_revisions_by_id",
+        side_effect=lambda site, revids, content: {
+            revid: {"text": f"{site.code}{revid}"}
+            for revid in revids
+            if revid != 7
+        },
+    )
+    tasks = [
+        diff_task("es", 2, 1),
+        diff_task("en", 4, 3),
+        diff_task("en", 5, 0),
+        diff_task("en", 7, 6),
+        diff_task("en", 9, 8, rev_text_hidden=True),
+    ]
+    result = [
+        item
+        for batch in cli._diff_batches(tasks)
+        for item in cli._fetch_batch(batch)
+    ]
+    assert [(task.rev_id, revisions) for task, revisions in result] == [
+        (4, {3: {"text": "en3"}, 4: {"text": "en4"}}),
+        (5, {5: {"text": "en5"}}),
+        (7, {6: {"text": "en6"}}),
+        (9, {}),
+        (2, {1: {"text": "es1"}, 2: {"text": "es2"}}),
+    ]
+    assert [call.args[1] for call in load.call_args_list] == [
+        [3, 4, 5],
+        [6, 7],
+        [1, 2],
+    ]
+
+
+def test_init_worker(mocker):
+    load = mocker.patch("copypatrol_backend.cli.site_metadata.load")
+    register = mocker.patch(
+        "copypatrol_backend.cli.register_cleaning_profiles"
+    )
+    handlers = mocker.patch("copypatrol_backend.cli.signal.signal")
+    profiles = [mocker.sentinel.profile]
+    cli._init_worker(profiles)
+    assert handlers.call_count == 2
+    load.assert_called_once_with()
+    register.assert_called_once_with(profiles)
+
+
+@pytest.mark.parametrize(
+    "text, approximate, expected",
+    [
+        ("added text", 0, "checked"),
+        ("added text", 1, "approximate"),
+        (None, 0, "checked"),
+    ],
+)
+def test_check_diff_result(mocker, text, approximate, expected):
+    def check_diff(page, parent_id, rev_id, *, stats, **kwargs):
+        assert page.title() == "Talk:Example"
+        assert (parent_id, rev_id) == (1, 2)
+        stats["approximate"] += approximate
+        return text
+
+    mocker.patch("copypatrol_backend.cli.check_diff", side_effect=check_diff)
+    task = cli.DiffTask(
+        diff_id=5,
+        project="wikipedia",
+        lang="en",
+        page_namespace=1,
+        page_title="Example",
+        rev_id=2,
+        rev_parent_id=1,
+        metadata=RevisionMetadata(),
+    )
+    assert cli._check_diff((task, None)) == cli.DiffResult(5, expected, text)
+
+
+@pytest.mark.parametrize("created", [False, True])
+def test_submit_diff(mocker, created):
+    sid = UUID(int=1)
+    diff = mocker.Mock(diff_id=5, submission_id=sid if created else None)
+    api = mocker.Mock()
+    api.create_submission.return_value = sid
+    writer = mocker.Mock()
+    assert cli._submit_diff(
+        api,
+        writer,
+        diff,
+        "text",
+        title="Revision 1",
+    )
+    assert api.create_submission.called is not created
+    api.upload_submission.assert_called_once_with(sid, "text")
+    expected = [
+        mocker.call.created(5, sid),
+        mocker.call.update(5, database.Status.UPLOADED),
+    ]
+    assert writer.mock_calls == expected[created:]
+
+
+def test_check_changes_daemon(mocker):
+    def poll_diffs(sessionmaker, owner, *, lease, limit=None, skip=()):
+        assert owner == "vm1"
+        polls = poll.call_count
+        if polls == 4:
+            os.kill(os.getpid(), signal.SIGTERM)
+        # submitted diffs have left the queue
+        skip = {*skip, *(call.args[2].diff_id for call in submit.mock_calls)}
+        # diffs of a site first seen after the pool started
+        diffs = [
+            _diff_row(diff_id, lang="en" if diff_id < 4 else "de")
+            for diff_id in range(1, 2 * polls)
+        ]
+        return [diff for diff in diffs if diff.diff_id not in skip]
+
+    poll = mocker.patch(
+        "copypatrol_backend.cli._poll_diffs",
+        side_effect=poll_diffs,
+    )
+    mocker.patch("copypatrol_backend.cli.POLL_INTERVAL", 0.01)
+    mocker.patch(
+        "pywikibot.site.APISite.maxlimit",
+        new_callable=mocker.PropertyMock,
+        return_value=4,
+    )
+    mocker.patch("copypatrol_backend.cli.database.create_sessionmaker")
+    release = mocker.patch("copypatrol_backend.cli.database.release_leases")
+    api = mocker.patch("copypatrol_backend.cli.tca.TurnitinCoreAPI")
+    profile = mocker.patch(
+        "copypatrol_backend.cli.cleaning_profile",
+        side_effect=_test_profile,
+    )
+    mocker.patch.dict(cleaning_profiles, clear=True)
+    mocker.patch(
+        "copypatrol_backend.cli._fetch_diff_revisions",
+        return_value={},
+    )
+    mocker.patch(
+        "copypatrol_backend.cli.check_diff",
+        # workers only check diffs of sites with a profile
+        side_effect=lambda page, old, new, **kwargs: (
+            "text" if page.site.sitename in cleaning_profiles else None
+        ),
+    )
+    submit = mocker.patch(
+        "copypatrol_backend.cli._submit_diff",
+        return_value=True,
+    )
+    handler = signal.getsignal(signal.SIGTERM)
+    cli.check_changes(daemon=True, poll_interval=0.05, worker_id="vm1")
+    assert signal.getsignal(signal.SIGTERM) is handler
+    assert poll.call_count == 4
+    assert {call.args[0].code for call in profile.call_args_list} == {
+        "en",
+        "de",
+    }
+    assert release.call_args.args[1] == "vm1"
+    # every diff polled before SIGTERM is still submitted, once
+    submitted = sorted(call.args[2].diff_id for call in submit.call_args_list)
+    assert submitted == list(range(1, 8))
+    assert all(
+        call.args[0] is api.return_value for call in submit.call_args_list
+    )
+
+
+def test_check_changes_leases(mocker):
+    def submit_diff(api, writer, diff, text, *, title):
+        # the failed diff finishes long before the other one
+        time.sleep(0.05 if diff.diff_id == 1 else 0.5)
+        return diff.diff_id != 1
+
+    poll = mocker.patch(
+        "copypatrol_backend.cli._poll_diffs",
+        return_value=[_diff_row(1), _diff_row(2)],
+    )
+    mocker.patch("copypatrol_backend.cli.POLL_INTERVAL", 0.01)
+    mocker.patch(
+        "pywikibot.site.APISite.maxlimit",
+        new_callable=mocker.PropertyMock,
+        return_value=4,
+    )
+    mocker.patch("copypatrol_backend.cli.database.create_sessionmaker")
+    renew = mocker.patch("copypatrol_backend.cli.database.renew_leases")
+    release = mocker.patch("copypatrol_backend.cli.database.release_leases")
+    mocker.patch("copypatrol_backend.cli.tca.TurnitinCoreAPI")
+    mocker.patch(
+        "copypatrol_backend.cli.cleaning_profile",
+        side_effect=_test_profile,
+    )
+    mocker.patch(
+        "copypatrol_backend.cli._fetch_diff_revisions",
+        return_value={},
+    )
+    mocker.patch(
+        "copypatrol_backend.cli.check_diff",
+        side_effect=lambda page, old, new, **kwargs: "text",
+    )
+    mocker.patch(
+        "copypatrol_backend.cli._submit_diff",
+        side_effect=submit_diff,
+    )
+    cli.check_changes(
+        worker_id="vm1",
+        lease=datetime.timedelta(seconds=0.1),
+    )
+    assert poll.call_count == 1
+    # leases are renewed without daemon mode too
+    assert renew.call_count >= 1
+    assert renew.call_args.args[1:] == ("vm1", {2})
+    # the failed diff is released right away, the rest at the end
+    assert [call.args[1:] for call in release.call_args_list] == [
+        ("vm1", {1}),
+        ("vm1",),
+    ]
+
+
+def _stream_event(rev_id):
+    return {
+        "meta": {
+            "domain": "en.wikipedia.org",
+            "dt": f"2024-01-01T00:00:0{rev_id}Z",
+        },
+        "revision": {"rev_id": rev_id},
+    }
+
+
+@pytest.mark.parametrize(
+    "batch_size, batch_interval, expected",
+    [
+        (2, None, [[1, 2], [3, 4], [5]]),
+        (10, 0.0, [[1], [2], [3], [4], [5]]),
+        (10, 3600.0, [[1, 2, 3, 4, 5]]),
+    ],
+)
+def test_store_changes_batches(mocker, batch_size, batch_interval, expected):
+    mocker.patch("copypatrol_backend.cli.database.create_sessionmaker")
+    mocker.patch(
+        "copypatrol_backend.cli.database.stream_checkpoint",
+        return_value=None,
+    )
+    mocker.patch(
+        "copypatrol_backend.cli.change_stream",
+        return_value=iter([_stream_event(i) for i in range(1, 6)]),
+    )
+    mocker.patch(
+        "copypatrol_backend.cli._queued_diff",
+        side_effect=lambda event: event["revision"]["rev_id"],
+    )
+    batches = []
+
+    def add_revisions(session, diffs):
+        batches.append(list(diffs))
+        return len(diffs)
+
+    mocker.patch(
+        "copypatrol_backend.cli.database.add_revisions",
+        side_effect=add_revisions,
+    )
+    save = mocker.patch(
+        "copypatrol_backend.cli.database.save_stream_checkpoint"
+    )
+    cli.store_changes(batch_size=batch_size, batch_interval=batch_interval)
+    assert batches == expected
+    # each batch is stored with the time of its last event
+    assert [call.args[2] for call in save.call_args_list] == [
+        Timestamp(2024, 1, 1, 0, 0, batch[-1]) for batch in expected
+    ]
+
+
+def test_store_changes_heartbeat(mocker):
+    mocker.patch("copypatrol_backend.cli.database.create_sessionmaker")
+    mocker.patch(
+        "copypatrol_backend.cli.database.stream_checkpoint",
+        return_value=None,
+    )
+    batches: list[list[int]] = []
+
+    def stream(**kwargs):
+        assert kwargs["heartbeat"] is True
+        yield _stream_event(1)
+        time.sleep(0.02)
+        # a rejected event
+        yield None
+        # the batch was stored without waiting for another accepted event
+        assert batches == [[1]]
+
+    mocker.patch("copypatrol_backend.cli.change_stream", side_effect=stream)
+    mocker.patch(
+        "copypatrol_backend.cli._queued_diff",
+        side_effect=lambda event: event["revision"]["rev_id"],
+    )
+
+    def add_revisions(session, diffs):
+        batches.append(list(diffs))
+        return len(diffs)
+
+    mocker.patch(
+        "copypatrol_backend.cli.database.add_revisions",
+        side_effect=add_revisions,
+    )
+    save = mocker.patch(
+        "copypatrol_backend.cli.database.save_stream_checkpoint"
+    )
+    cli.store_changes(batch_size=10, batch_interval=0.01)
+    assert batches == [[1]]
+    assert save.call_args.args[2] == Timestamp(2024, 1, 1, 0, 0, 1)
+
+
+@pytest.mark.parametrize(
+    "since, checkpoint, expected",
+    [
+        (None, None, None),
+        (
+            None,
+            datetime.datetime(2024, 1, 1, 0, 10),
+            datetime.datetime(2024, 1, 1, 0, 9),
+        ),
+        (
+            datetime.datetime(2024, 1, 2),
+            datetime.datetime(2024, 1, 1, 0, 10),
+            datetime.datetime(2024, 1, 2),
+        ),
+    ],
+)
+def test_store_changes_resume(mocker, since, checkpoint, expected):
+    mocker.patch("copypatrol_backend.cli.database.create_sessionmaker")
+    stream_checkpoint = mocker.patch(
+        "copypatrol_backend.cli.database.stream_checkpoint",
+        return_value=checkpoint,
+    )
+    stream = mocker.patch(
+        "copypatrol_backend.cli.change_stream",
+        return_value=iter([]),
+    )
+    save = mocker.patch(
+        "copypatrol_backend.cli.database.save_stream_checkpoint"
+    )
+    cli.store_changes(since=since, total=3)
+    assert stream_checkpoint.call_count == (since is None)
+    assert stream.call_args.kwargs["since"] == expected
+    assert stream.call_args.kwargs["total"] == 3
+    save.assert_not_called()
@@ -35,6 +35,14 @@ def test_tca_config():
                 enabled=True,
                 namespaces=[0, 2, 118],
                 pagetriage_namespaces=[0, 118],
+                min_size=500,
+                min_size_delta=None,
+                ignore_tags=[
+                    frozenset({"mw-rollback"}),
+                    frozenset({"mw-undo", "twinkle"}),
+                ],
+                ignore_reverts=False,
+                copied_coverage=0.5,
             ),
         ),
         (
@@ -44,6 +52,11 @@ def test_tca_config():
                 enabled=True,
                 namespaces=[0, 2],
                 pagetriage_namespaces=[],
+                min_size=1000,
+                min_size_delta=250,
+                ignore_tags=[frozenset({"mw-rollback"})],
+                ignore_reverts=True,
+                copied_coverage=0.8,
             ),
         ),
         (
@@ -53,6 +66,14 @@ def test_tca_config():
                 enabled=False,
                 namespaces=[0],
                 pagetriage_namespaces=[],
+                min_size=500,
+                min_size_delta=None,
+                ignore_tags=[
+                    frozenset({"mw-rollback"}),
+                    frozenset({"mw-undo", "twinkle"}),
+                ],
+                ignore_reverts=False,
+                copied_coverage=0.5,
             ),
         ),
     ],
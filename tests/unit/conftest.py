@@ -82,3 +82,17 @@ def mock_pywikibot_namespaces():
 def mock_responses():
     with RequestsMock(assert_all_requests_are_fired=False) as requests_mock:
         yield requests_mock
+
+
+@pytest.fixture
+def text_cache(monkeypatch, tmp_path):
+    import threading
+
+    from copypatrol_backend import config, text_cache
+
+    monkeypatch.setenv("CPB_TEXT_CACHE_PATH", str(tmp_path / "text.sqlite3"))
+    monkeypatch.setattr(text_cache, "_local", threading.local())
+    monkeypatch.setattr(text_cache, "_writes", 0)
+    config.text_cache_config.cache_clear()
+    yield text_cache
+    config.text_cache_config.cache_clear()
@@ -6,6 +6,7 @@ import pytest
 from pywikibot.page import Revision
 from pywikibot.time import Timestamp
 from sqlalchemy import Dialect, LargeBinary
+from sqlalchemy.exc import OperationalError
 
 from copypatrol_backend import database
 
@@ -32,6 +33,20 @@ def test_binarydecoratorbase_process(value1, value2):
     assert bb.process_result_value(value2, DIALECT) == value1
 
 
+@pytest.mark.parametrize(
+    "value1,value2",
+    [
+        (None, None),
+        ([], b"[]"),
+        (["foo", "bär"], b'["foo", "b\\u00e4r"]'),
+    ],
+)
+def test_jsonlistdecorator_process(value1, value2):
+    jl = database.JSONListDecorator()
+    assert jl.process_bind_param(value1, DIALECT) == value2
+    assert jl.process_result_value(value2, DIALECT) == value1
+
+
 @pytest.mark.parametrize(
     "value1,value2",
     [
@@ -122,3 +137,79 @@ def test_diff_update_page(mocker, ns, title, revs):
     diff.update_page()
     diff.status_timestamp = now
     assert diff == expected
+
+
+def test_diff_page_memoized():
+    diff = database.QueuedDiff(
+        project="wikipedia",
+        lang="en",
+        page_namespace=0,
+        page_title="Example_title",
+        rev_id=456,
+        rev_parent_id=123,
+        rev_timestamp=Timestamp(2023, 1, 2, 3, 4, 5),
+        rev_user_text="Example user",
+    )
+    page = diff.page
+    assert diff.page is page
+    assert diff.site is page.site
+    assert page.title() == "Example title"
+    diff.page_namespace = 2
+    diff.page_title = "Example_user/Example_title"
+    assert diff.page is not page
+    assert diff.page.title() == "User:Example user/Example title"
+
+
+def test_status_writer_created_kept(mocker):
+    error = OperationalError("UPDATE", {}, Exception())
+    sessionmaker = mocker.Mock(side_effect=[error, mocker.MagicMock()])
+    update = mocker.patch(
+        "copypatrol_backend.database.update_queued_diff",
+        return_value=True,
+    )
+    warning = mocker.patch("pywikibot.warning")
+    writer = database.StatusWriter(sessionmaker, interval=3600)
+    assert writer.created(1, UUID)
+    assert str(UUID) in warning.call_args.args[0]
+    assert len(writer) == 1
+    assert writer.flush()
+    assert len(writer) == 0
+    update.assert_called_once_with(
+        mocker.ANY,
+        1,
+        status=database.Status.CREATED,
+        submission_id=UUID,
+    )
+
+
+@pytest.mark.parametrize(
+    "name, mariadb, version, expected",
+    [
+        ("sqlite", False, (3, 45), False),
+        ("mysql", False, (5, 7, 44), False),
+        ("mysql", False, (8, 0, 36), True),
+        ("mysql", True, (10, 5, 26), False),
+        ("mysql", True, (10, 6, 18), True),
+        ("mariadb", True, (11, 4, 2), True),
+        ("mysql", False, None, False),
+    ],
+)
+def test_skip_locked(mocker, name, mariadb, version, expected):
+    session = mocker.Mock()
+    dialect = session.get_bind.return_value.dialect
+    dialect.name = name
+    dialect.is_mariadb = mariadb
+    dialect.server_version_info = version
+    assert database._skip_locked(session) is expected
+
+
+def test_status_writer_log_pending(mocker):
+    error = mocker.patch("pywikibot.error")
+    writer = database.StatusWriter(mocker.Mock(), interval=3600)
+    writer.delete(1)
+    writer.update(2, database.Status.UPLOADED)
+    writer.log_pending()
+    assert [call.args[0] for call in error.call_args_list] == [
+        "diff 1 was not deleted",
+        "diff 2 was not set to UPLOADED",
+    ]
@@ -0,0 +1,87 @@
+from __future__ import annotations
+
+import random
+
+import pytest
+
+from copypatrol_backend import fingerprint
+
+REFERENCE = (
+    "The quick brown fox jumps over the lazy dog near the riverbank, while"
+    " a heron waits in the reeds for the evening fish to rise. Farmers on"
+    " the far side of the valley bring in the last of the harvest before"
+    " the autumn rains arrive from the western hills."
+)
+
+
+def test_words():
+    assert fingerprint.words("Don't STOP, 2 fast!") == [
+        "don",
+        "t",
+        "stop",
+        "2",
+        "fast",
+    ]
+
+
+@pytest.mark.parametrize("window", [1, 2, 4, 8])
+def test_winnow(window):
+    rng = random.Random(0)
+    hashes = [rng.randrange(100) for _ in range(50)]
+    selected = fingerprint.winnow(hashes, window=window)
+    for start in range(len(hashes) - window + 1):
+        end = start + window
+        # every window has its smallest hash selected
+        chosen = [pos for pos in selected if start <= pos < end]
+        assert min(hashes[pos] for pos in chosen) == min(hashes[start:end])
+    assert all(hashes[pos] == value for pos, value in selected.items())
+
+
+def test_winnow_short():
+    assert fingerprint.winnow([3, 1, 2], window=4) == {1: 1}
+    assert fingerprint.winnow([], window=4) == {}
+
+
+@pytest.mark.parametrize(
+    "text, low, high",
+    [
+        # up to WINDOW - 1 words at either end can be missed
+        pytest.param(REFERENCE, 0.85, 1.0, id="copy"),
+        pytest.param(
+            REFERENCE.upper().replace(",", ";"),
+            0.85,
+            1.0,
+            id="case",
+        ),
+        # string hashes change between runs, so which of the words around
+        # the two edits are covered does too, but only the edited words
+        # are always missed
+        pytest.param(
+            REFERENCE.replace("lazy", "sleepy").replace("last", "rest"),
+            0.55,
+            0.96,
+            id="light edit",
+        ),
+        pytest.param(
+            "A completely different sentence about something else entirely.",
+            0.0,
+            0.0,
+            id="unrelated",
+        ),
+        pytest.param("quick brown fox", 0.0, 0.0, id="too short"),
+    ],
+)
+def test_coverage(text, low, high):
+    reference = fingerprint.fingerprints(REFERENCE)
+    assert low <= fingerprint.coverage(text, reference) <= high
+
+
+def test_coverage_partial():
+    reference = fingerprint.fingerprints(REFERENCE)
+    text = f"{REFERENCE} {' '.join(f'new{i}' for i in range(50))}"
+    copied = len(fingerprint.words(REFERENCE))
+    covered = fingerprint.coverage(text, reference) * len(
+        fingerprint.words(text)
+    )
+    assert copied - 2 * (fingerprint.WINDOW - 1) <= round(covered) <= copied
+    assert fingerprint.coverage(text, frozenset()) == 0.0
@@ -0,0 +1,112 @@
+from __future__ import annotations
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing.pool import ThreadPool
+
+import pytest
+
+from copypatrol_backend import pipeline
+
+
+def test_stage_stats():
+    stats = pipeline.StageStats("check", workers=2)
+    stats.add(0.5)
+    stats.add(0.25, items=3)
+    for depth in (0, 4, 2):
+        stats.sample(depth)
+    assert stats.items == 4
+    assert stats.busy == 0.75
+    assert (stats.samples, stats.depth_total, stats.depth_max) == (3, 6, 4)
+    summary = stats.summary()
+    assert summary.startswith("check: 4 in ")
+    assert summary.endswith("x2, queue 2.0 mean 4 max")
+
+
+def test_channel():
+    stats = pipeline.StageStats("stage", workers=2)
+    channel = pipeline.Channel[int](stats=stats, consumers=2)
+    for item in range(3):
+        channel.put(item)
+    channel.close()
+    assert list(channel) == [0, 1, 2]
+    assert list(channel) == []
+    assert stats.depth_max == 3
+
+
+@pytest.mark.parametrize("workers", [1, 3])
+def test_pipeline(workers):
+    stats = {
+        name: pipeline.StageStats(name, workers=workers)
+        for name in ("split", "square", "collect")
+    }
+    inbox = pipeline.Channel[range](stats=stats["split"], consumers=workers)
+    middle = pipeline.Channel[int](2, stats=stats["square"])
+    outbox = pipeline.Channel[int](
+        2,
+        stats=stats["collect"],
+        consumers=workers,
+    )
+    for start in range(0, 20, 5):
+        inbox.put(range(start, start + 5))
+    inbox.close()
+    collected = []
+    lock = threading.Lock()
+
+    def collect(item):
+        with lock:
+            collected.append(item)
+        return ()
+
+    with (
+        ThreadPool(workers) as pool,
+        ThreadPoolExecutor(2 * workers) as executor,
+    ):
+        futures = pipeline.thread_stage(executor, list, inbox, middle)
+        futures += pipeline.thread_stage(executor, collect, outbox, None)
+        pipeline.process_stage(pool, abs, middle, outbox)
+    for future in futures:
+        future.result()
+    assert sorted(collected) == list(range(20))
+    # the bounded queues never held more than their size
+    assert stats["square"].depth_max <= 2
+    assert stats["collect"].depth_max <= 2
+    assert [stats[name].items for name in stats] == [20, 20, 20]
+
+
+@pytest.mark.parametrize(
+    "fallback, expected",
+    [
+        (None, [0, 1, 3, 4]),
+        (lambda item: [-item], [-2, 0, 1, 3, 4]),
+    ],
+)
+def test_thread_stage_error(mocker, fallback, expected):
+    exception = mocker.patch("pywikibot.exception")
+    stats = {
+        name: pipeline.StageStats(name, workers=2)
+        for name in ("fetch", "collect")
+    }
+    inbox = pipeline.Channel[int](stats=stats["fetch"], consumers=2)
+    outbox = pipeline.Channel[int](stats=stats["collect"], consumers=2)
+    for item in range(5):
+        inbox.put(item)
+    inbox.close()
+
+    def func(item):
+        if item == 2:
+            raise ValueError(item)
+        return [item]
+
+    with ThreadPoolExecutor(2) as executor:
+        futures = pipeline.thread_stage(
+            executor,
+            func,
+            inbox,
+            outbox,
+            fallback=fallback,
+        )
+        for future in futures:
+            future.result()
+    assert sorted(outbox) == expected
+    exception.assert_called_once_with()
@@ -0,0 +1,86 @@
+from __future__ import annotations
+
+import json
+
+import pytest
+import pywikibot
+from pywikibot.site._siteinfo import Siteinfo
+from pywikibot.time import Timestamp
+
+from copypatrol_backend import config, site_metadata, wiki
+
+SITE = pywikibot.Site("en", "wikipedia")
+COMMONS = pywikibot.Site("commons", "commons")
+METADATA = {
+    "general": {"sitename": "Wikipedia", "case": "first-letter"},
+    "namespaces": {},
+    "namespacealiases": [],
+    "fileextensions": [{"ext": "png"}, {"ext": "jpg"}],
+    "interwikimap": [],
+}
+
+
+@pytest.fixture
+def fresh_siteinfo(mocker):
+    for site in (SITE, COMMONS):
+        mocker.patch.object(site, "_siteinfo", Siteinfo(site))
+    mocker.patch.dict(site_metadata._pending, clear=True)
+
+
+def test_write_load(mocker, tmp_path, fresh_siteinfo):
+    get = mocker.patch(
+        "pywikibot.site._siteinfo.Siteinfo.get",
+        side_effect=lambda prop, expiry: METADATA[prop],
+    )
+    path = str(tmp_path / "metadata.json")
+    assert site_metadata.write(path, [SITE, SITE]) == 2
+    assert get.call_count == 2 * len(site_metadata.PROPS)
+    with open(path) as f:
+        data = json.load(f)
+    assert set(data["sites"]) == {SITE.sitename, COMMONS.sitename}
+    mocker.stop(get)
+    request = mocker.patch("pywikibot.site.APISite._request")
+    assert site_metadata.load(path) == 2
+    assert set(site_metadata._pending) == {SITE.sitename, COMMONS.sitename}
+    site_metadata.apply(SITE)
+    assert not site_metadata._pending
+    assert SITE.file_extensions == ["jpg", "png"]
+    assert SITE.siteinfo["case"] == "first-letter"
+    request.assert_not_called()
+
+
+def test_load_keeps_loaded(tmp_path, fresh_siteinfo):
+    path = tmp_path / "metadata.json"
+    path.write_text(
+        json.dumps(
+            {
+                "timestamp": "2024-01-01T00:00:00Z",
+                "sites": {SITE.sitename: METADATA},
+            }
+        )
+    )
+    loaded = {"fileextensions": [{"ext": "gif"}]}
+    assert site_metadata._seed_siteinfo(SITE, loaded, Timestamp.nowutc())
+    assert site_metadata.load(str(path)) == 1
+    site_metadata.apply(SITE)
+    assert SITE.siteinfo["fileextensions"] == [{"ext": "gif"}]
+    assert SITE.siteinfo["case"] == "first-letter"
+
+
+def test_site_from_code_applies(mocker):
+    apply = mocker.patch("copypatrol_backend.site_metadata.apply")
+    wiki.site_from_code.cache_clear()
+    assert wiki.site_from_code("en", "wikipedia") is SITE
+    assert wiki.site_from_code("en", "wikipedia") is SITE
+    apply.assert_called_once_with(SITE)
+    wiki.site_from_code.cache_clear()
+
+
+def test_load_unset(monkeypatch, tmp_path):
+    monkeypatch.delenv("CPB_SITE_METADATA_PATH", raising=False)
+    config.site_metadata_path.cache_clear()
+    assert site_metadata.load() == 0
+    monkeypatch.setenv("CPB_SITE_METADATA_PATH", str(tmp_path / "missing"))
+    config.site_metadata_path.cache_clear()
+    assert site_metadata.load() == 0
+    config.site_metadata_path.cache_clear()
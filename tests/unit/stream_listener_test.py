@@ -1,6 +1,7 @@
 from __future__ import annotations
 
 import json
+from collections import Counter
 
 import pytest
 
@@ -102,6 +103,25 @@ DATA6 = DATA1 | {
         "page_title": "Help:About help pages",
     },
 }
+DATA7 = DATA1 | {
+    "revision": {
+        "editor": {
+            "is_bot": False,
+            "is_system": False,
+            "user_text": "Ignored",
+        },
+        "rev_id": 123,
+        "rev_parent_id": 456,
+        "rev_sha1": "2fd4e1c67a2d28fced849ee1bb76e7391b93eb12",
+        "rev_size": 1000,
+    },
+}
+
+
+@pytest.fixture(autouse=True)
+def reset_stream_filter(monkeypatch):
+    monkeypatch.setattr(stream_listener, "_stream_filter", None)
+    yield
 
 
 @pytest.mark.parametrize(
@@ -113,17 +133,120 @@ DATA6 = DATA1 | {
         (DATA4, False),
         (DATA5, False),
         (DATA6, False),
+        (DATA7, False),
         (DATA1 | {"page_change_kind": "move"}, False),
     ],
 )
 def test_stream_filter(mocker, data, expected):
     mocker.patch(
         "copypatrol_backend.stream_listener.config.user_ignore_list",
-        return_value=[],
+        return_value=["Ignored"],
     )
     assert stream_listener.stream_filter(data) is expected
 
 
+@pytest.mark.parametrize(
+    "revision, prescreen, rejection",
+    [
+        pytest.param({}, stream_listener.Prescreen(), None, id="accepted"),
+        pytest.param(
+            {},
+            stream_listener.Prescreen(min_size=1001),
+            "small-revision",
+            id="min size",
+        ),
+        pytest.param(
+            {},
+            stream_listener.Prescreen(min_size_delta=500),
+            "small-size-delta",
+            id="min size delta",
+        ),
+        pytest.param(
+            {"is_content_visible": False},
+            stream_listener.Prescreen(),
+            "hidden-content",
+            id="hidden content",
+        ),
+        pytest.param(
+            {"tags": ["mw-undo", "twinkle", "foo"]},
+            stream_listener.Prescreen(),
+            "ignored-tags",
+            id="ignored tags",
+        ),
+        pytest.param(
+            {"tags": ["mw-undo"]},
+            stream_listener.Prescreen(),
+            None,
+            id="partial ignored tags",
+        ),
+        pytest.param(
+            {"rev_is_revert": True},
+            stream_listener.Prescreen(ignore_reverts=True),
+            "revert",
+            id="revert",
+        ),
+        pytest.param(
+            {"rev_is_revert": True},
+            stream_listener.Prescreen(),
+            None,
+            id="revert allowed",
+        ),
+    ],
+)
+def test_stream_filter_prescreen(mocker, revision, prescreen, rejection):
+    mocker.patch.object(stream_listener, "prescreen_rejections", Counter())
+    stream_filter = stream_listener.StreamFilter(
+        namespaces={"en.wikipedia.org": frozenset({0})},
+        ignored_users=frozenset(),
+        prescreens={"en.wikipedia.org": prescreen},
+    )
+    data = DATA1 | {
+        "prior_state": {
+            "revision": {
+                "rev_id": 456,
+                "rev_sha1": "de9f2c7fd25e1b3afad3e85a0bd17d9b100db4b3",
+                "rev_size": 600,
+            },
+        },
+        "revision": DATA1["revision"] | revision,
+    }
+    assert stream_filter(data) is (rejection is None)
+    expected = {rejection: 1} if rejection else {}
+    assert stream_listener.prescreen_rejections == expected
+
+
+def test_compiled_stream_filter(mocker):
+    user_ignore_list = mocker.patch(
+        "copypatrol_backend.stream_listener.config.user_ignore_list",
+        return_value=[],
+    )
+    stream_filter = stream_listener.compiled_stream_filter()
+    assert stream_filter.namespaces == {
+        "en.wikipedia.org": frozenset({0, 2, 118}),
+        "es.wikipedia.org": frozenset({0, 2}),
+    }
+    assert stream_filter.prescreens["en.wikipedia.org"] == (
+        stream_listener.Prescreen()
+    )
+    assert stream_filter.prescreens["es.wikipedia.org"] == (
+        stream_listener.Prescreen(
+            min_size=1000,
+            min_size_delta=250,
+            ignore_tags=(frozenset({"mw-rollback"}),),
+            ignore_reverts=True,
+        )
+    )
+    assert stream_listener.compiled_stream_filter() is stream_filter
+    assert user_ignore_list.call_count == 1
+    stream_filter.expires = 0
+    user_ignore_list.return_value = ["Example"]
+    refreshed = stream_listener.compiled_stream_filter()
+    assert refreshed is not stream_filter
+    assert refreshed.ignored_users == frozenset({"Example"})
+    assert refreshed(DATA1) is False
+    assert stream_filter(DATA1) is True
+
+
 class _Event:
     def __init__(self, data):
         self.type = "message"
@@ -177,3 +300,70 @@ def test_change_stream(mocker):
     )
     revisions = list(stream_listener.change_stream(total=1))
     assert revisions == [DATA1]
+
+
+def test_record_replay_stream(mocker, tmp_path):
+    mocker.patch(
+        "pywikibot._code_fam_from_url",
+        wraps=_code_fam_from_url,
+    )
+    mocker.patch(
+        "pywikibot.comms.eventstreams.EventSource",
+        _ES,
+    )
+    path = str(tmp_path / "events.jsonl")
+    assert stream_listener.record_stream(path, total=3) == 3
+    assert list(stream_listener.read_events(path)) == [DATA1, DATA2, DATA3]
+    stats = stream_listener.StreamStats()
+    revisions = list(stream_listener.replay_stream(path, stats=stats))
+    assert revisions == [DATA1]
+    assert (stats.events, stats.accepted) == (3, 1)
+    assert "3 events" in stats.summary()
+    assert "1 accepted (33.3%)" in stats.summary()
+    revisions = list(stream_listener.replay_stream(path, heartbeat=True))
+    assert revisions == [DATA1, None, None]
+
+
+def test_replay_stream_ignored_users(tmp_path):
+    # sockets are blocked, so replays must not fetch the user ignore list
+    path = tmp_path / "events.jsonl"
+    path.write_text(json.dumps(DATA1))
+    assert list(stream_listener.replay_stream(str(path))) == [DATA1]
+    revisions = stream_listener.replay_stream(
+        str(path),
+        ignored_users={"Example"},
+    )
+    assert list(revisions) == []
+
+
+def test_replay_stream_realtime(mocker, tmp_path):
+    mocker.patch(
+        "copypatrol_backend.stream_listener.time.monotonic",
+        return_value=0,
+    )
+    sleep = mocker.patch("copypatrol_backend.stream_listener.time.sleep")
+    path = tmp_path / "events.jsonl"
+    path.write_text(
+        "\n".join(
+            json.dumps(
+                DATA1
+                | {
+                    "meta": {
+                        "domain": "en.wikipedia.org",
+                        "uri": "https://en.wikipedia.org/wiki/Wikipedia",
+                        "dt": dt,
+                    },
+                }
+            )
+            for dt in (
+                "2023-01-01T00:00:00Z",
+                "2023-01-01T00:00:02.5Z",
+                "2023-01-01T00:00:03Z",
+            )
+        )
+    )
+    revisions = list(
+        stream_listener.replay_stream(str(path), realtime=True, total=2)
+    )
+    assert len(revisions) == 2
+    assert sleep.call_args_list == [mocker.call(2.5)]
@@ -0,0 +1,109 @@
+from __future__ import annotations
+
+from concurrent.futures import ThreadPoolExecutor
+
+from copypatrol_backend import config
+from copypatrol_backend import text_cache as text_cache_module
+
+
+def test_text_cache_disabled():
+    config.text_cache_config.cache_clear()
+    text_cache_module.save_revision_texts("wikipedia:en", {1: "one"})
+    assert text_cache_module.revision_texts("wikipedia:en", [1]) == {}
+    text_cache_module.save_clean_text("wikipedia:en", "1", "one", "1")
+    assert text_cache_module.clean_text("wikipedia:en", "1", "one") is None
+    config.text_cache_config.cache_clear()
+
+
+def test_revision_texts(text_cache):
+    text_cache.save_revision_texts("wikipedia:en", {1: "one", 2: "two"})
+    text_cache.save_revision_texts("wikipedia:es", {1: "uno"})
+    assert text_cache.revision_texts("wikipedia:en", [1, 2, 3]) == {
+        1: "one",
+        2: "two",
+    }
+    assert text_cache.revision_texts("wikipedia:es", [1, 2]) == {1: "uno"}
+    assert text_cache.revision_texts("wikipedia:en", []) == {}
+
+
+def test_revision_texts_shared_by_content(text_cache):
+    text_cache.save_revision_texts("wikipedia:en", {1: "same", 2: "same"})
+    conn = text_cache.connection()
+    assert conn.execute("SELECT COUNT(*) FROM texts").fetchone() == (1,)
+
+
+def test_clean_text_versioned(text_cache):
+    text_cache.save_clean_text("wikipedia:en", "1", "''raw''", "raw")
+    assert text_cache.clean_text("wikipedia:en", "1", "''raw''") == "raw"
+    assert text_cache.clean_text("wikipedia:en", "2", "''raw''") is None
+    assert text_cache.clean_text("wikipedia:es", "1", "''raw''") is None
+
+
+def test_evict(text_cache, monkeypatch):
+    monkeypatch.setenv("CPB_TEXT_CACHE_MAX_MB", "0")
+    config.text_cache_config.cache_clear()
+    monkeypatch.setattr(text_cache, "EVICT_EVERY", 3)
+    text_cache.save_revision_texts("wikipedia:en", {1: "one", 2: "two"})
+    assert text_cache.revision_texts("wikipedia:en", [1, 2]) == {
+        1: "one",
+        2: "two",
+    }
+    text_cache.save_revision_texts("wikipedia:en", {3: "three"})
+    assert text_cache.revision_texts("wikipedia:en", [1, 2, 3]) == {}
+    conn = text_cache.connection()
+    assert conn.execute("SELECT COUNT(*) FROM revisions").fetchone() == (0,)
+
+
+def test_evict_least_recently_used(text_cache, monkeypatch, mocker):
+    monkeypatch.setenv("CPB_TEXT_CACHE_MAX_MB", "0")
+    config.text_cache_config.cache_clear()
+    monkeypatch.setattr(text_cache, "EVICT_LIMIT", 1)
+    clock = mocker.patch("copypatrol_backend.text_cache.time")
+    for revid, text in enumerate(["one", "two", "three"], start=1):
+        clock.time.return_value = revid
+        text_cache.save_revision_texts("wikipedia:en", {revid: text})
+    conn = text_cache.connection()
+    (used,) = conn.execute("SELECT bytes FROM usage").fetchone()
+    assert conn.execute("SELECT SUM(size) FROM texts").fetchone() == (used,)
+    # hits within the resolution leave atime as it is
+    clock.time.return_value = text_cache.ATIME_RESOLUTION
+    assert text_cache.revision_texts("wikipedia:en", [1]) == {1: "one"}
+    clock.time.return_value = text_cache.ATIME_RESOLUTION + 2
+    assert text_cache.revision_texts("wikipedia:en", [2]) == {2: "two"}
+    assert text_cache.evict(conn) == 1
+    assert text_cache.revision_texts("wikipedia:en", [1, 2, 3]) == {
+        2: "two",
+        3: "three",
+    }
+    assert text_cache.evict(conn) == 1
+    assert text_cache.revision_texts("wikipedia:en", [1, 2, 3]) == {2: "two"}
+    assert conn.execute("SELECT revid FROM revisions").fetchall() == [(2,)]
+    (size,) = conn.execute("SELECT size FROM texts").fetchone()
+    assert conn.execute("SELECT bytes FROM usage").fetchone() == (size,)
+
+
+def test_connection_per_process(text_cache, mocker):
+    conn = text_cache.connection()
+    assert text_cache.connection() is conn
+    mocker.patch("os.getpid", return_value=-1)
+    assert text_cache.connection() is not conn
+
+
+def test_connection_per_thread(text_cache):
+    conn = text_cache.connection()
+    text_cache.save_revision_texts("wikipedia:en", {1: "one"})
+
+    def use_cache(revid):
+        text_cache.save_revision_texts("wikipedia:en", {revid: str(revid)})
+        texts = text_cache.revision_texts("wikipedia:en", [1, revid])
+        return text_cache.connection(), texts
+
+    with ThreadPoolExecutor(2) as executor:
+        results = list(executor.map(use_cache, [2, 3]))
+    assert [texts for _, texts in results] == [
+        {1: "one", 2: "2"},
+        {1: "one", 3: "3"},
+    ]
+    conns = {id(thread_conn) for thread_conn, _ in results}
+    assert id(conn) not in conns
+    assert text_cache.connection() is conn
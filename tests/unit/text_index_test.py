@@ -0,0 +1,52 @@
+from __future__ import annotations
+
+import pytest
+
+from copypatrol_backend.text_index import TextIndex
+
+FOX = "The quick brown fox jumps over the lazy dog near the riverbank."
+PACK = "Pack my box with five dozen liquor jugs before the long winter."
+TEXT = (
+    "The quick brown fox jumps over the lazy dog near the riverbank.\n"
+    "  Pack my box with five dozen liquor jugs before the long winter.  \n"
+    "\n"
+    "Sphinx of black quartz, judge my vow.\n"
+)
+
+
+@pytest.mark.parametrize(
+    "value, expected",
+    [
+        (FOX, True),
+        (PACK, True),
+        ("  " + PACK, True),
+        ("   " + PACK, False),
+        ("brown fox jumps over the lazy dog near the river", True),
+        ("dog near the riverbank.\n  Pack my box with five dozen", True),
+        ("brown fox jumps over the lazy cat near the river", False),
+        ("Totally unrelated sentence that never appears in the text.", False),
+        ("black quartz", True),
+        ("white quartz", False),
+        ("", True),
+    ],
+)
+def test_text_index(value, expected):
+    assert (value in TextIndex(TEXT)) is expected
+    assert (value in TEXT) is expected
+
+
+@pytest.mark.parametrize("size, step", [(4, 1), (8, 3), (16, 16)])
+def test_text_index_sizes(size, step):
+    index = TextIndex(TEXT, size=size, step=step)
+    for start in range(0, len(TEXT), 7):
+        for end in range(start, len(TEXT), 11):
+            assert TEXT[start:end] in index
+    assert "over the lazy cat" not in index
+
+
+def test_text_index_inexact():
+    index = TextIndex(TEXT, size=8, step=1, exact=False)
+    # both ends match indexed n-grams, so only exact mode catches this
+    value = "The quick brown fox jumps over the lazy dog, the riverbank."
+    assert value in index
+    assert value not in TextIndex(TEXT, size=8, step=1)
@@ -1,6 +1,7 @@
 from __future__ import annotations
 
 import pywikibot
+from pywikibot.page import Revision
 
 from copypatrol_backend import wiki
 from testing.resources import resource
@@ -45,3 +46,204 @@ def test_load_revisions_badrevids(mocker):
         },
     )
     assert wiki.load_revisions(SITE, [1167163687]) is None
+
+
+def _revisions_response(revids, *, content, hidden=()):
+    revisions = []
+    for revid in revids:
+        main = {"contentmodel": "wikitext"}
+        rev = {"revid": revid, "parentid": 0, "slots": {"main": main}}
+        if revid in hidden:
+            main["texthidden"] = ""
+            rev["sha1hidden"] = ""
+        elif content:
+            main["*"] = f"text {revid}"
+        revisions.append(rev)
+    page = {"pageid": 1, "ns": 0, "title": "A", "revisions": revisions}
+    return {"query": {"pages": {"1": page}}}
+
+
+def test_load_revisions_text_cache(mocker, text_cache):
+    def simple_request(**kwargs):
+        request = mocker.Mock()
+        request.submit.return_value = _revisions_response(
+            kwargs["revids"],
+            content="content" in kwargs["rvprop"],
+            hidden=[3],
+        )
+        return request
+
+    mocker.patch.object(SITE, "simple_request", side_effect=simple_request)
+    res = wiki.load_revisions(SITE, [1, 2], content=True)
+    assert res is not None
+    assert {revid: rev.text for revid, rev in res.items()} == {
+        1: "text 1",
+        2: "text 2",
+    }
+    text_cache.save_revision_texts(SITE.sitename, {3: "text 3"})
+    res = wiki.load_revisions(SITE, [1, 2, 3, 4], content=True)
+    assert res is not None
+    assert {revid: rev.text for revid, rev in res.items()} == {
+        1: "text 1",
+        2: "text 2",
+        3: None,
+        4: "text 4",
+    }
+    assert "texthidden" in res[3]["slots"]["main"]
+    calls = [
+        (call.kwargs["revids"], "content" in call.kwargs["rvprop"])
+        for call in SITE.simple_request.call_args_list
+    ]
+    assert calls == [([1, 2], True), ([1, 2, 3], False), ([4], True)]
+
+
+def test_load_revisions_by_id(mocker):
+    mocker.patch(
+        "pywikibot.site.APISite.maxlimit",
+        new_callable=mocker.PropertyMock,
+        return_value=3,
+    )
+
+    def simple_request(**kwargs):
+        revids = kwargs["revids"]
+        data = _revisions_response(
+            # responses over the size limit leave out revisions
+            [revid for revid in revids if revid != 3 or revids[0] == 3],
+            content=True,
+        )
+        if 2 in revids:
+            data["query"]["badrevids"] = {"2": {"revid": 2, "missing": ""}}
+            data["query"]["pages"]["1"]["revisions"].pop(1)
+        request = mocker.Mock()
+        request.submit.return_value = data
+        return request
+
+    mocker.patch.object(SITE, "simple_request", side_effect=simple_request)
+    res = wiki.load_revisions_by_id(SITE, [1, 2, 3, 4, 1, 5], content=True)
+    assert {revid: Revision(**data).text for revid, data in res.items()} == {
+        1: "text 1",
+        3: "text 3",
+        4: "text 4",
+        5: "text 5",
+    }
+    assert [
+        call.kwargs["revids"] for call in SITE.simple_request.call_args_list
+    ] == [[1, 2, 3], [3, 4, 5]]
+
+
+def test_latest_revids(mocker):
+    mocker.patch(
+        "pywikibot.site.APISite.maxlimit",
+        new_callable=mocker.PropertyMock,
+        return_value=50,
+    )
+    request = mocker.patch.object(SITE, "simple_request")
+    request.return_value.submit.return_value = {
+        "query": {
+            "pages": [
+                {
+                    "pageid": 1,
+                    "ns": 0,
+                    "title": "Foo",
+                    "revisions": [{"revid": 12, "parentid": 11}],
+                },
+                {
+                    "pageid": 2,
+                    "ns": 0,
+                    "title": "Bar",
+                    "revisions": [{"revid": 21, "parentid": 0}],
+                },
+                {"ns": 0, "title": "Missing", "missing": True},
+            ]
+        }
+    }
+    assert wiki.latest_revids(SITE, ["Foo", "Bar", "Missing", "Foo"]) == [
+        12,
+        11,
+        21,
+    ]
+    assert request.call_args.kwargs["titles"] == ["Foo", "Bar", "Missing"]
+
+
+DIFF_TABLE = """
+<tr>
+  <td colspan="2" class="diff-lineno">Line 1:</td>
+  <td colspan="2" class="diff-lineno">Line 1:</td>
+</tr>
+<tr>
+  <td class="diff-marker"></td>
+  <td class="diff-context diff-side-deleted"><div>Intro &amp; more</div></td>
+  <td class="diff-marker"></td>
+  <td class="diff-context diff-side-added"><div>Intro &amp; more</div></td>
+</tr>
+<tr>
+  <td class="diff-marker" data-marker="−"></td>
+  <td class="diff-deletedline diff-side-deleted"><div>Old <del
+    class="diffchange diffchange-inline">text</del></div></td>
+  <td class="diff-marker" data-marker="+"></td>
+  <td class="diff-addedline diff-side-added"><div>Old <ins
+    class="diffchange diffchange-inline">words</ins></div></td>
+</tr>
+<tr>
+  <td colspan="2" class="diff-empty diff-side-deleted"></td>
+  <td class="diff-marker" data-marker="+"></td>
+  <td class="diff-addedline diff-side-added"><div><a
+    class="mw-diff-movedpara-right" href="#m">&#9899;</a>New</div></td>
+</tr>
+<tr>
+  <td colspan="2" class="diff-lineno">Line 40:</td>
+  <td colspan="2" class="diff-lineno">Line 41:</td>
+</tr>
+<tr>
+  <td class="diff-marker">−</td>
+  <td class="diff-deletedline"><div>Gone</div></td>
+  <td colspan="2" class="diff-empty"></td>
+</tr>
+<tr>
+  <td class="diff-marker"></td>
+  <td class="diff-context"></td>
+  <td class="diff-marker"></td>
+  <td class="diff-context"><div>End</div></td>
+</tr>
+"""
+
+
+def test_compare_revisions(mocker):
+    request = mocker.patch.object(SITE, "simple_request")
+    request.return_value.submit.return_value = {
+        "compare": {"fromrevid": 1, "torevid": 2, "body": DIFF_TABLE}
+    }
+    assert wiki.compare_revisions(SITE, 1, 2) == [
+        ("Intro & more\nOld text", "Intro & more\nOld words\nNew"),
+        ("Gone\n", "End"),
+    ]
+    assert request.call_args.kwargs["fromrev"] == 1
+    assert request.call_args.kwargs["torev"] == 2
+
+
+def test_compare_revisions_error(mocker):
+    request = mocker.patch.object(SITE, "simple_request")
+    request.return_value.submit.side_effect = pywikibot.exceptions.APIError(
+        "nosuchrevid", "no such revision"
+    )
+    assert wiki.compare_revisions(SITE, 1, 2) is None
+
+
+def test_site_registry(mocker):
+    wiki.site_from_domain.cache_clear()
+    wiki.site_from_code.cache_clear()
+    site = mocker.patch("pywikibot.Site", return_value=SITE)
+    for _ in range(3):
+        assert wiki.site_from_domain("en.wikipedia.org") is SITE
+        assert wiki.site_from_code("en", "wikipedia") is SITE
+    assert site.call_args_list == [
+        mocker.call(url="https://en.wikipedia.org/wiki/DUMMY"),
+        mocker.call("en", "wikipedia"),
+    ]
+    info = wiki.site_registry_info()
+    assert info["site_from_domain"].hits == 2
+    assert info["site_from_domain"].misses == 1
+    assert info["site_from_code"].hits == 2
+    assert info["site_from_code"].misses == 1
+    wiki.site_from_domain.cache_clear()
+    wiki.site_from_code.cache_clear()